@@ -0,0 +1,12 @@
+"""Runs a generation worker, which generates replies when
+config.generation_workers is enabled. Start one or more of these processes
+next to the web server. See sigmund/generation_worker.py.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+from sigmund.server import create_app
+from sigmund import generation_worker
+
+app = create_app()
+if __name__ == '__main__':
+    generation_worker.work(app)
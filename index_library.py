@@ -1,5 +1,6 @@
 from sigmund import config
-from sigmund.library import Library
+from sigmund.library import Library, publish_index
+from sigmund.indexing import Indexer
 from pathlib import Path
 import logging
 logging.basicConfig(level=logging.INFO, force=True)
@@ -10,8 +11,15 @@ library = Library(
     embedding_provider=config.search_embedding_provider,
     embedding_model=config.search_embedding_model)
 
-added = 0
-for path in Path('sources').glob('*.json'):
-    print(f"Adding documents from {path}")
-    added += library.add(path)
-print(f"Added {added} documents")
+# A library without a keyword index is published once the keyword index has
+# been built, even if no documents have changed
+missing_keyword_index = library.keyword_index is None
+# Only new and changed documents are embedded, and documents that have been
+# removed from the sources are deleted from the library
+stats = Indexer(library).sync(sorted(Path('sources').glob('*.json')))
+print(f"Added {stats['added']}, updated {stats['updated']}, deleted "
+      f"{stats['deleted']}, and kept {stats['unchanged']} documents")
+# Notify running servers that the index has changed
+if stats['added'] or stats['updated'] or stats['deleted'] or \
+        missing_keyword_index:
+    publish_index(config.search_persist_directory)
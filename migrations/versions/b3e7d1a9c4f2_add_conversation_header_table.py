@@ -0,0 +1,43 @@
+"""Add conversation_header table
+
+Revision ID: b3e7d1a9c4f2
+Revises: f8a2c3d4e5b6
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e7d1a9c4f2'
+down_revision = 'f8a2c3d4e5b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table is not populated here, because titles are encrypted with keys
+    # that are derived from user passwords. Headers for existing conversations
+    # are created when the user first lists their conversations.
+    op.create_table(
+        'conversation_header',
+        sa.Column('conversation_id', sa.Integer(),
+                  sa.ForeignKey('conversation.conversation_id'),
+                  primary_key=True),
+        sa.Column('user_id', sa.Integer(),
+                  sa.ForeignKey('user.user_id'), index=True),
+        sa.Column('title', sa.LargeBinary()),
+        sa.Column('last_updated', sa.Float()),
+        sa.Column('message_count', sa.Integer()),
+        sa.Column('active', sa.Boolean(), server_default='0',
+                  nullable=False),
+    )
+    op.create_index('ix_conversation_header_user_id_last_updated',
+                    'conversation_header', ['user_id', 'last_updated'])
+
+
+def downgrade():
+    op.drop_index('ix_conversation_header_user_id_last_updated',
+                  table_name='conversation_header')
+    op.drop_table('conversation_header')
@@ -0,0 +1,46 @@
+"""Add search_token table
+
+Revision ID: c9a4f2e8d1b7
+Revises: b3e7d1a9c4f2
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9a4f2e8d1b7'
+down_revision = 'b3e7d1a9c4f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing conversations are indexed when the user first searches, because
+    # the index is keyed with per-user keys
+    op.create_table(
+        'search_token',
+        sa.Column('search_token_id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.user_id')),
+        sa.Column('conversation_id', sa.Integer(),
+                  sa.ForeignKey('conversation.conversation_id'), index=True),
+        sa.Column('message_id', sa.Integer(),
+                  sa.ForeignKey('message.message_id'), index=True,
+                  nullable=True),
+        sa.Column('token_hash', sa.String(32)),
+        sa.Column('count', sa.Integer()),
+    )
+    op.create_index('ix_search_token_user_id_token_hash', 'search_token',
+                    ['user_id', 'token_hash'])
+    with op.batch_alter_table('conversation_header', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_indexed', sa.Boolean(),
+                                      server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('conversation_header', schema=None) as batch_op:
+        batch_op.drop_column('search_indexed')
+    op.drop_index('ix_search_token_user_id_token_hash',
+                  table_name='search_token')
+    op.drop_table('search_token')
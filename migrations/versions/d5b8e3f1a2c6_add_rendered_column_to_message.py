@@ -0,0 +1,28 @@
+"""Add rendered column to Message
+
+Revision ID: d5b8e3f1a2c6
+Revises: c9a4f2e8d1b7
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5b8e3f1a2c6'
+down_revision = 'c9a4f2e8d1b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Messages are rendered and cached when a conversation is first opened
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rendered', sa.LargeBinary(),
+                                      nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('rendered')
@@ -0,0 +1,30 @@
+"""Add title column to search_token
+
+Revision ID: e7c1d4a9b3f5
+Revises: d5b8e3f1a2c6
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c1d4a9b3f5'
+down_revision = 'd5b8e3f1a2c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('search_token', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('title', sa.Boolean(),
+                                      server_default='0', nullable=False))
+    # Titles are not in the index yet, so all conversations are re-indexed
+    # when the user first searches
+    op.execute('UPDATE conversation_header SET search_indexed = 0')
+
+
+def downgrade():
+    with op.batch_alter_table('search_token', schema=None) as batch_op:
+        batch_op.drop_column('title')
@@ -42,6 +42,11 @@ server_url = os.environ.get('FLASK_SERVER_URL', 'http://127.0.0.1:5000')
 flask_port = int(os.environ.get('FLASK_PORT', 5000))
 # The flask host arhument where all 0s means listen to all incoming addresses
 flask_host = os.environ.get('FLASK_HOST', '0.0.0.0')
+# The number of proxies in front of the app, such as nginx. The client address
+# (and protocol) is taken from the X-Forwarded-For (and X-Forwarded-Proto)
+# headers that are set by these proxies. With 0, these headers are ignored,
+# because clients can set them to anything.
+flask_proxy_hops = int(os.environ.get('FLASK_PROXY_HOPS', 0))
 # The secret key is used for logging in. This should be a long and arbitrary
 # string that is hard to guess. This should not be shared
 flask_secret_key = os.environ.get('FLASK_SECRET_KEY', '0123456789ABCDEF')
@@ -58,12 +63,31 @@ max_prompt_length = 100_000
 condense_chunk_length = 10000
 
 # MESSAGES
+# When enabled, only new and changed messages are written to the database when
+# a conversation is saved. When disabled, all messages are rewritten.
+incremental_persistence = True
+# The rendered HTML of messages is cached, so that conversations open quickly.
+# The cache size is the number of messages that are kept in memory, per
+# process. Rendered messages are also stored, encrypted, in the database,
+# unless render_cache_persistent is False.
+render_cache_size = 5000
+render_cache_persistent = True
+# When a conversation is opened, only the last messages are shown. Earlier
+# messages are loaded in windows when the user scrolls up. The maximum window
+# size limits the number of messages that can be requested at once.
+chat_history_window = 50
+chat_history_max_window = 200
 # The maximum length of a user message
 max_message_length = 10
 # A fixed welcome message
 welcome_message = '''Nice to meet you! I am Sigmund, your friendly AI assistant! How can I help you?'''
 # The default title of a new conversation
 default_conversation_title = 'New conversation'
+# Conversation titles are generated in the background by a fixed number of
+# worker threads per process. Title jobs that are submitted while the queue is
+# full are dropped, and retried when the conversation is saved again.
+title_workers = int(os.environ.get('SIGMUND_TITLE_WORKERS', 2))
+title_queue_size = int(os.environ.get('SIGMUND_TITLE_QUEUE_SIZE', 100))
 
 # LIMITS
 #
@@ -71,6 +95,48 @@ default_conversation_title = 'New conversation'
 max_message_length = 500_000
 anthropic_max_thinking_tokens = 2048
 
+# STREAMING
+#
+# When enabled, streamed replies are sent to the client as deltas of rendered
+# Markdown blocks, such that each finalized block is rendered and sent only
+# once. When disabled, the full accumulated reply is re-rendered and sent for
+# every chunk.
+stream_delta = True
+# Streamed text is coalesced, so that a chunk is sent to the client at most
+# once per interval (in seconds), unless the number of new characters exceeds
+# a threshold. The first chunk is sent right away, and remaining text is sent
+# before a tool is run and before the final reply. Set the interval to 0 to
+# send every chunk.
+stream_coalesce_interval = 0.1
+stream_coalesce_chars = 200
+# Streams are cancelled through a Redis channel, which is read by a background
+# thread in each process. The poll interval (in seconds) is the maximum time
+# that this thread blocks while waiting for a message. Cancellations are also
+# stored for a while (in seconds), for streams that haven't started yet.
+# Providers that report token usage only at the end of a stream don't report
+# usage for cancelled streams. Usage is then estimated from the number of
+# characters.
+stream_cancel_poll_interval = 1
+stream_cancel_expiry = 60
+stream_cancel_chars_per_token = 4
+# When enabled, replies are not generated by the web process, but by separate
+# worker processes (generation_worker.py). Replies are then kept in Redis for
+# a while (in seconds), so that clients that lose the connection can resume
+# the stream. Jobs that no worker has taken within the job expiry (in seconds)
+# are dropped. Each worker process runs several jobs at the same time, in
+# threads, and signals that a job is still running every heartbeat interval
+# (in seconds). The streaming route sends a keep-alive message when no events
+# have arrived for a while (in seconds), and gives up after the idle timeout.
+generation_workers = int(os.environ.get('SIGMUND_GENERATION_WORKERS', False))
+generation_worker_threads = int(
+    os.environ.get('SIGMUND_GENERATION_WORKER_THREADS', 8))
+generation_events_expiry = 600
+generation_job_expiry = 300
+generation_heartbeat_interval = 5
+generation_poll_interval = 5
+generation_keepalive_interval = 15
+generation_idle_timeout = 300
+
 # LOGGING
 #
 # When set to True, replies will be logged. This should disabled during 
@@ -146,6 +212,12 @@ anthropic_kwargs = {
 }
 openai_kwargs = {'reasoning_effort': 'none'}
 mistral_kwargs = {}
+# Provider clients are shared by all models in a process, so that HTTP
+# connections to the providers are kept alive across requests. The pool size is
+# the maximum number of connections per provider client, and the keep-alive is
+# the number of seconds that an idle connection is kept open.
+model_client_pool_size = int(os.environ.get('SIGMUND_MODEL_CLIENT_POOL_SIZE', 20))
+model_client_keepalive = float(os.environ.get('SIGMUND_MODEL_CLIENT_KEEPALIVE', 60))
 
 # The model token rate is used to convert model-specific consumption to a 
 # standardized usage measure. The model names below are those defined in the 
@@ -165,6 +237,12 @@ weekly_limit_exceeded_message = '''Sorry, I can't reply right now, because you h
 In the meanwhile, why not review our [fair-use policy](/fair-use)? This includes suggestions to keep usage under control in the future. \U0001f6a6\u23f3\U0001f917
 '''
 weekly_token_range = 7
+# Usage is counted in sliding-window counters in Redis, so that checking the
+# limits doesn't require summing the activity table. The counters are rebuilt
+# from the activity table when they are older than the reconciliation interval
+# (in seconds). When disabled, the activity table is queried directly.
+usage_counters = True
+usage_reconcile_interval = 600
 model_token_rate = {
     'claude-haiku-4-5': {
         'output': 5,
@@ -295,9 +373,71 @@ search_embedding_model = 'text-embedding-3-large'
 # search
 public_search_docs_max = 4
 public_search_max_doc_length = 1000
+# Public search results are summarized with the public model of this model
+# config, and cached in Redis for public_search_cache_ttl seconds. Public
+# searches are rate-limited per client with a token bucket that allows bursts
+# of public_search_rate_limit_burst requests, and is refilled with
+# public_search_rate_limit_rate requests per second.
+public_search_model_config = 'mistral'
+public_search_cache_ttl = 3600
+public_search_rate_limit_burst = 10
+public_search_rate_limit_rate = 0.2
 search_persist_directory = "library"
+# The embedding provider is "openai", "local", or "hashing". The local provider
+# embeds on the CPU, either with all-MiniLM-L6-v2 through ONNX Runtime, or with
+# any other sentence-transformers model, which requires the optional
+# sentence-transformers package. The hashing provider is a deterministic
+# stand-in that doesn't capture meaning, and is only meant for tests and
+# benchmarks. Each provider (and model) has its own embedding space, so a
+# library needs to be re-indexed, in its own persist directory, when the
+# provider is changed.
 search_embedding_provider = "openai"
 search_embedding_model = "text-embedding-3-large"
+# The local provider embeds texts in batches, several batches at the same time
+local_embedding_batch_size = 32
+local_embedding_workers = 4
+# The number of dimensions of embeddings from the hashing provider
+hashing_embedding_dimensions = 256
+# Query embeddings are cached in memory, per process, and in Redis, so that the
+# same query is embedded only once. The cache size is the number of embeddings
+# that are kept in memory, and the TTL is the number of seconds that embeddings
+# are kept in Redis. Set the TTL to None to disable caching in Redis.
+search_embedding_cache_size = 1024
+search_embedding_cache_ttl = 7 * 24 * 3600
+# Library searches combine vector search with a BM25 keyword index, which is
+# built when the library is indexed (index_library.py), so that exact
+# identifiers are also found. Vector results (within
+# search_max_distance_fallback) and keyword results are combined by
+# reciprocal-rank fusion, in a single search. Each of both contributes up to
+# search_hybrid_candidates results. Without a keyword index, or when hybrid
+# search is disabled, searches fall back to vector search, and to a second
+# search with search_max_distance_fallback if nothing is found.
+search_hybrid = True
+search_hybrid_candidates = 50
+search_rrf_k = 60
+search_bm25_k1 = 1.2
+search_bm25_b = 0.75
+# Search results are reranked by maximal marginal relevance, so that
+# near-duplicate documents are not all included. For this, search_docs_max
+# documents are selected from search_rerank_candidates candidates. Diversity
+# is between 0 (relevance only) and 1 (diversity only). Adjacent chunks of the
+# same document are merged, and documents are dropped when the documentation
+# exceeds search_max_documentation_length characters (None for no limit).
+search_rerank = True
+search_rerank_candidates = 8
+search_mmr_diversity = 0.3
+search_max_documentation_length = 40000
+# When the search query is similar to the previous search query of the same
+# conversation (cosine similarity of the embeddings), the previously retrieved
+# documentation is reused, and the search is skipped. Set to None to always
+# search.
+search_reuse_similarity = 0.95
+# When indexing the library (index_library.py), documents are embedded in
+# batches, several batches at the same time. Batches that fail because of rate
+# limits or connection errors are retried with exponential backoff.
+index_batch_size = 100
+index_workers = 4
+index_max_retries = 6
 
 
 
@@ -1,15 +1,27 @@
 import json
 import logging
 import time
+import uuid
+import math
 from datetime import datetime, timedelta
+from cryptography.fernet import InvalidToken
+from redis.exceptions import RedisError
 from .. import config
-from .models import db, User, Conversation, Activity, BufferActivity, \
-    Subscription, Setting, Message
+from ..redis_client import redis_client
+from ..usage import UsageCounter
+from .models import db, User, Conversation, ConversationHeader, Activity, \
+    BufferActivity, Subscription, Setting, Message, SearchToken
 from .encryption import EncryptionManager
-from sqlalchemy import func, delete
+from . import search
+from sqlalchemy import func, delete, update, insert, or_
 from sqlalchemy.orm.exc import NoResultFound
 
 logger = logging.getLogger('sigmund')
+# Snapshots of user settings that are cached per process. Keys are user ids,
+# and values are (version, settings) tuples. The version is shared through
+# Redis, so that a setting change in one process invalidates the snapshots in
+# all other processes.
+_settings_cache = {}
 
 
 class DatabaseManager:
@@ -17,10 +29,13 @@ class DatabaseManager:
     def __init__(self, sigmund, username: str,
                  encryption_key: [str, bytes]=None):
         self.transient_settings = {}
+        self._settings = None
         self._sigmund = sigmund
         self.username = username
         self.encryption_manager = EncryptionManager(encryption_key)
+        self._index_key = search.index_key(encryption_key)
         self.ensure_user_exists()
+        self.usage = UsageCounter(self)
         logger.info(
             f'initializing database for user {self.username} ({self.user_id})')
         
@@ -49,6 +64,8 @@ class DatabaseManager:
             for message in all_messages:
                 if message.message_id not in attached_message_ids:
                     logger.info(f'deleting {message.message_id}')
+                    SearchToken.query.filter_by(
+                        message_id=message.message_id).delete()
                     db.session.delete(message)
         logger.info('committing')
         db.session.commit()
@@ -113,15 +130,80 @@ class DatabaseManager:
             logger.error(f"Error retrieving message {message_id}: {e}")
             return {}
             
-    def get_message_history(self, conversation_data):
-        """Returns a list of message dicts, excluding empty ones"""
+    def get_message_rows(self, conversation_data) -> list:
+        """Returns a list of (message_id, message) tuples, excluding empty
+        messages. The message_id is the id of the row in the message table, or
+        None for old-style messages that are stored in the conversation.
+        """
         message_ids = conversation_data.get('message_history', [])
-        message_history = []
+        message_rows = []
         for msg_id in message_ids:
             msg = self.get_message(msg_id)
             if msg:
-                message_history.append(msg)
-        return message_history
+                message_rows.append(
+                    (msg_id if isinstance(msg_id, int) else None, msg))
+        return message_rows
+
+    def get_message_history(self, conversation_data):
+        """Returns a list of message dicts, excluding empty ones"""
+        return [msg for _, msg in self.get_message_rows(conversation_data)]
+
+    def get_message_window(self, before: int = None,
+                           limit: int = None) -> dict | None:
+        """Returns a window of the visible messages of the active
+        conversation, without decrypting the messages outside of the window.
+        Tool messages and empty messages are not visible.
+
+        Parameters
+        ----------
+        before : int, optional
+            The row id of the message before which the window ends. If None,
+            the window ends at the last message.
+        limit : int, optional
+            The maximum number of visible messages. If None, all messages
+            before the end of the window are included.
+
+        Returns
+        -------
+        dict or None
+            A dict with a messages key, which is a chronological list of
+            (row_id, message) tuples, a before key, which is the row id of the
+            oldest message in the window (or None), and a has_more key, which
+            indicates whether there are older messages. None if there is no
+            active conversation, or if the conversation contains old-style
+            messages, which cannot be windowed.
+        """
+        try:
+            user = self._get_user()
+            conversation = Conversation.query.filter_by(
+                conversation_id=user.active_conversation_id).one()
+        except NoResultFound:
+            return None
+        conversation_data = self._decrypt_conversation_data(conversation)
+        message_ids = conversation_data.get('message_history', [])
+        if not all(isinstance(msg_id, int) for msg_id in message_ids):
+            return None
+        end = len(message_ids)
+        if before is not None:
+            try:
+                end = message_ids.index(before)
+            except ValueError:
+                logger.warning(f'message {before} not in active conversation')
+                end = 0
+        messages = []
+        position = end
+        while position > 0 and (limit is None or len(messages) < limit):
+            position -= 1
+            msg = self.get_message(message_ids[position])
+            if not msg:
+                continue
+            role, content = msg[:2]
+            if role == 'tool' or not content.strip():
+                continue
+            messages.insert(0, (message_ids[position], msg))
+        return dict(messages=messages,
+                    before=messages[0][0] if messages else before,
+                    has_more=position > 0)
 
     
     def add_message(self, conversation_id: int, message_data: dict) -> int:
@@ -143,8 +225,12 @@ class DatabaseManager:
             return {}    
         decrypted_data = self.encryption_manager.decrypt_data(conversation.data)
         conversation_data = json.loads(decrypted_data)
-        conversation_data['message_history'] = self.get_message_history(
-            conversation_data)
+        message_rows = self.get_message_rows(conversation_data)
+        conversation_data['message_history'] = [msg for _, msg in message_rows]
+        # The row ids allow the conversation to be saved incrementally
+        conversation_data['message_row_ids'] = [
+            row_id for row_id, _ in message_rows]
+        conversation_data['conversation_id'] = conversation.conversation_id
         return conversation_data
         
     def _get_user(self):
@@ -214,10 +300,43 @@ class DatabaseManager:
         conversation_data : dict
             The updated conversation data dictionary
         """
-        encrypted_data = self._encrypt_conversation_data(conversation_data)
-        conversation.data = encrypted_data
+        self._store_conversation_data(conversation, conversation_data)
         db.session.commit()
 
+    def _store_conversation_data(self, conversation, conversation_data: dict):
+        """Encrypts the conversation data and updates the conversation header
+        accordingly. This doesn't commit.
+        """
+        conversation.data = self._encrypt_conversation_data(conversation_data)
+        self._update_header(conversation, conversation_data)
+
+    def _update_header(self, conversation, conversation_data: dict,
+                       active: bool = None):
+        """Creates or updates the header of a conversation. This doesn't
+        commit.
+        """
+        header = db.session.get(ConversationHeader,
+                                conversation.conversation_id)
+        if header is None:
+            header = ConversationHeader(
+                conversation_id=conversation.conversation_id,
+                user_id=conversation.user_id, active=bool(active))
+            db.session.add(header)
+        elif active is not None:
+            header.active = active
+        title = conversation_data.get('title', 'Untitled conversation')
+        # The title is part of the search index, and is re-indexed when it
+        # changes. Headers that are not indexed yet are indexed in full later.
+        if header.search_indexed and self._decrypt_title(header) != title:
+            self._index_title(header, title)
+        header.title = self.encryption_manager.encrypt_data(
+            title.encode('utf-8'))
+        header.last_updated = conversation_data.get('last_updated',
+                                                    time.time())
+        header.message_count = len(conversation_data.get('message_history',
+                                                         []))
+        return header
+
     def set_active_conversation(self, conversation_id: int) -> bool:
         """Sets the active conversation for the current user.
 
@@ -248,6 +367,11 @@ class DatabaseManager:
         # Change the active conversation for the user
         user = self._get_user()
         user.active_conversation_id = conversation.conversation_id
+        db.session.execute(
+            update(ConversationHeader)
+            .where(ConversationHeader.user_id == self.user_id)
+            .values(active=ConversationHeader.conversation_id
+                    == conversation.conversation_id))
         db.session.commit()
         return True
 
@@ -300,6 +424,8 @@ class DatabaseManager:
         logger.info('deleting old messages')
         # Batch delete all messages linked to this conversation, because we
         # will recreate new messages
+        db.session.execute(delete(SearchToken).where(
+            SearchToken.conversation_id == conversation.conversation_id))
         db.session.execute(
             delete(Message).where(
                 Message.conversation_id == conversation.conversation_id)
@@ -314,47 +440,419 @@ class DatabaseManager:
             message_ids.append(message_id)
         conversation_data['message_history'] = message_ids
         conversation_data['last_updated'] = time.time()
-        json_data = json.dumps(conversation_data)
-        encrypted_data = self.encryption_manager.encrypt_data(
-            json_data.encode('utf-8'))
-        conversation.data = encrypted_data
+        self._store_conversation_data(conversation, conversation_data)
+        self._update_search_index(
+            conversation,
+            [(message_id, message, True) for message_id, message
+             in zip(message_ids, message_history)],
+            reindex=True)
         logger.info('committing conversation')
         db.session.commit()
         logger.info('done')
         return conversation.conversation_id
 
-    def list_conversations(self, query=None) -> dict:
-        conversations = {}
-        user = self._get_user()
-        for conversation in \
-                Conversation.query.filter_by(user_id=self.user_id).all():
+    def save_active_conversation(self, conversation_data: dict,
+                                 message_rows: list) -> tuple:
+        """Incrementally saves the active conversation in a single
+        transaction. Only new and changed messages are written, messages that
+        are no longer part of the conversation are deleted, and the
+        conversation itself is updated in place.
+
+        Parameters
+        ----------
+        conversation_data : dict
+            The conversation data without the message history.
+        message_rows : list
+            A list of (row_id, message, changed) tuples, in the order of the
+            message history. The row_id is None for new messages.
+
+        Returns
+        -------
+        tuple
+            A (conversation_id, row_ids) tuple, where row_ids is a list of
+            message row ids in the order of the message history. If there is
+            no active conversation, (None, []) is returned.
+        """
+        try:
+            user = self._get_user()
+            conversation = Conversation.query.filter_by(
+                conversation_id=user.active_conversation_id
+            ).one()
+        except NoResultFound:
+            logger.warning(
+                f"No active conversation to update for user {self.user_id}")
+            return None, []
+        conversation_id = conversation.conversation_id
+        # Row ids that don't belong to this conversation (for example because
+        # another conversation has been activated in the meantime) are never
+        # reused, but the messages are inserted as new rows instead.
+        existing_ids = {
+            message_id for (message_id,) in
+            db.session.query(Message.message_id).filter_by(
+                conversation_id=conversation_id)
+        }
+        row_ids = []
+        new_messages = []
+        n_updated = 0
+        for row_id, message, changed in message_rows:
+            if row_id in existing_ids:
+                if changed:
+                    db.session.execute(
+                        update(Message)
+                        .where(Message.message_id == row_id)
+                        .values(data=self._encrypt_message(message),
+                                rendered=None))
+                    n_updated += 1
+                row_ids.append(row_id)
+            else:
+                new_message = Message(conversation_id=conversation_id,
+                                      data=self._encrypt_message(message))
+                db.session.add(new_message)
+                new_messages.append(new_message)
+                row_ids.append(new_message)
+        removed_ids = existing_ids - set(row_ids)
+        if removed_ids:
+            db.session.execute(delete(SearchToken).where(
+                SearchToken.message_id.in_(removed_ids)))
+            db.session.execute(
+                delete(Message).where(Message.message_id.in_(removed_ids)))
+        # Flushing assigns ids to the new messages without committing
+        db.session.flush()
+        row_ids = [row_id.message_id if isinstance(row_id, Message)
+                   else row_id for row_id in row_ids]
+        logger.info(f'saving conversation {conversation_id}: '
+                    f'{len(new_messages)} new, {n_updated} updated, '
+                    f'{len(removed_ids)} removed message(s)')
+        conversation_data['message_history'] = row_ids
+        conversation_data['last_updated'] = time.time()
+        self._store_conversation_data(conversation, conversation_data)
+        self._update_search_index(
+            conversation,
+            [(row_id, message, changed or row_id not in existing_ids)
+             for row_id, (_, message, changed) in zip(row_ids, message_rows)])
+        db.session.commit()
+        return conversation_id, row_ids
+
+    def get_rendered_messages(self, row_ids: list) -> dict:
+        """Returns the rendered HTML of messages, as a dict with row ids as
+        keys and the data that was stored with set_rendered_messages() as
+        values. Messages that haven't been rendered are not included.
+        """
+        row_ids = [row_id for row_id in row_ids if row_id is not None]
+        if not row_ids:
+            return {}
+        rows = db.session.query(Message.message_id, Message.rendered).join(
+            Conversation,
+            Message.conversation_id == Conversation.conversation_id).filter(
+            Conversation.user_id == self._get_user().user_id,
+            Message.message_id.in_(row_ids),
+            Message.rendered.isnot(None))
+        rendered = {}
+        for row_id, data in rows:
             try:
-                data = json.loads(self.encryption_manager.decrypt_data(
-                    conversation.data))
-                # Don't list empty conversations except for the active one
-                if len(data.get('message_history', [])) < 2 and \
-                        user.active_conversation_id != conversation.conversation_id:
-                    continue
-                title = data.get('title', 'Untitled conversation')
-                if query is not None:
-                    # First check title match
-                    if query.lower() not in title.lower():
-                        # If the title doesn't match, then we do a full-text
-                        # search on the message history
-                        match = False
-                        for message in self.get_message_history(data):
-                            message_text = message[1]
-                            if query.lower() in message_text.lower():
-                                match = True
-                                break
-                        if not match:
-                            continue
-                conversations[conversation.conversation_id] = (
-                     title, data.get('last_updated', time.time()))
+                rendered[row_id] = json.loads(
+                    self.encryption_manager.decrypt_data(data))
+            except (InvalidToken, ValueError) as e:
+                logger.warning(f'failed to decrypt rendered message: {e}')
+        return rendered
+
+    def set_rendered_messages(self, rendered: dict):
+        """Stores the rendered HTML of messages. Rendered is a dict with row
+        ids as keys and JSON-serializable data as values.
+        """
+        if not rendered:
+            return
+        for row_id, data in rendered.items():
+            db.session.execute(
+                update(Message)
+                .where(Message.message_id == row_id)
+                .values(rendered=self.encryption_manager.encrypt_data(
+                    json.dumps(data).encode('utf-8'))))
+        db.session.commit()
+        logger.info(f'stored {len(rendered)} rendered message(s)')
+
+    def _encrypt_message(self, message_data) -> bytes:
+        json_data = json.dumps(message_data)
+        return self.encryption_manager.encrypt_data(json_data.encode('utf-8'))
+
+    def list_conversations(self, query: str = None, offset: int = 0,
+                           limit: int = None, sort: str = 'last_updated',
+                           descending: bool = True) -> list:
+        """Lists the conversations of the user. Without a query, this is based
+        on the conversation headers, so that only the titles need to be
+        decrypted. Empty conversations are not listed, except for the active
+        one.
+
+        Parameters
+        ----------
+        query : str, optional
+            If provided, only conversations that match the query are listed,
+            ranked by relevance, and the sorting parameters are ignored. See
+            _search_conversations().
+        offset : int, optional
+            The number of conversations to skip.
+        limit : int, optional
+            The maximum number of conversations to list.
+        sort : str, optional
+            'last_updated' or 'message_count'.
+        descending : bool, optional
+            Indicates whether conversations are sorted in descending order.
+
+        Returns
+        -------
+        list
+            A list of dicts with id, title, last_updated, and message_count
+            keys, in the requested order.
+        """
+        if query is not None:
+            return self._search_conversations(query, offset, limit)
+        if sort not in ('last_updated', 'message_count'):
+            raise ValueError(f'invalid sort key: {sort}')
+        column = getattr(ConversationHeader, sort)
+        headers = self._listed_headers().order_by(
+            column.desc() if descending else column.asc(),
+            ConversationHeader.conversation_id.desc())
+        if offset:
+            headers = headers.offset(offset)
+        if limit is not None:
+            headers = headers.limit(limit)
+        conversations = []
+        for header in headers:
+            title = self._decrypt_title(header)
+            if title is None:
+                continue
+            conversations.append(self._header_info(header, title))
+        return conversations
+
+    def _header_info(self, header, title: str) -> dict:
+        return dict(id=header.conversation_id, title=title,
+                    last_updated=header.last_updated,
+                    message_count=header.message_count)
+
+    def count_conversations(self) -> int:
+        """Returns the number of conversations that list_conversations() lists
+        when no query is provided.
+        """
+        return self._listed_headers().count()
+
+    def _listed_headers(self):
+        self._create_missing_headers()
+        return ConversationHeader.query.filter(
+            ConversationHeader.user_id == self.user_id,
+            or_(ConversationHeader.message_count >= 2,
+                ConversationHeader.active))
+
+    def _create_missing_headers(self):
+        """Creates headers for conversations that were created before headers
+        existed. This requires decrypting these conversations, but only once.
+        """
+        missing = Conversation.query.filter(
+            Conversation.user_id == self.user_id,
+            ~Conversation.conversation_id.in_(
+                db.session.query(ConversationHeader.conversation_id)
+                .filter(ConversationHeader.user_id == self.user_id))).all()
+        if not missing:
+            return
+        logger.info(f'creating {len(missing)} conversation header(s)')
+        active_conversation_id = self._get_user().active_conversation_id
+        for conversation in missing:
+            try:
+                conversation_data = self._decrypt_conversation_data(
+                    conversation)
             except Exception as e:
                 logger.error(f"Error decrypting conversation data: {e}")
+                continue
+            self._update_header(
+                conversation, conversation_data,
+                active=conversation.conversation_id == active_conversation_id)
+        db.session.commit()
+
+    def _search_conversations(self, query: str, offset: int = 0,
+                              limit: int = None) -> list:
+        """Searches conversations using the search index. A conversation
+        matches if its title contains all words of the query, or if its
+        messages contain all words of the query. Matches are ranked by how
+        often, and how distinctive, the query words occur, with title matches
+        ranked first. Titles are decrypted, and snippets are created, only for
+        the returned conversations.
+
+        Returns
+        -------
+        list
+            A list of dicts, in ranked order, with the same keys as
+            list_conversations() plus snippet and score keys. The snippet is
+            an HTML string with the query words in <mark> tags.
+        """
+        self._index_missing_conversations()
+        tokens = list(dict.fromkeys(search.tokenize(query)))
+        hashes = {search.token_hash(self._index_key, token): token
+                  for token in tokens}
+        if not hashes:
+            return []
+        # Term frequencies per conversation, the message in each conversation
+        # that matches the most query words, and the query words that occur in
+        # each title
+        term_counts = {}
+        message_matches = {}
+        title_matches = {}
+        for conversation_id, message_id, token_hash, count, title in \
+                db.session.query(SearchToken.conversation_id,
+                                 SearchToken.message_id,
+                                 SearchToken.token_hash,
+                                 SearchToken.count,
+                                 SearchToken.title).filter(
+                    SearchToken.user_id == self.user_id,
+                    SearchToken.token_hash.in_(hashes)):
+            if title:
+                title_matches.setdefault(conversation_id, set()).add(
+                    token_hash)
+                continue
+            counts = term_counts.setdefault(conversation_id, {})
+            counts[token_hash] = counts.get(token_hash, 0) + count
+            matches = message_matches.setdefault(conversation_id, {})
+            matches[message_id] = matches.get(message_id, 0) + 1
+        headers = {header.conversation_id: header
+                   for header in self._listed_headers()}
+        # Rare words are more informative than common ones
+        document_frequency = {}
+        for conversation_id in term_counts.keys() | title_matches.keys():
+            for token_hash in term_counts.get(conversation_id, {}).keys() | \
+                    title_matches.get(conversation_id, set()):
+                document_frequency[token_hash] = \
+                    document_frequency.get(token_hash, 0) + 1
+        idf = {token_hash: math.log(1 + len(headers) / frequency)
+               for token_hash, frequency in document_frequency.items()}
+        results = []
+        for conversation_id, header in headers.items():
+            counts = term_counts.get(conversation_id, {})
+            score = 0
+            if len(counts) == len(hashes):
+                score = sum((1 + math.log(count)) * idf[token_hash]
+                            for token_hash, count in counts.items())
+            if len(title_matches.get(conversation_id, ())) == len(hashes):
+                score += 10 + sum(idf[token_hash] for token_hash in hashes)
+            if score > 0:
+                results.append((score, conversation_id, header))
+        results.sort(key=lambda result: (-result[0], -result[2].last_updated))
+        results = results[offset:]
+        if limit is not None:
+            results = results[:limit]
+        conversations = []
+        for score, conversation_id, header in results:
+            title = self._decrypt_title(header)
+            if title is None:
+                continue
+            snippet = ''
+            matches = message_matches.get(conversation_id, {})
+            message_id = max(matches, key=matches.get) if matches else None
+            if message_id is not None:
+                snippet = search.snippet(
+                    search.message_text(self.get_message(message_id)),
+                    tokens)
+            conversations.append(dict(self._header_info(header, title),
+                                      snippet=snippet, score=round(score, 3)))
         return conversations
-    
+
+    def _decrypt_title(self, header):
+        try:
+            title = self.encryption_manager.decrypt_data(header.title)
+        except Exception as e:
+            logger.error(f"Error decrypting conversation title: {e}")
+            return None
+        if isinstance(title, bytes):
+            title = title.decode('utf-8')
+        return title
+
+    def _update_search_index(self, conversation, message_rows: list,
+                             reindex: bool = False):
+        """Updates the search index for the messages of a conversation. This
+        doesn't commit.
+
+        Parameters
+        ----------
+        conversation : Conversation
+            The conversation.
+        message_rows : list
+            A list of (message_id, message, changed) tuples. If the
+            conversation is already indexed, only changed messages are
+            re-indexed. Otherwise, all messages are indexed.
+        reindex : bool, optional
+            If True, the index for the conversation is rebuilt from scratch.
+        """
+        conversation_id = conversation.conversation_id
+        header = db.session.get(ConversationHeader, conversation_id)
+        if reindex or header is None or not header.search_indexed:
+            db.session.execute(delete(SearchToken).where(
+                SearchToken.conversation_id == conversation_id))
+            message_rows = [(message_id, message)
+                            for message_id, message, _ in message_rows]
+            if header is not None:
+                self._index_title(header, self._decrypt_title(header) or '')
+        else:
+            message_rows = [(message_id, message)
+                            for message_id, message, changed in message_rows
+                            if changed]
+            changed_ids = [message_id for message_id, _ in message_rows
+                           if message_id is not None]
+            if changed_ids:
+                db.session.execute(delete(SearchToken).where(
+                    SearchToken.message_id.in_(changed_ids)))
+        tokens = []
+        for message_id, message in message_rows:
+            counts = search.token_counts(self._index_key,
+                                         search.message_text(message))
+            tokens += [dict(user_id=self.user_id,
+                            conversation_id=conversation_id,
+                            message_id=message_id, token_hash=token_hash,
+                            count=count)
+                       for token_hash, count in counts.items()]
+        if tokens:
+            db.session.execute(insert(SearchToken), tokens)
+        if header is not None:
+            header.search_indexed = True
+
+    def _index_title(self, header, title: str):
+        """Replaces the title words of a conversation in the search index.
+        This doesn't commit.
+        """
+        db.session.execute(delete(SearchToken).where(
+            SearchToken.conversation_id == header.conversation_id,
+            SearchToken.title))
+        tokens = [dict(user_id=header.user_id,
+                       conversation_id=header.conversation_id,
+                       message_id=None, token_hash=token_hash, count=count,
+                       title=True)
+                  for token_hash, count
+                  in search.token_counts(self._index_key, title).items()]
+        if tokens:
+            db.session.execute(insert(SearchToken), tokens)
+
+    def _index_missing_conversations(self):
+        """Indexes conversations that were created before the search index
+        existed. This requires decrypting all their messages, but only once.
+        """
+        self._create_missing_headers()
+        headers = ConversationHeader.query.filter_by(
+            user_id=self.user_id, search_indexed=False).all()
+        if not headers:
+            return
+        logger.info(f'indexing {len(headers)} conversation(s) for search')
+        for header in headers:
+            conversation = db.session.get(Conversation,
+                                          header.conversation_id)
+            try:
+                conversation_data = self._decrypt_conversation_data(
+                    conversation)
+            except Exception as e:
+                logger.error(f"Error decrypting conversation data: {e}")
+                continue
+            message_rows = [
+                (message_id, message, True) for message_id, message
+                in self.get_message_rows(conversation_data)]
+            self._update_search_index(conversation, message_rows,
+                                      reindex=True)
+        db.session.commit()
+
     def export_conversations(self) -> dict:
         conversations = []
         for conversation in \
@@ -386,6 +884,9 @@ class DatabaseManager:
             conversation = Conversation(user_id=self.user_id,
                                         data=encrypted_data)
             db.session.add(conversation)
+            # Flushing assigns an id, which is needed for the header
+            db.session.flush()
+            self._update_header(conversation, conversation_data)
             db.session.commit()
             self.set_active_conversation(conversation.conversation_id)
             return True
@@ -404,8 +905,12 @@ class DatabaseManager:
                     f"user {self.user_id}")
                 return False
 
-            # Delete associated messages
+            # Delete the search index, associated messages, and the header
+            SearchToken.query.filter_by(
+                conversation_id=conversation_id).delete()
             Message.query.filter_by(conversation_id=conversation_id).delete()
+            ConversationHeader.query.filter_by(
+                conversation_id=conversation_id).delete()
 
             # Delete the conversation
             db.session.delete(conversation)
@@ -424,8 +929,7 @@ class DatabaseManager:
         activity. This ensures that usage beyond the limit draws from
         the purchased buffer rather than the free weekly budget.
         """
-        weekly_activity = self.get_activity(
-            time_delta={'days': config.weekly_token_range})
+        weekly_activity = self.usage.weekly()
         remaining_budget = max(0, config.weekly_token_limit - weekly_activity)
         if tokens_consumed <= remaining_budget:
             # The full consumption fits within the weekly budget.
@@ -434,6 +938,7 @@ class DatabaseManager:
                 tokens_consumed=tokens_consumed)
             db.session.add(new_activity)
             db.session.commit()
+            self.usage.add(tokens_consumed)
         else:
             # Part of the consumption fits within the weekly budget, and the
             # rest is deducted from the buffer.
@@ -446,6 +951,8 @@ class DatabaseManager:
             self.deduct_activity_buffer(
                 excess, description='Usage beyond weekly limit')
             db.session.commit()
+            if remaining_budget > 0:
+                self.usage.add(remaining_budget)
 
     def get_activity(self, time_delta) -> int:
         """Retrieves the total number of tokens consumed since a particular 
@@ -460,6 +967,15 @@ class DatabaseManager:
             .scalar()
         return total_tokens if total_tokens is not None else 0
 
+    def get_activity_log(self, since: datetime) -> list:
+        """Returns a list of (time, tokens_consumed) tuples for all activity
+        since a particular time. This is used to rebuild the usage counters.
+        """
+        return db.session.query(Activity.time, Activity.tokens_consumed) \
+            .filter(Activity.user_id == self.user_id) \
+            .filter(Activity.time >= since) \
+            .all()
+
     def get_activity_buffer(self) -> int:
         """Returns the current net activity buffer balance for the user.
 
@@ -484,6 +1000,7 @@ class DatabaseManager:
             tokens=tokens, description=description)
         db.session.add(entry)
         db.session.commit()
+        self.usage.invalidate_buffer()
 
     def deduct_activity_buffer(self, tokens: int, description: str = None):
         """Deducts tokens from the activity buffer (i.e. usage that exceeds
@@ -499,6 +1016,7 @@ class DatabaseManager:
             tokens=-tokens, description=description)
         db.session.add(entry)
         db.session.commit()
+        self.usage.invalidate_buffer()
         
     def get_suspended(self) -> bool:
         """Returns the suspended status of the user."""
@@ -576,18 +1094,82 @@ class DatabaseManager:
             return None
         return DatabaseManager(None, username=user_record.username)
 
+    def _settings_version(self) -> str | None:
+        """Returns the version stamp of the user's settings, which changes
+        whenever a setting is changed. If there is no version yet, a new one is
+        created, so that a missing key (e.g. after a Redis restart) never
+        matches a stale snapshot. Returns None if Redis is unavailable.
+        """
+        version_key = f'settings_version_{self.user_id}'
+        try:
+            version = redis_client.get(version_key)
+            if version is None:
+                redis_client.set(version_key, uuid.uuid4().hex, nx=True)
+                version = redis_client.get(version_key)
+        except RedisError as e:
+            logger.warning(f'failed to get settings version: {e}')
+            return None
+        return version.decode() if isinstance(version, bytes) else version
+
+    def _settings_snapshot(self) -> dict:
+        """Returns a dict with all stored settings of the current user. The
+        snapshot is loaded with a single query, and cached for the lifetime
+        of this object, per process, and in Redis.
+        """
+        if self._settings is not None:
+            return self._settings
+        version = self._settings_version()
+        snapshot_key = f'settings_snapshot_{self.user_id}'
+        if version is not None:
+            cached = _settings_cache.get(self.user_id)
+            if cached is not None and cached[0] == version:
+                self._settings = cached[1]
+                return self._settings
+            try:
+                cached = redis_client.get(snapshot_key)
+            except RedisError as e:
+                logger.warning(f'failed to get settings snapshot: {e}')
+                cached = None
+            if cached is not None:
+                cached = json.loads(cached)
+                if cached['version'] == version:
+                    self._settings = cached['settings']
+                    _settings_cache[self.user_id] = version, self._settings
+                    return self._settings
+        self._settings = {
+            setting.key: setting.value for setting in
+            db.session.query(Setting).filter_by(user_id=self.user_id).all()
+        }
+        if version is not None:
+            _settings_cache[self.user_id] = version, self._settings
+            try:
+                redis_client.set(snapshot_key, json.dumps(
+                    {'version': version, 'settings': self._settings}))
+            except RedisError as e:
+                logger.warning(f'failed to store settings snapshot: {e}')
+        return self._settings
+
+    def _invalidate_settings(self):
+        """Invalidates all cached settings snapshots of the current user."""
+        self._settings = None
+        _settings_cache.pop(self.user_id, None)
+        try:
+            redis_client.set(f'settings_version_{self.user_id}',
+                             uuid.uuid4().hex)
+            redis_client.delete(f'settings_snapshot_{self.user_id}')
+        except RedisError as e:
+            logger.warning(f'failed to invalidate settings: {e}')
+
     def get_setting(self, key: str) -> str:
         """Retrieve a setting value for the current user, which is available
         as self.user_id. If the setting does not exist, return the default
         value as specified in the config or None if no default has been 
-        specified.
+        specified. Transient settings take precedence over stored settings.
         """
         if key in self.transient_settings:
             return self.transient_settings[key]
-        setting = db.session.query(Setting).filter_by(
-            user_id=self.user_id, key=key).first()
-        return setting.value if setting \
-            else config.settings_default.get(key, None)
+        return self._settings_snapshot().get(
+            key, config.settings_default.get(key, None))
 
     def set_setting(self, key: str, value: str, transient: bool = False):
         """Set a setting to specified value for the current user. If the
@@ -606,13 +1188,10 @@ class DatabaseManager:
                                   value=value)
             db.session.add(new_setting)
         db.session.commit()
+        self._invalidate_settings()
 
     def list_settings(self) -> dict:
         """Returns a dict of all settings for the current user."""
-        settings = {}
-        setting_objs = db.session.query(Setting).filter_by(
-            user_id=self.user_id).all()
-        for setting in setting_objs:
-            settings[setting.key] = setting.value
+        settings = dict(self._settings_snapshot())
         settings.update(self.transient_settings)
         return settings
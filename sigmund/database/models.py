@@ -18,9 +18,11 @@ if os.environ.get('USE_FLASK_SQLALCHEMY', False):
     DateTime = db.DateTime
     Model = db.Model
     Boolean = db.Boolean
+    Float = db.Float
+    Index = db.Index
 else:
     from sqlalchemy import create_engine, Column, Integer, String, \
-        ForeignKey, LargeBinary, DateTime, Boolean
+        ForeignKey, LargeBinary, DateTime, Boolean, Float, Index
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.orm import scoped_session, sessionmaker
     import logging
@@ -78,6 +80,33 @@ class Conversation(Model):
     data = Column(LargeBinary)
 
 
+class ConversationHeader(Model):
+    __tablename__ = 'conversation_header'
+    # Conversations are listed per user, most recent first
+    __table_args__ = (
+        Index('ix_conversation_header_user_id_last_updated', 'user_id',
+              'last_updated'),
+    )
+
+    # A compact summary of a conversation, so that conversations can be listed
+    # without decrypting the full conversation data. The header is updated
+    # whenever the conversation data is saved.
+    conversation_id = Column(Integer,
+                             ForeignKey('conversation.conversation_id'),
+                             primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.user_id'), index=True)
+    # The title is encrypted in the same way as the conversation data
+    title = Column(LargeBinary)
+    last_updated = Column(Float)
+    message_count = Column(Integer)
+    active = Column(Boolean, default=False, server_default='0',
+                    nullable=False)
+    # Indicates whether all messages of the conversation are in the search
+    # index
+    search_indexed = Column(Boolean, default=False, server_default='0',
+                            nullable=False)
+
+
 class Message(Model):
     __tablename__ = 'message'
 
@@ -88,6 +117,36 @@ class Message(Model):
     # Data corresponds to an encrypted blob. After encryption, it becomes a
     # JSON string.
     data = Column(LargeBinary)
+    # The rendered HTML of the message, as an encrypted JSON string (see
+    # sigmund.render_cache). This is cleared when the message changes.
+    rendered = Column(LargeBinary, nullable=True)
+
+
+class SearchToken(Model):
+    __tablename__ = 'search_token'
+    # Queries look up token hashes per user
+    __table_args__ = (
+        Index('ix_search_token_user_id_token_hash', 'user_id', 'token_hash'),
+    )
+
+    # The search index of conversations. Each row indicates how often a word
+    # occurs in a message, or in the title of a conversation. Words are stored
+    # as keyed hashes, so that the index doesn't reveal the content of
+    # messages (see sigmund.database.search).
+    search_token_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.user_id'))
+    conversation_id = Column(Integer,
+                             ForeignKey('conversation.conversation_id'),
+                             index=True)
+    # Old-style messages that are stored in the conversation itself don't
+    # have a message_id
+    message_id = Column(Integer, ForeignKey('message.message_id'),
+                        index=True, nullable=True)
+    token_hash = Column(String(32))
+    count = Column(Integer)
+    # Indicates whether the word occurs in the title rather than in a message
+    title = Column(Boolean, default=False, server_default='0',
+                   nullable=False)
 
 
 class Activity(Model):
@@ -0,0 +1,97 @@
+"""Helper functions for the blind search index of conversations. Messages are
+encrypted at rest, so they cannot be searched by the database. Instead, each
+word of a message is stored as a keyed hash (a blind index), with a key that
+is derived from the user's encryption key. A query is answered by hashing the
+query words with the same key and looking up the hashes. The hashes do not
+reveal the words without the key, although they do reveal how often the same
+(unknown) word occurs.
+"""
+import hashlib
+import hmac
+import re
+from collections import Counter
+from markupsafe import escape
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+# Very short words are too common to be useful, and very long words are
+# usually not words but things like base64-encoded data
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+# Used to derive the index key from the encryption key, so that the index key
+# is different from the encryption key itself
+INDEX_KEY_CONTEXT = b'sigmund-search-index'
+
+
+def index_key(encryption_key) -> bytes:
+    """Derives the key for the blind index from the user's encryption key."""
+    if encryption_key is None:
+        encryption_key = b''
+    if isinstance(encryption_key, str):
+        encryption_key = encryption_key.encode()
+    return hmac.new(encryption_key, INDEX_KEY_CONTEXT,
+                    hashlib.sha256).digest()
+
+
+def tokenize(text: str) -> list:
+    """Splits text into lowercase words."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower())
+            if MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH]
+
+
+def token_hash(key: bytes, token: str) -> str:
+    """Returns the blind-index hash of a token as a 32-character hex string.
+    """
+    return hmac.new(key, token.encode('utf-8'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def token_counts(key: bytes, text: str) -> dict:
+    """Returns a dict with token hashes as keys and the number of occurrences
+    as values.
+    """
+    return {token_hash(key, token): count
+            for token, count in Counter(tokenize(text)).items()}
+
+
+def message_text(message) -> str:
+    """Returns the searchable text of a [role, content, metadata] message."""
+    if not isinstance(message, (list, tuple)) or len(message) < 2 or \
+            not isinstance(message[1], str):
+        return ''
+    return message[1]
+
+
+def snippet(text: str, tokens: list, width: int = 160) -> str:
+    """Returns an HTML snippet of the text around the first occurrence of one
+    of the tokens, with all occurrences highlighted by <mark> tags. The text
+    is escaped. If none of the tokens occur, an empty string is returned.
+    """
+    if not tokens:
+        return ''
+    pattern = re.compile(
+        r'\b(' + '|'.join(re.escape(token) for token in tokens) + r')\b',
+        re.IGNORECASE | re.UNICODE)
+    match = pattern.search(text)
+    if match is None:
+        return ''
+    start = max(0, match.start() - width // 3)
+    end = min(len(text), start + width)
+    # Don't cut words in half
+    if start > 0:
+        space = text.find(' ', start, match.start())
+        if space >= 0:
+            start = space + 1
+    if end < len(text):
+        space = text.rfind(' ', match.end(), end)
+        if space >= 0:
+            end = space
+    fragment = ' '.join(text[start:end].split())
+    highlighted = []
+    position = 0
+    for match in pattern.finditer(fragment):
+        highlighted.append(str(escape(fragment[position:match.start()])))
+        highlighted.append(f'<mark>{escape(match.group(0))}</mark>')
+        position = match.end()
+    highlighted.append(str(escape(fragment[position:])))
+    return ('…' if start > 0 else '') + ''.join(highlighted) + \
+        ('…' if end < len(text) else '')
@@ -1,25 +1,35 @@
+import base64
 import json
 import logging
-from .library import Library
-from . import config
+import numpy as np
+from .library import get_library
+from . import config, reranking
 logger = logging.getLogger('sigmund')
 
 
 class Documentation:
 
-    def __init__(self, sigmund, foundation_document_topics=None):
+    def __init__(self, sigmund, foundation_document_topics=None,
+                 collections=None):
+        """If collections is None, the collections are taken from the user
+        settings. Otherwise, sigmund may be None, so that the user database
+        is not accessed.
+        """
         self._sigmund = sigmund
         self._foundation_document_topics = foundation_document_topics
         self._documents = []
         self.poor_match = False
-        self._library = Library(
-            persist_directory=config.search_persist_directory,
-            embedding_provider=config.search_embedding_provider,
-            embedding_model=config.search_embedding_model)
-        self._collections = {
-            c for c in config.search_collections
-            if self._sigmund.database.get_setting(f'collection_{c}') == 'true'
-        }
+        # The library is shared across requests, so that the vector database
+        # is opened only once per process.
+        self._library = get_library()
+        if collections is not None:
+            self._collections = set(collections)
+        else:
+            self._collections = {
+                c for c in config.search_collections
+                if self._sigmund.database.get_setting(
+                    f'collection_{c}') == 'true'
+            }
         logger.info(f'using collections: {self._collections}')
 
     @property
@@ -88,12 +98,75 @@ You have retrieved the following documentation to answer the user's question:
         logger.info('clearing documentation')
         self._documents = []
 
+    def embed(self, query):
+        """Embeds a search query. Returns None if no collections are
+        searched, in which case the query isn't embedded.
+        """
+        if not self._collections or query is None:
+            return None
+        return self._library.embed(query)
+
+    def state(self, query_embedding):
+        """Returns the retrieved documents, and the query embedding that
+        was used to retrieve them, as a JSON-serializable dict. The state is
+        stored with the conversation, so that the documents can be reused by
+        restore(). The embedding is stored as base64-encoded float32.
+        """
+        if query_embedding is not None:
+            query_embedding = base64.b64encode(np.asarray(
+                query_embedding, dtype=np.float32).tobytes()).decode()
+        return {'query_embedding': query_embedding,
+                'collections': sorted(self._collections),
+                'foundation_document_topics':
+                    sorted(self._foundation_document_topics or []),
+                'documents': self._documents,
+                'poor_match': self.poor_match}
+
+    def restore(self, state, query_embedding):
+        """Reuses the documents from a previous state (see state()) if the
+        query embedding is similar enough to the previous query embedding,
+        and if the same collections were searched. Returns True if the
+        documents were reused, and False otherwise.
+        """
+        if config.search_reuse_similarity is None or not state or \
+                query_embedding is None or \
+                state.get('query_embedding') is None:
+            return False
+        if state['collections'] != sorted(self._collections) or \
+                state['foundation_document_topics'] != \
+                sorted(self._foundation_document_topics or []):
+            return False
+        previous = np.frombuffer(base64.b64decode(state['query_embedding']),
+                                 dtype=np.float32)
+        current = np.asarray(query_embedding, dtype=np.float32)
+        if previous.shape != current.shape:
+            return False
+        norm = np.linalg.norm(previous) * np.linalg.norm(current)
+        similarity = float(previous @ current / norm) if norm else 0
+        logger.info(f'similarity to previous query: {similarity:.3f}')
+        if similarity < config.search_reuse_similarity:
+            return False
+        self._documents = state['documents']
+        self.poor_match = state['poor_match']
+        return True
+
     def search(self, query, fallback=False, foundation=True, howtos=True,
-               max_distance=None, max_distance_fallback=None, k=None):
+               max_distance=None, max_distance_fallback=None, k=None,
+               query_embedding=None, rerank=None):
         """First, we separately search for regular and howto documents, because
         these tend not to be fairly comparable (howtos tend to always win).
         Finally, we insert foundation documents that match the topic of the
-        search hits.
+        search hits. The query is embedded only once for all searches.
+
+        If the library is hybrid (see Library.search()), a single search with
+        the fallback distance replaces the fallback search. The match is poor
+        if none of the vector results is within the regular distance.
+
+        If rerank is True (the default is config.search_rerank), more
+        candidates are retrieved, from which k are selected by maximal
+        marginal relevance. Adjacent chunks of the same document are then
+        merged, and documents that exceed the length budget are dropped (see
+        sigmund.reranking).
         """
         if not self._collections and not self._foundation_document_topics:
             logger.info('library search disabled')
@@ -104,23 +177,43 @@ You have retrieved the following documentation to answer the user's question:
             max_distance = config.search_max_distance
         if max_distance_fallback is None:
             max_distance_fallback = config.search_max_distance_fallback
+        hybrid = self._library.hybrid and query is not None and \
+            bool(self._collections)
+        strict_max_distance = max_distance
         if fallback:
             max_distance = max_distance_fallback
+        elif hybrid:
+            max_distance = max(max_distance, max_distance_fallback)
+        if rerank is None:
+            rerank = config.search_rerank
+        rerank = rerank and query is not None
+        n = max(k, config.search_rerank_candidates) if rerank else k
+        if self._collections and query is not None and \
+                query_embedding is None:
+            query_embedding = self._library.embed(query)
         if self._collections:
             regular_results = self._library.search(
-                query, foundation=False, howto=False, k=k,
-                max_distance=max_distance, collection=self._collections)
+                query, foundation=False, howto=False, k=n,
+                max_distance=max_distance, query_embedding=query_embedding,
+                include_embeddings=rerank, collection=self._collections)
+            if rerank:
+                regular_results = reranking.mmr(regular_results, k)
             logger.info(f'found {len(regular_results)} regular results')
         else:
             regular_results = []
         if howtos and self._collections:
             howto_results = self._library.search(
-                query, foundation=False, howto=True, k=k,
-                max_distance=max_distance, collection=self._collections)
+                query, foundation=False, howto=True, k=n,
+                max_distance=max_distance, query_embedding=query_embedding,
+                include_embeddings=rerank, collection=self._collections)
+            if rerank:
+                howto_results = reranking.mmr(howto_results, k)
             logger.info(f'found {len(howto_results)} howto results')
         else:
             howto_results = []
         results = regular_results + howto_results
+        if rerank:
+            results = reranking.stitch_chunks(results)
         if foundation:
             foundation_results = self._library.retrieve_foundation_documents(
                 results, self._foundation_document_topics)
@@ -128,12 +221,21 @@ You have retrieved the following documentation to answer the user's question:
         else:
             foundation_results = []            
         self._documents = foundation_results + results
+        if rerank:
+            self._documents = reranking.apply_budget(self._documents)
         if config.log_replies:
             for doc in self._documents:
                 logger.info(f'topic: {doc.get("topic", None)}, foundation: {doc.get("foundation", None)}, howto: {doc.get("howto", None)}, title: {doc.get("title", None)}')
-        if not fallback and not self._documents:
+        if hybrid:
+            self.poor_match = not any(
+                doc.get('distance') is not None and
+                doc['distance'] <= strict_max_distance for doc in results)
+            if self.poor_match:
+                logger.warning('no close vector results found')
+        elif not fallback and not self._documents:
             self.poor_match = True
             logger.warning('no results found, retrying with higher threshold')
             self.search(query, fallback=True, foundation=foundation, 
                         howtos=howtos, max_distance=max_distance,
-                        max_distance_fallback=max_distance_fallback, k=k)
\ No newline at end of file
+                        max_distance_fallback=max_distance_fallback, k=k,
+                        query_embedding=query_embedding, rerank=rerank)
\ No newline at end of file
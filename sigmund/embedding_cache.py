@@ -0,0 +1,111 @@
+"""A cache for query embeddings. Embedding a query requires a call to the
+embedding provider, and the same query is often embedded several times, for
+example when searching for regular documents and howtos, and again when
+retrying with a higher threshold. Embeddings are cached in memory per process,
+and optionally in Redis, so that they are shared across processes and restarts.
+Entries are keyed by the embedding model and a hash of the normalized text.
+"""
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from . import config
+from .redis_client import redis_client
+logger = logging.getLogger('sigmund')
+# Process-wide LRU cache with (model, text hash) tuples as keys and
+# embeddings as values
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_counts = {'hits': 0, 'persistent_hits': 0, 'misses': 0}
+
+
+def normalize(text: str) -> str:
+    """Normalizes whitespace, which doesn't affect the meaning of a query."""
+    return ' '.join(text.split())
+
+
+def cache_key(model: str, text: str) -> tuple:
+    return model, hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+
+
+def embed(text: str, model: str, embedding_function: callable) -> list:
+    """Returns the embedding for a text, from the cache if possible.
+
+    Parameters
+    ----------
+    text : str
+        The text to embed.
+    model : str
+        The name of the embedding model. This is part of the cache key.
+    embedding_function : callable
+        A function that takes a list of texts and returns a list of
+        embeddings, such as a ChromaDB embedding function.
+
+    Returns
+    -------
+    list
+        The embedding as a list of floats.
+    """
+    key = cache_key(model, text)
+    with _cache_lock:
+        embedding = _cache.get(key)
+        if embedding is not None:
+            _cache.move_to_end(key)
+            _counts['hits'] += 1
+            return embedding
+    embedding = _get_persistent(key)
+    if embedding is None:
+        _counts['misses'] += 1
+        embedding = [float(value) for value in
+                     embedding_function([normalize(text)])[0]]
+        _set_persistent(key, embedding)
+    else:
+        _counts['persistent_hits'] += 1
+    with _cache_lock:
+        _cache[key] = embedding
+        while len(_cache) > config.search_embedding_cache_size:
+            _cache.popitem(last=False)
+    return embedding
+
+
+def stats() -> dict:
+    """Returns cache statistics for this process."""
+    with _cache_lock:
+        return dict(size=len(_cache), **_counts)
+
+
+def clear():
+    """Clears the in-memory cache of this process."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def _redis_key(key: tuple) -> str:
+    return f'embedding_{key[0]}_{key[1]}'
+
+
+def _get_persistent(key: tuple) -> list | None:
+    if not config.search_embedding_cache_ttl:
+        return None
+    try:
+        data = redis_client.get(_redis_key(key))
+    except RedisError as e:
+        logger.warning(f'failed to read cached embedding: {e}')
+        return None
+    if data is None:
+        return None
+    # Embeddings are stored as single-precision floats, which is also the
+    # precision that ChromaDB uses
+    return array('f', data).tolist()
+
+
+def _set_persistent(key: tuple, embedding: list):
+    if not config.search_embedding_cache_ttl:
+        return
+    try:
+        redis_client.set(_redis_key(key), array('f', embedding).tobytes(),
+                         ex=config.search_embedding_cache_ttl)
+    except RedisError as e:
+        logger.warning(f'failed to cache embedding: {e}')
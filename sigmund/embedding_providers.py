@@ -0,0 +1,196 @@
+"""Embedding providers for the library. A provider is a factory that takes a
+model name and returns a ChromaDB-compatible embedding function, that is, a
+callable that takes a list of texts and returns a list of embeddings.
+
+- openai: embeds through the OpenAI API.
+- local: embeds on the CPU with a local model. Texts are split into batches,
+  which are embedded concurrently by a thread pool.
+- hashing: a deterministic, model-free stand-in that hashes words into a
+  fixed number of dimensions. Texts that share words have similar embeddings,
+  but the embeddings are not semantic. This is meant for tests and benchmarks,
+  which then don't depend on the network.
+
+Additional providers can be added with register_provider().
+"""
+import hashlib
+import logging
+import math
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils import embedding_functions
+from . import config
+logger = logging.getLogger('sigmund')
+# The local model that is run with ONNX Runtime, which is a dependency of
+# ChromaDB. Other local models require sentence-transformers.
+ONNX_MODEL = 'all-MiniLM-L6-v2'
+_providers = {}
+
+
+def register_provider(name: str) -> Callable:
+    """A decorator that registers an embedding-provider factory. The factory
+    takes a model name and returns an embedding function.
+    """
+    def decorator(factory: Callable) -> Callable:
+        _providers[name] = factory
+        return factory
+    return decorator
+
+
+def providers() -> List[str]:
+    return list(_providers)
+
+
+def get_embedding_function(provider: str, model: str) -> EmbeddingFunction:
+    try:
+        factory = _providers[provider]
+    except KeyError:
+        raise ValueError(f"Unknown embedding provider: {provider}")
+    return factory(model)
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embeds texts by hashing lowercase words, and pairs of adjacent words,
+    into a fixed number of dimensions. Each feature also has a hashed sign, so
+    that collisions cancel out on average. Word counts are scaled
+    sublinearly, and embeddings are L2-normalized.
+    """
+
+    def __init__(self, dimensions: int = None):
+        self._dimensions = dimensions or config.hashing_embedding_dimensions
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [self._embed(text) for text in input]
+
+    def _embed(self, text: str) -> np.ndarray:
+        words = re.findall(r'\w+', text.lower())
+        features = {}
+        for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+            features[feature] = features.get(feature, 0) + 1
+        embedding = np.zeros(self._dimensions, dtype=np.float32)
+        for feature, count in features.items():
+            digest = int.from_bytes(
+                hashlib.blake2b(feature.encode(), digest_size=8).digest(),
+                'little')
+            sign = 1 if digest >> 63 else -1
+            embedding[digest % self._dimensions] += \
+                sign * (1 + math.log(count))
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding /= norm
+        return embedding
+
+    @staticmethod
+    def name() -> str:
+        return 'sigmund_hashing'
+
+    def get_config(self) -> Dict[str, Any]:
+        return {'dimensions': self._dimensions}
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> 'HashingEmbeddingFunction':
+        return HashingEmbeddingFunction(config.get('dimensions'))
+
+
+class LocalEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embeds texts on the CPU with a local model. The model is loaded when
+    it is first used. Texts are split into batches, which are embedded
+    concurrently by a thread pool; ONNX Runtime and PyTorch release the GIL
+    while running the model, so that batches are really embedded in parallel.
+
+    Parameters
+    ----------
+    model : str
+        'all-MiniLM-L6-v2' runs with ONNX Runtime. The model is downloaded
+        once, and cached. Other models are sentence-transformers models,
+        which requires the optional sentence-transformers package.
+    batch_size : int, optional
+        The maximum number of texts per batch.
+    workers : int, optional
+        The number of batches that are embedded concurrently.
+    """
+
+    def __init__(self, model: str, batch_size: int = None,
+                 workers: int = None):
+        self._model = model
+        self._batch_size = batch_size or config.local_embedding_batch_size
+        self._workers = workers or config.local_embedding_workers
+        self._encoder = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        encoder = self._get_encoder()
+        batches = [input[i:i + self._batch_size]
+                   for i in range(0, len(input), self._batch_size)]
+        if len(batches) <= 1 or self._workers <= 1:
+            results = [encoder(batch) for batch in batches]
+        else:
+            results = list(self._executor.map(encoder, batches))
+        return [embedding for result in results for embedding in result]
+
+    def _get_encoder(self) -> Callable:
+        with self._lock:
+            if self._encoder is None:
+                logger.info(f'loading local embedding model {self._model}')
+                self._encoder = self._load_encoder()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._workers,
+                    thread_name_prefix='embedding')
+        return self._encoder
+
+    def _load_encoder(self) -> Callable:
+        """Returns a function that embeds a single batch of texts."""
+        if self._model == ONNX_MODEL:
+            function = embedding_functions.ONNXMiniLM_L6_V2()
+            # The model is downloaded, and the tokenizer and model are
+            # loaded, when the function is first called. This is not
+            # thread-safe, so a dummy text is embedded here, while the lock
+            # is held.
+            function(['warm-up'])
+            return function
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ValueError(
+                f'The local embedding model {self._model} requires the '
+                f'sentence-transformers package. Install it with `pip install '
+                f'sentence-transformers`, or use {ONNX_MODEL}')
+        model = SentenceTransformer(self._model, device='cpu')
+        return lambda batch: model.encode(
+            batch, batch_size=len(batch), normalize_embeddings=True,
+            convert_to_numpy=True)
+
+    @staticmethod
+    def name() -> str:
+        return 'sigmund_local'
+
+    def get_config(self) -> Dict[str, Any]:
+        return {'model': self._model, 'batch_size': self._batch_size,
+                'workers': self._workers}
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> 'LocalEmbeddingFunction':
+        return LocalEmbeddingFunction(config['model'],
+                                      config.get('batch_size'),
+                                      config.get('workers'))
+
+
+@register_provider('openai')
+def _openai_provider(model: str) -> EmbeddingFunction:
+    return embedding_functions.OpenAIEmbeddingFunction(
+        api_key=config.openai_api_key, model_name=model)
+
+
+@register_provider('local')
+def _local_provider(model: str) -> EmbeddingFunction:
+    return LocalEmbeddingFunction(model)
+
+
+@register_provider('hashing')
+def _hashing_provider(model: str) -> EmbeddingFunction:
+    # The model name is not used
+    return HashingEmbeddingFunction()
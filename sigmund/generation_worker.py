@@ -0,0 +1,265 @@
+"""Generation workers, which generate replies outside of the web process when
+config.generation_workers is enabled. Generating a reply can take minutes, and
+when this happens inside the request that streams the reply, a dropped
+connection or a proxy timeout ends the generation, and a web worker is tied up
+for the full duration.
+
+Instead, a job is put on a Redis queue when a message is sent. The job itself,
+which contains the encryption key and the message, is stored under a key of
+its own, which expires if no worker takes the job in time, and only the job id
+is queued. Worker processes (see generation_worker.py in the root folder) move
+job ids from the queue to a processing list, run Sigmund, and append every
+reply as an event to a Redis Stream per job. While a job runs, the worker
+keeps a short-lived running key alive. A job that has neither its stored job
+nor a running key anymore has been lost, for example because the job expired
+or because the worker died. The streaming route tails the stream of the job,
+and because every event has an id, a client that reconnects with a
+Last-Event-ID header resumes where it left off.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from redis.exceptions import RedisError
+from . import config, stream_cancel
+from .redis_client import redis_client
+from .reply import ActionReply
+from .sigmund import Sigmund
+logger = logging.getLogger('sigmund')
+JOBS_KEY = 'generation_jobs'
+PROCESSING_KEY = 'generation_jobs_processing'
+CLOSE_EVENT = '{"action": "close"}'
+
+
+def _events_key(job_id: str) -> str:
+    return f'generation_events_{job_id}'
+
+
+def _job_key(job_id: str) -> str:
+    return f'generation_job_{job_id}'
+
+
+def _running_key(job_id: str) -> str:
+    return f'generation_job_running_{job_id}'
+
+
+def _running_expiry() -> float:
+    # A few heartbeats can be missed before a job is considered lost
+    return 3 * config.generation_heartbeat_interval
+
+
+def _error_event() -> str:
+    return ActionReply('Generation failed', action='error').to_json()
+
+
+def submit(job: dict) -> str:
+    """Puts a job on the queue, and returns the job id.
+
+    Parameters
+    ----------
+    job : dict
+        A dict with the user id, the encryption key, the keyword arguments for
+        Sigmund, and the keyword arguments for Sigmund.send_user_message().
+
+    Returns
+    -------
+    str
+        The job id.
+    """
+    job_id = uuid.uuid4().hex
+    # The encryption key is bytes when it comes from the session
+    if isinstance(job['encryption_key'], bytes):
+        job = dict(job, encryption_key=job['encryption_key'].decode())
+    pipe = redis_client.pipeline()
+    pipe.set(_job_key(job_id), json.dumps(job),
+             ex=config.generation_job_expiry)
+    pipe.lpush(JOBS_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def _add_event(key: str, data: str):
+    redis_client.xadd(key, {'data': data})
+    # Events are kept for a while after the last event, so that clients can
+    # resume
+    redis_client.expire(key, config.generation_events_expiry)
+
+
+def run_job(job: dict):
+    """Runs a job and appends the replies as events to the job's stream. This
+    requires an app context.
+    """
+    key = _events_key(job['job_id'])
+    sigmund = None
+    logger.info(f'starting generation job {job["job_id"]} for '
+                f'{job["user_id"]}')
+    # Every job ends with a close event, also when Sigmund cannot be created,
+    # so that the client doesn't wait for events that never come
+    try:
+        sigmund = Sigmund(user_id=job['user_id'], persistent=True,
+                          encryption_key=job['encryption_key'],
+                          **job['sigmund_kwargs'])
+        stream_cancel.watch(sigmund.user_id, sigmund.cancelled)
+        attachments_json = redis_client.get(f'attachments_{sigmund.user_id}')
+        attachments = json.loads(attachments_json) if attachments_json else []
+        for reply in sigmund.send_user_message(attachments=attachments,
+                                               **job['message_kwargs']):
+            _add_event(key, reply.to_json())
+            if sigmund.cancelled.is_set():
+                logger.info(f'generation job {job["job_id"]} cancelled')
+                break
+    except Exception as e:
+        logger.error(f'generation job {job["job_id"]} failed: {e}')
+        _add_event(key, _error_event())
+    finally:
+        if sigmund is not None:
+            stream_cancel.unwatch(sigmund.user_id, sigmund.cancelled)
+        _add_event(key, CLOSE_EVENT)
+
+
+def _fail_job(job_id: str):
+    key = _events_key(job_id)
+    _add_event(key, _error_event())
+    _add_event(key, CLOSE_EVENT)
+
+
+def _keep_running(job_id: str, done: threading.Event):
+    """Refreshes the running key of a job until the job is done."""
+    while not done.wait(config.generation_heartbeat_interval):
+        try:
+            redis_client.expire(_running_key(job_id), _running_expiry())
+        except RedisError as e:
+            logger.warning(f'failed to refresh generation job {job_id}: {e}')
+
+
+def run_next_job(app, timeout: float = 0) -> bool:
+    """Waits for a job and runs it within the app's context.
+
+    Parameters
+    ----------
+    app : Flask
+        The app that provides the database.
+    timeout : float, optional
+        The maximum number of seconds to wait for a job. 0 means forever.
+
+    Returns
+    -------
+    bool
+        True if a job was taken, False if no job arrived before the timeout.
+    """
+    job_id = redis_client.blmove(JOBS_KEY, PROCESSING_KEY, timeout,
+                                 'RIGHT', 'LEFT')
+    if job_id is None:
+        return False
+    job_id = job_id.decode()
+    done = threading.Event()
+    try:
+        # The running key is set before the stored job is removed, so that a
+        # job always has one of both while it is alive
+        redis_client.set(_running_key(job_id), 1, ex=_running_expiry())
+        job_json = redis_client.getdel(_job_key(job_id))
+        if job_json is None:
+            logger.warning(f'generation job {job_id} expired')
+            _fail_job(job_id)
+            return True
+        threading.Thread(target=_keep_running, args=(job_id, done),
+                         daemon=True).start()
+        with app.app_context():
+            run_job(dict(json.loads(job_json), job_id=job_id))
+    finally:
+        done.set()
+        redis_client.lrem(PROCESSING_KEY, 0, job_id)
+        redis_client.delete(_running_key(job_id))
+    return True
+
+
+def recover_lost_jobs() -> int:
+    """Removes jobs from the processing list whose worker has died, and ends
+    their streams with an error.
+
+    Returns
+    -------
+    int
+        The number of lost jobs.
+    """
+    lost = 0
+    for job_id in redis_client.lrange(PROCESSING_KEY, 0, -1):
+        job_id = job_id.decode()
+        if redis_client.exists(_job_key(job_id), _running_key(job_id)):
+            continue
+        # Only one worker removes the job, and ends the stream
+        if redis_client.lrem(PROCESSING_KEY, 0, job_id):
+            logger.warning(f'generation job {job_id} was lost')
+            _fail_job(job_id)
+            lost += 1
+    return lost
+
+
+def work(app, threads: int = None):
+    """Runs jobs forever, in a number of threads. Generation mostly consists of
+    waiting for the model, so a single process can run several jobs at the
+    same time.
+    """
+    if threads is None:
+        threads = config.generation_worker_threads
+
+    def run():
+        while True:
+            try:
+                if not run_next_job(app,
+                                    timeout=config.generation_poll_interval):
+                    recover_lost_jobs()
+            except RedisError as e:
+                logger.warning(f'failed to get generation job: {e}')
+                time.sleep(config.generation_poll_interval)
+
+    logger.info(f'starting {threads} generation worker thread(s)')
+    workers = [threading.Thread(target=run, daemon=True,
+                                name=f'generation-worker-{i}')
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def tail(job_id: str, last_event_id: str = '0'):
+    """A generator that yields (event_id, data) tuples for the events of a
+    job that come after last_event_id, until the job is done. While waiting
+    for events, (None, None) is yielded regularly, so that keep-alive messages
+    can be sent. If the job has been lost, or if no events arrive for
+    config.generation_idle_timeout seconds, an error event and the close event
+    are yielded.
+    """
+    key = _events_key(job_id)
+    idle = 0
+    while True:
+        result = redis_client.xread(
+            {key: last_event_id},
+            block=int(config.generation_keepalive_interval * 1000))
+        if not result and not redis_client.exists(_job_key(job_id),
+                                                  _running_key(job_id)):
+            # The last events may have been added just before the job ended
+            result = redis_client.xread({key: last_event_id})
+            if not result:
+                logger.warning(f'generation job {job_id} was lost')
+                yield None, _error_event()
+                yield None, CLOSE_EVENT
+                return
+        if not result:
+            idle += config.generation_keepalive_interval
+            if idle >= config.generation_idle_timeout:
+                logger.warning(f'no events for generation job {job_id}')
+                yield None, _error_event()
+                yield None, CLOSE_EVENT
+                return
+            yield None, None
+            continue
+        idle = 0
+        for event_id, fields in result[0][1]:
+            last_event_id = event_id.decode()
+            data = fields[b'data'].decode()
+            yield last_event_id, data
+            if data == CLOSE_EVENT:
+                return
@@ -0,0 +1,301 @@
+"""An incremental indexing pipeline for the library. Documents are read from
+JSON source files, which contain a list of document dicts, as accepted by
+Library.add(). The pipeline:
+
+- Streams source files, so that large sources are never parsed as a whole.
+- Keeps a manifest of the document ids (content hashes) per source, so that
+  unchanged documents are not embedded again, and documents that have
+  disappeared from a source are deleted from the library.
+- Checks which documents already exist in bulk, rather than per document.
+- Embeds batches of documents concurrently, and backs off when the embedding
+  provider rate-limits requests.
+- Rebuilds the keyword index (see sigmund.keyword_index) when documents have
+  changed.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+import openai
+from . import config
+logger = logging.getLogger('sigmund')
+MANIFEST_FILE = 'index-manifest.json'
+# Errors after which an embedding request is retried
+RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError,
+                openai.APITimeoutError, openai.InternalServerError)
+
+
+def iter_json_array(path: Path, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yields the items of a JSON file that contains a list, without parsing
+    the entire file at once.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as fd:
+        buffer = ''
+        position = 0
+        started = False
+        eof = False
+        while True:
+            # Skip whitespace and separators between items
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if not started and position < len(buffer):
+                if buffer[position] != '[':
+                    raise ValueError(f'{path} does not contain a JSON list')
+                started = True
+                position += 1
+                continue
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                if position >= len(buffer):
+                    raise ValueError('empty buffer')
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The item is incomplete, so read more data
+                if eof:
+                    raise ValueError(f'{path} ends unexpectedly')
+                data = fd.read(chunk_size)
+                eof = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+            yield item
+            position = end
+
+
+def document_id(content: str) -> str:
+    """Returns the id of a document, which is a hash of the content. This is
+    the same id that Library.add() uses.
+    """
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def metadata_hash(metadata: Dict[str, Any]) -> str:
+    return hashlib.md5(
+        json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+
+
+def retry_delay(exception: Exception, attempt: int) -> float:
+    """Returns the number of seconds to wait before retrying. This uses the
+    Retry-After header if the provider sends one, and otherwise exponential
+    backoff with jitter.
+    """
+    response = getattr(exception, 'response', None)
+    if response is not None:
+        try:
+            return float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+class Manifest:
+    """Keeps track of the document ids (content hashes) and metadata hashes
+    of each source, in a JSON file in the persist directory of the library.
+    """
+
+    def __init__(self, persist_directory: str):
+        self._path = Path(persist_directory) / MANIFEST_FILE
+        if self._path.exists():
+            self._sources = json.loads(self._path.read_text())
+        else:
+            self._sources = {}
+
+    @property
+    def sources(self) -> List[str]:
+        return list(self._sources)
+
+    def get(self, source: str) -> Dict[str, str]:
+        """Returns a dict with document ids as keys and metadata hashes as
+        values.
+        """
+        return self._sources.get(source, {})
+
+    def set(self, source: str, documents: Dict[str, str]):
+        self._sources[source] = documents
+
+    def remove(self, source: str):
+        self._sources.pop(source, None)
+
+    def referenced_ids(self, exclude: str = None) -> set:
+        """Returns the ids of all documents that are referenced by sources
+        other than exclude. Identical documents may occur in multiple sources,
+        and should only be deleted when no source references them anymore.
+        """
+        return {doc_id for source, documents in self._sources.items()
+                if source != exclude for doc_id in documents}
+
+    def save(self):
+        """Writes the manifest atomically."""
+        tmp_path = self._path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self._sources))
+        os.replace(tmp_path, self._path)
+
+
+class Indexer:
+    """Synchronizes the library with source files.
+
+    Parameters
+    ----------
+    library : Library
+        A writable library.
+    workers : int, optional
+        The number of concurrent embedding requests.
+    batch_size : int, optional
+        The maximum number of documents per embedding request.
+    """
+
+    def __init__(self, library, workers: int = None, batch_size: int = None):
+        self._library = library
+        self._workers = workers or config.index_workers
+        self._batch_size = batch_size or config.index_batch_size
+        self._manifest = Manifest(library.persist_directory)
+        # ChromaDB writes are serialized, only embedding is concurrent
+        self._write_lock = threading.Lock()
+
+    def sync_source(self, path: Path) -> Dict[str, int]:
+        """Synchronizes the library with a single source file. Documents that
+        are new are embedded and added, documents with changed metadata are
+        updated without embedding them again, and documents that have been
+        removed from the source are deleted.
+
+        Returns
+        -------
+        dict
+            The number of added, updated, deleted, and unchanged documents.
+        """
+        source = Path(path).stem
+        previous = self._manifest.get(source)
+        current = {}
+        stats = dict(added=0, updated=0, deleted=0, unchanged=0)
+        pending = []
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = deque()
+            for doc_data in iter_json_array(Path(path)):
+                if 'content' not in doc_data:
+                    logger.warning(
+                        f"Skipping document without 'content' field: {doc_data}")
+                    continue
+                content = doc_data['content']
+                doc_id = document_id(content)
+                if doc_id in current:
+                    logger.warning(f"Duplicate document ID generated: {doc_id}")
+                    continue
+                metadata = self._library._clean_metadata(
+                    {k: v for k, v in doc_data.items() if k != 'content'})
+                current[doc_id] = metadata_hash(metadata)
+                if doc_id in previous:
+                    if previous[doc_id] == current[doc_id]:
+                        stats['unchanged'] += 1
+                    else:
+                        with self._write_lock:
+                            self._library.collection.update(
+                                ids=[doc_id], metadatas=[metadata])
+                        stats['updated'] += 1
+                    continue
+                pending.append((doc_id, content, metadata))
+                submitted += 1
+                if len(pending) >= self._batch_size:
+                    futures.append(executor.submit(self._add_batch, pending))
+                    pending = []
+                    # Limit the number of batches that are held in memory
+                    if len(futures) > 2 * self._workers:
+                        stats['added'] += futures.popleft().result()
+            if pending:
+                futures.append(executor.submit(self._add_batch, pending))
+            # Raises the first exception, if any
+            for future in futures:
+                stats['added'] += future.result()
+        # Documents that were not in the manifest, but already existed in the
+        # library, were not added again
+        stats['unchanged'] += submitted - stats['added']
+        removed = set(previous) - set(current)
+        # Documents that are also part of another source are kept
+        removed -= self._manifest.referenced_ids(exclude=source)
+        if removed:
+            with self._write_lock:
+                self._library.collection.delete(ids=list(removed))
+            stats['deleted'] = len(removed)
+        self._manifest.set(source, current)
+        self._manifest.save()
+        logger.info(f'synchronized {source}: {stats}')
+        return stats
+
+    def remove_source(self, source: str) -> int:
+        """Deletes all documents of a source that no longer exists. Returns
+        the number of deleted documents.
+        """
+        removed = set(self._manifest.get(source)) - \
+            self._manifest.referenced_ids(exclude=source)
+        if removed:
+            with self._write_lock:
+                self._library.collection.delete(ids=list(removed))
+        self._manifest.remove(source)
+        self._manifest.save()
+        logger.info(f'removed {source}: {len(removed)} documents deleted')
+        return len(removed)
+
+    def sync(self, paths: List[Path]) -> Dict[str, int]:
+        """Synchronizes the library with a list of source files. Sources that
+        were indexed before, but are not in the list, are removed. Finally,
+        the keyword index is rebuilt if anything changed, or if there is no
+        keyword index yet.
+        """
+        totals = dict(added=0, updated=0, deleted=0, unchanged=0)
+        sources = set()
+        for path in paths:
+            logger.info(f'synchronizing documents from {path}')
+            sources.add(Path(path).stem)
+            for key, value in self.sync_source(path).items():
+                totals[key] += value
+        for source in self._manifest.sources:
+            if source not in sources:
+                totals['deleted'] += self.remove_source(source)
+        if totals['added'] or totals['updated'] or totals['deleted'] or \
+                self._library.keyword_index is None:
+            self._library.build_keyword_index()
+        return totals
+
+    def _add_batch(self, batch: list) -> int:
+        """Embeds and adds a batch of (doc_id, content, metadata) tuples.
+        Documents that already exist, for example because the manifest was
+        lost, are not embedded again. Returns the number of added documents.
+        """
+        ids = [doc_id for doc_id, _, _ in batch]
+        with self._write_lock:
+            existing = self._library._existing_ids(ids)
+        batch = [doc for doc in batch if doc[0] not in existing]
+        if not batch:
+            return 0
+        contents = [content for _, content, _ in batch]
+        embeddings = self._embed(contents)
+        with self._write_lock:
+            self._library.collection.add(
+                ids=[doc_id for doc_id, _, _ in batch],
+                documents=contents,
+                metadatas=[metadata for _, _, metadata in batch],
+                embeddings=embeddings)
+        logger.info(f'added {len(batch)} documents')
+        return len(batch)
+
+    def _embed(self, contents: List[str]) -> list:
+        for attempt in range(config.index_max_retries + 1):
+            try:
+                return self._library.embedding_function(contents)
+            except RETRY_ERRORS as e:
+                if attempt == config.index_max_retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                logger.warning(
+                    f'embedding failed ({e.__class__.__name__}), retrying in '
+                    f'{delay:.1f}s')
+                time.sleep(delay)
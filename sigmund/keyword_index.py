@@ -0,0 +1,174 @@
+"""A BM25 keyword index over the documents of the library. Questions often
+hinge on exact identifiers, such as keyboard_response or dm.series, which
+dense embeddings tend to miss. The keyword index is built when the library is
+indexed, and stored as NumPy arrays in the persist directory, which are
+memory-mapped when the index is loaded:
+
+- postings.npy: the document numbers of all postings, grouped by term
+- frequencies.npy: the term frequencies of all postings
+- lengths.npy: the number of tokens of each document
+- terms.json: a term -> (start, end) dict that indexes the postings
+- ids.json: the ChromaDB ids of the documents, by document number
+
+Keyword and vector results are combined with reciprocal_rank_fusion().
+"""
+import json
+import logging
+import os
+import re
+import shutil
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, List, Tuple
+import numpy as np
+from . import config
+logger = logging.getLogger('sigmund')
+KEYWORD_INDEX_DIRECTORY = 'keyword-index'
+# Words, and identifiers that consist of words separated by periods
+TOKEN_PATTERN = re.compile(r'\w+(?:\.\w+)*')
+# The number of documents that are read from the library at once
+READ_BATCH_SIZE = 1000
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into lowercase tokens. Identifiers such as dm.series and
+    keyboard_response are kept as single tokens, and are also split into
+    their parts, so that they also match partial mentions.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if '.' in token or '_' in token:
+            tokens.extend(part for part in re.split(r'[._]+', token) if part)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = None) \
+        -> List[str]:
+    """Fuses several rankings of ids into a single ranking. Each id scores
+    1 / (k + rank) for each ranking in which it occurs.
+    """
+    if k is None:
+        k = config.search_rrf_k
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / (k + rank)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+
+def _iter_documents(collection) -> Iterator[Tuple[str, str]]:
+    """Yields (id, text) tuples for all documents in a collection. The text
+    includes the title, because titles often name the relevant identifiers.
+    """
+    offset = 0
+    while True:
+        results = collection.get(include=['documents', 'metadatas'],
+                                 limit=READ_BATCH_SIZE, offset=offset)
+        if not results['ids']:
+            return
+        for doc_id, doc, metadata in zip(results['ids'], results['documents'],
+                                         results['metadatas']):
+            title = (metadata or {}).get('title') or ''
+            yield doc_id, f'{title}\n{doc}'
+        offset += len(results['ids'])
+
+
+def build(collection, persist_directory: str):
+    """Builds a keyword index for all documents in a collection, and writes
+    it to the persist directory. The previous index, if any, is replaced.
+    """
+    ids = []
+    lengths = []
+    postings = {}
+    for doc_number, (doc_id, text) in enumerate(_iter_documents(collection)):
+        tokens = tokenize(text)
+        ids.append(doc_id)
+        lengths.append(len(tokens))
+        for term, count in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc_number, count))
+    terms = {}
+    doc_numbers = []
+    frequencies = []
+    for term, term_postings in postings.items():
+        terms[term] = len(doc_numbers), len(doc_numbers) + len(term_postings)
+        for doc_number, count in term_postings:
+            doc_numbers.append(doc_number)
+            frequencies.append(count)
+    # The index is written to a temporary directory, which then replaces the
+    # previous index
+    path = Path(persist_directory) / KEYWORD_INDEX_DIRECTORY
+    tmp_path = path.with_suffix('.tmp')
+    old_path = path.with_suffix('.old')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir()
+    np.save(tmp_path / 'postings.npy', np.array(doc_numbers, dtype=np.int32))
+    np.save(tmp_path / 'frequencies.npy',
+            np.array(frequencies, dtype=np.float32))
+    np.save(tmp_path / 'lengths.npy', np.array(lengths, dtype=np.float32))
+    (tmp_path / 'terms.json').write_text(json.dumps(terms))
+    (tmp_path / 'ids.json').write_text(json.dumps(ids))
+    shutil.rmtree(old_path, ignore_errors=True)
+    if path.exists():
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logger.info(f'built keyword index with {len(terms)} terms for '
+                f'{len(ids)} documents')
+
+
+class KeywordIndex:
+    """A read-only BM25 index. Use load() to open an index."""
+
+    def __init__(self, path: Path):
+        self._postings = np.load(path / 'postings.npy', mmap_mode='r')
+        self._frequencies = np.load(path / 'frequencies.npy', mmap_mode='r')
+        self._lengths = np.load(path / 'lengths.npy', mmap_mode='r')
+        self._terms = json.loads((path / 'terms.json').read_text())
+        self._ids = json.loads((path / 'ids.json').read_text())
+        self._average_length = float(self._lengths.mean()) \
+            if len(self._lengths) else 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def search(self, query: str, n: int) -> List[Tuple[str, float]]:
+        """Returns up to n (id, score) tuples for the documents that best
+        match the query, from best to worst.
+        """
+        k1 = config.search_bm25_k1
+        b = config.search_bm25_b
+        scores = np.zeros(len(self._ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self._terms:
+                continue
+            start, end = self._terms[term]
+            doc_numbers = self._postings[start:end]
+            frequencies = self._frequencies[start:end]
+            lengths = self._lengths[doc_numbers]
+            idf = np.log(1 + (len(self._ids) - (end - start) + .5) /
+                         (end - start + .5))
+            scores[doc_numbers] += idf * frequencies * (k1 + 1) / (
+                frequencies + k1 * (1 - b + b * lengths /
+                                    self._average_length))
+        matches = np.flatnonzero(scores)
+        if len(matches) > n:
+            matches = matches[np.argpartition(-scores[matches], n)[:n]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+        return [(self._ids[i], float(scores[i])) for i in matches]
+
+
+def load(persist_directory: str) -> KeywordIndex | None:
+    """Opens the keyword index in the persist directory, or returns None if
+    there is no keyword index.
+    """
+    path = Path(persist_directory) / KEYWORD_INDEX_DIRECTORY
+    if not path.exists():
+        return None
+    try:
+        keyword_index = KeywordIndex(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f'failed to load keyword index: {e}')
+        return None
+    logger.info(f'loaded keyword index for {len(keyword_index)} documents')
+    return keyword_index
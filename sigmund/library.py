@@ -1,12 +1,21 @@
 import json
+import os
+import time
+import threading
 from pathlib import Path
 import chromadb
-from chromadb.utils import embedding_functions
 import hashlib
 from typing import List, Dict, Any, Union
 import logging
-from . import config
+from . import config, embedding_cache, embedding_providers, keyword_index
 logger = logging.getLogger('sigmund')
+# A small file in the persist directory that is rewritten whenever a new index
+# is published. Shared libraries are re-opened when this file changes.
+INDEX_VERSION_FILE = 'index-version'
+# Shared libraries are kept per process, and are keyed by persist directory,
+# embedding provider and embedding model. Values are (version, library) tuples.
+_shared_libraries = {}
+_shared_libraries_lock = threading.Lock()
 
 
 class Library:
@@ -16,23 +25,33 @@ class Library:
     
     def __init__(self, persist_directory: str,
                  embedding_provider: str, embedding_model: str,
-                 collection_name: str = "documents"):
+                 collection_name: str = "documents",
+                 read_only: bool = False):
         """
         Initialize the Library with ChromaDB backend.
         
         Args:
             persist_directory: Directory for persistent storage
             collection_name: Name of the ChromaDB collection
-            embedding_provider: Which embedding provider to use ("mistral", "openai", "sentence-transformers")
+            embedding_provider: Which embedding provider to use ("openai", "local", "hashing")
             embedding_model: Specific model name for the provider
-            api_key: API key for the embedding provider (if needed)
+            read_only: If True, documents cannot be added or deleted. This is
+                used for libraries that are shared across requests.
         """
         self._json_metadata_fields = set()
+        self.read_only = read_only
         self.persist_directory = persist_directory
         self.embedding_provider = embedding_provider
         self.embedding_model = embedding_model
         self.collection_name = collection_name
         self.client = None
+        # Foundation documents are kept in memory as a topic -> document dict
+        # (see retrieve_foundation_documents()). This is None when the
+        # documents need to be (re)loaded.
+        self._foundation_documents = None
+        # The BM25 keyword index (see sigmund.keyword_index), or None if the
+        # library has no (up-to-date) keyword index
+        self.keyword_index = None
         
         # Initialize the client and collection
         self._initialize_client()
@@ -43,13 +62,8 @@ class Library:
         
         # When re-initializing the client, the system cache needs to be cleared,
         # otherwise database updates from an external process cause errors. 
-        # However, because we are using an internal API here, this may break.
         if self.client is not None:
-            try:
-                self.client._admin_client.clear_system_cache()
-                logger.info("Cleared library cache")
-            except Exception as e:
-                logger.warning(f"Failed to clear library cache: {e}")
+            self._clear_system_cache()
         
         # Initialize ChromaDB with persistent storage
         self.client = chromadb.PersistentClient(path=self.persist_directory)
@@ -65,16 +79,51 @@ class Library:
             embedding_function=self.embedding_function
         )
         logger.info(f'library contains {self.collection.count()} documents')
+        self._load_foundation_documents()
+        self.keyword_index = keyword_index.load(self.persist_directory)
+
+    def _clear_system_cache(self):
+        """Clears the ChromaDB system cache, which is shared by all clients
+        for the same persist directory. Because we are using an internal API
+        here, this may break.
+        """
+        try:
+            self.client._admin_client.clear_system_cache()
+            logger.info("Cleared library cache")
+        except Exception as e:
+            logger.warning(f"Failed to clear library cache: {e}")
+
+    @property
+    def hybrid(self) -> bool:
+        """Indicates whether searches combine vector and keyword search."""
+        return config.search_hybrid and self.keyword_index is not None
+
+    def build_keyword_index(self):
+        """(Re)build the keyword index from the documents in the library.
+        This is done when the library is indexed.
+        """
+        self._check_writable()
+        keyword_index.build(self.collection, self.persist_directory)
+        self.keyword_index = keyword_index.load(self.persist_directory)
+
+    def _load_foundation_documents(self):
+        """Load all foundation documents into memory. There are only few
+        foundation documents, and they are requested on every search.
+        """
+        results = self.collection.get(where={'foundation': {'$eq': True}})
+        foundation_documents = {}
+        for doc, metadata in zip(results['documents'] or [],
+                                 results['metadatas'] or []):
+            result = self._format_result(doc, metadata)
+            # There should be only one foundation document per topic. If
+            # there are more, the first one is used.
+            foundation_documents.setdefault(result.get('topic'), result)
+        self._foundation_documents = foundation_documents
+        logger.info(f'loaded {len(foundation_documents)} foundation documents')
         
     def _get_embedding_function(self, provider: str, model: str):
         """Get the appropriate embedding function based on provider."""
-        if provider == "openai":
-            return embedding_functions.OpenAIEmbeddingFunction(
-                api_key=config.openai_api_key,
-                model_name=model
-            )
-        else:
-            raise ValueError(f"Unknown embedding provider: {provider}")
+        return embedding_providers.get_embedding_function(provider, model)
     
     def _clean_metadata(self, metadata: Dict[str, Any]) -> Dict[str, Union[str, int, float, bool]]:
         """
@@ -98,10 +147,22 @@ class Library:
                 cleaned[key] = str(value)
         return cleaned
     
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError('Cannot modify a read-only library')
+
     def _document_exists(self, doc_id: str) -> bool:
         """Check if a document with the given ID already exists."""
-        result = self.collection.get(ids=[doc_id])
-        return len(result['ids']) > 0
+        return bool(self._existing_ids([doc_id]))
+
+    def _existing_ids(self, doc_ids: List[str]) -> set:
+        """Return the subset of IDs that already exist, using a single query
+        per 1000 IDs, and without retrieving the documents themselves."""
+        existing = set()
+        for i in range(0, len(doc_ids), 1000):
+            result = self.collection.get(ids=doc_ids[i:i + 1000], include=[])
+            existing.update(result['ids'])
+        return existing
     
     def add(self, documents: [str, Path, dict, list[dict]],
             **metadata_kwargs) -> int:
@@ -122,6 +183,10 @@ class Library:
         Returns:
             Number of documents added (excluding duplicates)
         """
+        self._check_writable()
+        self._foundation_documents = None
+        # The keyword index no longer matches the library
+        self.keyword_index = None
         if isinstance(documents, dict):
             logger.info('turning document into list')
             return self.add([documents], **metadata_kwargs)
@@ -136,6 +201,10 @@ class Library:
         metadatas = []
         ids = []
         skipped_duplicates = 0
+        # Check which documents already exist in bulk
+        existing_ids = self._existing_ids(list({
+            hashlib.md5(doc_data['content'].encode()).hexdigest()
+            for doc_data in documents if 'content' in doc_data}))
         
         for doc_data in documents:
             # Extract content (required field)
@@ -150,7 +219,7 @@ class Library:
             doc_id = hashlib.md5(content.encode()).hexdigest()
             
             # Check if document already exists
-            if self._document_exists(doc_id):
+            if doc_id in existing_ids:
                 skipped_duplicates += 1
                 continue
             
@@ -196,15 +265,40 @@ class Library:
         
         return total_added if contents else 0
     
+    def embed(self, text: str) -> List[float]:
+        """
+        Embed a text with the embedding function of the library. Embeddings
+        are cached (see sigmund.embedding_cache).
+
+        Args:
+            text: The text to embed
+
+        Returns:
+            The embedding as a list of floats
+        """
+        return embedding_cache.embed(
+            text, f'{self.embedding_provider}/{self.embedding_model}',
+            self.embedding_function)
+
     def search(self, query: str = None, k: int = 5, max_distance: float = None,
+               query_embedding: List[float] = None,
+               include_embeddings: bool = False,
                **metadata_filters) -> List[Dict[str, Any]]:
         """
         Search for documents similar to the query and/or matching metadata filters.
 
+        If the library is hybrid, vector results (within max_distance) and
+        keyword results are fused by reciprocal-rank fusion. Results that are
+        only found by keyword search have a distance of None.
+
         Args:
             query: Search query text (optional - if None, searches by metadata only)
             k: Number of documents to return
             max_distance: Maximum distance threshold for semantic search (optional)
+            query_embedding: A precomputed embedding of the query (optional -
+                if None, the query is embedded with embed())
+            include_embeddings: If True, the stored embedding of each document
+                is included as an 'embedding' field
             **metadata_filters: Optional metadata filters (e.g., user_id="123")
 
         Returns:
@@ -228,14 +322,24 @@ class Library:
             else:
                 where_clause = filters[0]
 
+        include = ['documents', 'metadatas']
+        if include_embeddings:
+            include.append('embeddings')
         try:
             # Perform search
+            if query is not None and self.hybrid:
+                return self._hybrid_search(query, k, max_distance,
+                                           query_embedding, where_clause,
+                                           include)
             if query is not None:
                 # Semantic search with optional metadata filtering
+                if query_embedding is None:
+                    query_embedding = self.embed(query)
                 results = self.collection.query(
-                    query_texts=[query],
+                    query_embeddings=[query_embedding],
                     n_results=k,
-                    where=where_clause
+                    where=where_clause,
+                    include=include + ['distances']
                 )
             else:
                 # Metadata-only search
@@ -244,12 +348,14 @@ class Library:
 
                 results = self.collection.get(
                     where=where_clause,
-                    limit=k
+                    limit=k,
+                    include=include
                 )
                 # Convert get() format to query() format for consistency
                 results = {
                     'documents': [results['documents']] if results['documents'] else [[]],
                     'metadatas': [results['metadatas']] if results['metadatas'] else [[]],
+                    'embeddings': [results['embeddings']] if include_embeddings and results['documents'] else [[]],
                     'distances': [[None] * len(results['documents'])] if results['documents'] else [[]]
                 }
                 
@@ -263,7 +369,10 @@ class Library:
                 self._initialize_client()
                 
                 # Retry the search (recursive call)
-                return self.search(query=query, k=k, max_distance=max_distance, **metadata_filters)
+                return self.search(query=query, k=k, max_distance=max_distance,
+                                   query_embedding=query_embedding,
+                                   include_embeddings=include_embeddings,
+                                   **metadata_filters)
             else:
                 # Re-raise if it's a different error
                 raise
@@ -282,44 +391,110 @@ class Library:
                 if query is not None and max_distance is not None:
                     if results['distances'][0][i] > max_distance:
                         break  # Stop here - all subsequent results will be worse
-        
-                result = {
-                    'content': doc,
-                    **results['metadatas'][0][i]  # Add all metadata fields
-                }
+                result = self._format_result(doc, results['metadatas'][0][i])
                 # Only add distance if we performed semantic search
                 if query is not None:
                     result['distance'] = results['distances'][0][i]                
-        
-                # Convert all JSON-encoded metadata fields back to Python objects
-                for key, value in result.items():
-                    if key in ('content', 'title'):
-                        continue
-                    if key in self._json_metadata_fields or \
-                            (isinstance(value, str) and value[0] in ['{', '[']):
-                        try:
-                            result[key] = json.loads(value)
-                        except Exception:
-                            logger.warning(f'failed to decode JSON for {key}')
-                            pass        
+                if include_embeddings:
+                    result['embedding'] = results['embeddings'][0][i]
                 formatted_results.append(result)
 
         return formatted_results
+
+    def _hybrid_search(self, query: str, k: int, max_distance: float | None,
+                       query_embedding: List[float] | None,
+                       where_clause: dict | None,
+                       include: List[str]) -> List[Dict[str, Any]]:
+        """Fuse vector and keyword results. Both retrievers contribute up to
+        search_hybrid_candidates results that match the metadata filters.
+        """
+        n = max(k, config.search_hybrid_candidates)
+        if query_embedding is None:
+            query_embedding = self.embed(query)
+        results = {}
+        vector_ranking = []
+        vector_results = self.collection.query(
+            query_embeddings=[query_embedding], n_results=n,
+            where=where_clause, include=include + ['distances'])
+        for i, (doc_id, doc, metadata, distance) in enumerate(zip(
+                vector_results['ids'][0], vector_results['documents'][0],
+                vector_results['metadatas'][0],
+                vector_results['distances'][0])):
+            if max_distance is not None and distance > max_distance:
+                break
+            result = self._format_result(doc, metadata)
+            result['distance'] = distance
+            if 'embeddings' in include:
+                result['embedding'] = vector_results['embeddings'][0][i]
+            results[doc_id] = result
+            vector_ranking.append(doc_id)
+        keyword_ids = [doc_id for doc_id, _ in
+                       self.keyword_index.search(query, n)]
+        keyword_ranking = []
+        if keyword_ids:
+            # Only keep keyword results that match the metadata filters
+            keyword_results = self.collection.get(
+                ids=keyword_ids, where=where_clause, include=include)
+            matches = {doc_id: i for i, doc_id
+                       in enumerate(keyword_results['ids'])}
+            keyword_ranking = [doc_id for doc_id in keyword_ids
+                               if doc_id in matches]
+            for doc_id in keyword_ranking:
+                if doc_id in results:
+                    continue
+                i = matches[doc_id]
+                result = self._format_result(
+                    keyword_results['documents'][i],
+                    keyword_results['metadatas'][i])
+                result['distance'] = None
+                if 'embeddings' in include:
+                    result['embedding'] = keyword_results['embeddings'][i]
+                results[doc_id] = result
+        logger.info(f'hybrid search: {len(vector_ranking)} vector results, '
+                    f'{len(keyword_ranking)} keyword results')
+        ranking = keyword_index.reciprocal_rank_fusion(
+            [vector_ranking, keyword_ranking])
+        return [results[doc_id] for doc_id in ranking[:k]]
+
+    def _format_result(self, doc: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Combine a document and its metadata into a single dict."""
+        result = {
+            'content': doc,
+            **metadata  # Add all metadata fields
+        }
+        # Convert all JSON-encoded metadata fields back to Python objects
+        for key, value in result.items():
+            if key in ('content', 'title'):
+                continue
+            if key in self._json_metadata_fields or \
+                    (isinstance(value, str) and value[0] in ['{', '[']):
+                try:
+                    result[key] = json.loads(value)
+                except Exception:
+                    logger.warning(f'failed to decode JSON for {key}')
+                    pass        
+        return result
         
     def retrieve_foundation_documents(self,
                                       results: dict | None = None,
                                       topics: list | None = None) -> list:
+        """Return the foundation documents for the topics, and for the topics
+        of the results. Foundation documents are served from memory.
+        """
+        if self._foundation_documents is None:
+            self._load_foundation_documents()
         topics = set() if topics is None else set(topics)
-        for result in results:
+        for result in results or []:
             topics |= set(result.get('topics', set()))        
         foundation_results = []
         for topic in topics:
-            results = self.search(None, k=1, topic=topic, foundation=True)
-            if results:
+            doc = self._foundation_documents.get(topic)
+            if doc is not None:
                 logger.info(f'found foundation document for {topic}')
+                # Return a copy, because the documents are shared
+                foundation_results.append(dict(doc))
             else:
                 logger.info(f'no foundation document for {topic}')
-            foundation_results += results
         return foundation_results
     
     def count(self) -> int:
@@ -328,10 +503,76 @@ class Library:
     
     def delete_all(self):
         """Delete all documents from the collection."""
+        self._check_writable()
+        self._foundation_documents = None
+        # The keyword index no longer matches the library
+        self.keyword_index = None
         # ChromaDB doesn't have a direct delete_all, so we delete and recreate
         collection_name = self.collection.name
         self.client.delete_collection(collection_name)
         self.collection = self.client.create_collection(
             name=collection_name,
             embedding_function=self.embedding_function
-        )
\ No newline at end of file
+        )
+
+
+def index_version(persist_directory: str) -> int | None:
+    """Returns the version of the published index in the persist directory,
+    or None if no index has been published. This is cheap enough to call for
+    every request, because it only stats a single file.
+    """
+    try:
+        return os.stat(Path(persist_directory) / INDEX_VERSION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def publish_index(persist_directory: str):
+    """Marks the index in the persist directory as updated, so that shared
+    libraries in running processes are re-opened. The version file is replaced
+    atomically, so readers never see a partially written file.
+    """
+    path = Path(persist_directory) / INDEX_VERSION_FILE
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(str(time.time()))
+    os.replace(tmp_path, path)
+    logger.info(f'published index in {persist_directory}')
+
+
+def get_library(persist_directory: str = None,
+                embedding_provider: str = None,
+                embedding_model: str = None) -> Library:
+    """Returns a read-only Library that is shared by all requests in the
+    current process. The library is opened only once, unless a new index has
+    been published (see publish_index()), in which case a new library is
+    opened and swapped in. Requests that still hold the previous library can
+    continue to use it.
+    """
+    if persist_directory is None:
+        persist_directory = config.search_persist_directory
+    if embedding_provider is None:
+        embedding_provider = config.search_embedding_provider
+    if embedding_model is None:
+        embedding_model = config.search_embedding_model
+    key = persist_directory, embedding_provider, embedding_model
+    version = index_version(persist_directory)
+    entry = _shared_libraries.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _shared_libraries_lock:
+        # Another thread may have opened the library while we were waiting
+        entry = _shared_libraries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        logger.info(f'opening shared library (version: {version})')
+        # ChromaDB caches the system per persist directory, so when a new
+        # index has been published the cache is cleared first, so that the
+        # new library picks up the changes.
+        if entry is not None:
+            entry[1]._clear_system_cache()
+        library = Library(persist_directory=persist_directory,
+                          embedding_provider=embedding_provider,
+                          embedding_model=embedding_model,
+                          read_only=True)
+        _shared_libraries[key] = version, library
+        return library
@@ -15,12 +15,15 @@ class LimitsChecker:
     def __init__(self, sigmund):
         self._sigmund = sigmund
         self._db = sigmund.database
+        # Usage is read from sliding-window counters rather than by summing
+        # the activity table (see sigmund.usage)
+        self._usage = sigmund.database.usage
 
     # -- Individual limit checks -------------------------------------------
 
     def hourly_exceeded(self) -> bool:
         """Returns True if the hourly token limit has been exceeded."""
-        hourly_activity = self._db.get_activity(time_delta={'hours': 1})
+        hourly_activity = self._usage.hourly()
         logger.info(f'hourly_activity: {hourly_activity}')
         return hourly_activity > config.hourly_token_limit
 
@@ -32,13 +35,11 @@ class LimitsChecker:
         is allowed to continue (drawing from the buffer), so this returns
         False.
         """
-        weekly_activity = self._db.get_activity(
-            time_delta={'days': config.weekly_token_range}
-        )
+        weekly_activity = self._usage.weekly()
         logger.info(f'weekly_activity: {weekly_activity}')
         if weekly_activity < config.weekly_token_limit:
             return False
-        return self._db.get_activity_buffer() <= 0
+        return self._usage.buffer() <= 0
 
     def suspended(self) -> bool:
         """Returns True if the user's account is suspended."""
@@ -72,9 +73,7 @@ class LimitsChecker:
         return True
         
     def weekly_credits_used(self) -> int:
-        return self._db.get_activity(
-            time_delta={'days': config.weekly_token_range}
-        )
+        return self._usage.weekly()
 
     def usage(self) -> float:
         """Returns the weekly usage as a fraction of the weekly token limit."""
@@ -84,4 +83,4 @@ class LimitsChecker:
         return max(0, config.weekly_token_limit - self.weekly_credits_used())
         
     def extra_credits_left(self) -> int:
-        return max(0, self._db.get_activity_buffer())
+        return max(0, self._usage.buffer())
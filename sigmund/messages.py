@@ -1,9 +1,8 @@
 import logging
 import uuid
 from cryptography.fernet import InvalidToken
-import multiprocessing as mp
 import json
-from . import prompt, config, utils
+from . import prompt, config, utils, title_worker
 logger = logging.getLogger('sigmund')
 
 
@@ -13,6 +12,12 @@ class Messages:
         self._sigmund = sigmund
         self._persistent = persistent
         self._conversation_id = None
+        # Maps message ids (from the metadata) to the row ids in the database,
+        # so that only new and changed messages need to be saved. Message ids
+        # are not necessarily unique, and are therefore mapped to lists of row
+        # ids, in the order in which the messages occur.
+        self._row_ids = {}
+        self._changed = set()
         self.workspace_content = None
         self.workspace_language = None
         if self._persistent:
@@ -30,6 +35,11 @@ class Messages:
     def init_conversation(self):
         self._condensed_text = None
         self._notes = {}
+        # The documentation that was retrieved for the last search, so that it
+        # can be reused (see Documentation.state())
+        self.retrieval = None
+        self._row_ids = {}
+        self._changed = set()
         metadata = self.metadata()
         metadata['answer_model'] = 'welcome-bot'
         self._conversation_title = config.default_conversation_title
@@ -73,6 +83,7 @@ class Messages:
                                      assistant_metadata]
         self._condensed_message_history[-2] = [assistant_role,
                                                assistant_message]
+        self._changed.add(assistant_metadata['message_id'])
         # Update the tool result of the tool message
         tool_role, tool_message, tool_metadata = self._message_history[-1]
         if tool_role != 'tool':
@@ -85,6 +96,7 @@ class Messages:
         tool_message = json.dumps(tool_data)
         self._message_history[-1] = [tool_role, tool_message, tool_metadata]
         self._condensed_message_history[-1] = [tool_role, tool_message]
+        self._changed.add(tool_metadata['message_id'])
         return True
 
     def metadata(self, workspace_content: str = None,
@@ -124,6 +136,9 @@ class Messages:
         if message_to_remove:
             logger.info(f'deleting message: {message_id}')
             self._message_history.remove(message_to_remove)
+            # The first message with this id is removed, and so is its row
+            if self._row_ids.get(message_id):
+                self._row_ids[message_id].pop(0)
         if condensed_message_to_remove:
             try:
                 self._condensed_message_history.remove(
@@ -176,17 +191,35 @@ class Messages:
         # pprint.pprint(model_prompt)
         return model_prompt
 
+    def row_ids(self):
+        """Returns the database row id of each message, or None for messages
+        that haven't been saved yet.
+        """
+        available = {message_id: list(row_ids)
+                     for message_id, row_ids in self._row_ids.items()}
+        return [available[metadata['message_id']].pop(0)
+                if available.get(metadata['message_id']) else None
+                for _, _, metadata in self._message_history]
+
     def visible_messages(self):
         """Yields role, message, metadata while ignoring messages and 
         converting tool messages into user messages with tool result as 
         content. This is mainly for display in the web interface.
         """
-        for role, message, metadata in self:
+        for _, message in self.visible_rows():
+            yield message
+
+    def visible_rows(self):
+        """Like visible_messages(), but yields (row_id, (role, message,
+        metadata)) tuples, where row_id is the database row id of the
+        message, or None if the message hasn't been saved yet.
+        """
+        for row_id, (role, message, metadata) in zip(self.row_ids(), self):
             if role == 'tool':
                 continue
             if not message.strip():
                 continue
-            yield role, message, metadata
+            yield row_id, (role, message, metadata)
 
     def welcome_message(self):
         return config.welcome_message
@@ -314,58 +347,103 @@ class Messages:
         for _, _, metadata in conversation['message_history']:
             if 'message_id' not in metadata:
                 metadata['message_id'] = str(uuid.uuid4())
+                self._changed.add(metadata['message_id'])
                 modified = True
+        self._row_ids = {}
+        for row_id, (_, _, metadata) in zip(
+                conversation.get('message_row_ids', []),
+                conversation['message_history']):
+            self._row_ids.setdefault(metadata['message_id'], []).append(
+                row_id)
+        self._conversation_id = conversation.get('conversation_id')
         self._conversation_title = conversation['title']
         self._message_history = conversation['message_history']
         self._condensed_text = conversation['condensed_text']
         self._condensed_message_history = \
             conversation['condensed_message_history']
         self._notes = conversation.get('notes', {})
+        self.retrieval = conversation.get('retrieval')
         if self._persistent and modified:
             self.save()
 
     def save(self):
         conversation = {
             'condensed_text': self._condensed_text,
-            'message_history': self._message_history,
             'condensed_message_history': self._condensed_message_history,
             'title': self._conversation_title,
             'notes': self._notes,
+            'retrieval': self.retrieval,
         }
-        self._conversation_id = self._sigmund.database.update_active_conversation(conversation)
-        # We update the title in a background process so that we don't block
-        # the conversation
-        mp.Process(target=self._update_title).start()
+        if config.incremental_persistence:
+            self._save_incremental(conversation)
+        else:
+            conversation['message_history'] = self._message_history
+            self._conversation_id = \
+                self._sigmund.database.update_active_conversation(conversation)
+        self._request_title()
 
-    def _update_title(self):
+    def _save_incremental(self, conversation):
+        """Saves only new and changed messages. Deleted messages are detected
+        by the database, because their rows are no longer referenced.
+        """
+        message_rows = [
+            (row_id, message, message[2]['message_id'] in self._changed)
+            for row_id, message in zip(self.row_ids(), self._message_history)]
+        self._conversation_id, row_ids = \
+            self._sigmund.database.save_active_conversation(
+                conversation, message_rows)
+        self._row_ids = {}
+        for message, row_id in zip(self._message_history, row_ids):
+            self._row_ids.setdefault(message[2]['message_id'], []).append(
+                row_id)
+        self._changed = set()
+
+    def _request_title(self):
         """The conversation title is updated when there are at least two 
         messages, excluding the system prompt and AI welcome message. Based on
         the last messages, a summary title is then created.
 
-        This method is run in a separate process to avoid blocking the main thread.
+        The title is created by the title worker to avoid blocking the
+        conversation. Nothing is submitted if the conversation already has a
+        title, or if a title job for this conversation is already pending.
         """
-        if len(self) <= 2 or \
+        if len(self) <= 2 or self._conversation_id is None or \
                 self._conversation_title != config.default_conversation_title:
             return
-        logger.info('updating conversation title')
         # To make sure that all models understand that the conversation should
         # be summarized into the title, we add the title prompt to the system
         # prompt as well as the last user message. If the prompt already ends
-        # with a user message, we strip it.
+        # with a user message, we strip it. The prompt is built here, rather
+        # than in the worker, because the message history may change while
+        # the job is pending.
         title_prompt = [dict(role='system', content=prompt.TITLE_PROMPT)]
         title_prompt += self.prompt()[2:]
         if title_prompt[-1]['role'] == 'user':
             title_prompt.pop()
         title_prompt.append(dict(role='user', content=prompt.TITLE_PROMPT))
-        suggested_title = self._sigmund.condense_model.predict(title_prompt).strip()
+        model = self._sigmund.condense_model
+        database = self._sigmund.database
+        conversation_id = self._conversation_id
+        title_worker.submit(
+            conversation_id,
+            lambda: self._update_title(model, database, conversation_id,
+                                       title_prompt))
+
+    def _update_title(self, model, database, conversation_id, title_prompt):
+        """Generates and stores the title. This runs in the title worker."""
+        logger.info('updating conversation title')
+        suggested_title = model.predict(title_prompt)
         # The prediction may be a tool call, so we need to check if it is a str.
         # This should not ordinarily happen, but sometimes models get confused.
         if not isinstance(suggested_title, str):
             logger.error(f'suggested conversation title is not str, but: {suggested_title}')
             return
-        self._conversation_title = suggested_title.strip('"\'')
-        if len(self._conversation_title) > 100:
-            self._conversation_title = self._conversation_title[:100] + '…'
-        self._sigmund.database.set_conversation_title(
-            self._conversation_id, self._conversation_title)
+        title = suggested_title.strip().strip('"\'')
+        if len(title) > 100:
+            title = title[:100] + '…'
+        database.set_conversation_title(conversation_id, title)
+        # Also update the title in memory, so that later saves of the same
+        # conversation don't overwrite it with the default title.
+        if self._conversation_id == conversation_id:
+            self._conversation_title = title
         logger.info('completed updating conversation title')
\ No newline at end of file
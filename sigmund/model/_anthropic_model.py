@@ -1,4 +1,5 @@
 from . import BaseModel
+from . import _client_pool as client_pool
 from .. import config, utils
 import logging
 import json
@@ -8,11 +9,23 @@ logger = logging.getLogger('sigmund')
 class AnthropicModel(BaseModel):
 
     def __init__(self, sigmund, model, **kwargs):
-        from anthropic import Anthropic, AsyncAnthropic
         super().__init__(sigmund, model, **kwargs)
         self._tool_use_id = 0
-        self._client = Anthropic(api_key=config.anthropic_api_key)
-        self._async_client = AsyncAnthropic(api_key=config.anthropic_api_key)
+        self._client = client_pool.get_client(
+            'anthropic', self._create_client, config.anthropic_api_key)
+
+    @staticmethod
+    def _create_client(limits):
+        from anthropic import Anthropic, DefaultHttpxClient, \
+            DEFAULT_CONNECTION_LIMITS
+        http_client = DefaultHttpxClient(
+            limits=type(DEFAULT_CONNECTION_LIMITS)(**limits))
+        return Anthropic(api_key=config.anthropic_api_key,
+                         http_client=http_client), http_client
+
+    def _create_async_client(self):
+        from anthropic import AsyncAnthropic
+        return AsyncAnthropic(api_key=config.anthropic_api_key)
 
     def predict(self, messages, attachments=None, stream=False):
         if isinstance(messages, str):
@@ -281,18 +294,56 @@ class AnthropicModel(BaseModel):
                 model=self._model, messages=messages, **kwargs
             ) as stream:
                 all_text = ''
-                for text in stream.text_stream:
+                streamed_chars = 0
+                # Cancellation is checked for every event, including thinking
+                # events, which don't result in streamed text
+                for event in stream:
+                    if self.cancelled():
+                        break
+                    if event.type == 'content_block_delta':
+                        if event.delta.type == 'thinking_delta':
+                            streamed_chars += len(event.delta.thinking)
+                        elif event.delta.type == 'text_delta':
+                            text = event.delta.text
+                            if config.log_replies:
+                                logger.info(f'streaming: {text}')
+                            streamed_chars += len(text)
+                            all_text += text
+                    # The text is also yielded, unchanged, for events without
+                    # text, so that text that is held back by StreamCoalescer
+                    # is sent in time while the model is thinking or calling
+                    # a tool
+                    if all_text:
+                        yield all_text, False
+                else:
                     if config.log_replies:
-                        logger.info(f'streaming: {text}')
-                    all_text += text
-                    yield all_text, False
-                if config.log_replies:
-                    logger.info('stream ended')
-                yield stream.get_final_message(), True
+                        logger.info('stream ended')
+                    yield stream.get_final_message(), True
+                    return
+                response = self._partial_response(stream, streamed_chars)
+            # Leaving the stream closes the connection, so that the model stops
+            # generating
+            logger.info('stream cancelled')
+            yield response, True
         except Exception:
             self._print_error(messages, kwargs)
             raise
 
+    def _partial_response(self, stream, streamed_chars):
+        """Returns the message that has been received so far from a stream
+        that is cancelled, or None if nothing has been received yet. The
+        number of output tokens is only reported at the end of a stream, and
+        is therefore estimated.
+        """
+        try:
+            message = stream.current_message_snapshot
+        except AssertionError:
+            return None
+        message.usage.output_tokens = max(
+            message.usage.output_tokens,
+            streamed_chars // config.stream_cancel_chars_per_token)
+        return message
+
     async def async_invoke(self, messages):
         messages, kwargs = self._prepare_invoke_kwargs(messages)
         try:
@@ -26,6 +26,7 @@ class BaseModel:
         self.json_mode = False
         self._stream_result = None
         self._strip_thinking_blocks = strip_thinking_blocks
+        self._async_client_instance = None
 
     def __repr__(self):
         return f'{self.__class__.__name__}(model={self._model}, thinking={self._thinking})'
@@ -42,6 +43,18 @@ class BaseModel:
         return [{"type": "function", "function": t.tool_spec}
                 for t in self._tools if t.tool_spec]
 
+    def _create_async_client(self):
+        raise NotImplementedError()
+
+    @property
+    def _async_client(self):
+        """Async clients are bound to the event loop in which they are used,
+        and are therefore not pooled. They are only created when needed.
+        """
+        if self._async_client_instance is None:
+            self._async_client_instance = self._create_async_client()
+        return self._async_client_instance
+
     def invoke(self, messages, attachments=None):
         raise NotImplementedError()
 
@@ -51,6 +64,12 @@ class BaseModel:
     def async_invoke(self, messages, attachments=None):
         raise NotImplementedError()
         
+    def cancelled(self) -> bool:
+        """Indicates whether the user has cancelled the reply. This is checked
+        while streaming, and doesn't involve any I/O.
+        """
+        return self._sigmund is not None and self._sigmund.cancelled.is_set()
+
     def handle_invoke_exception(self, e: Exception) -> str:
         """Receives an Exception that resulted from invoking a model. If a str is
         returned, this is used as an informative message to notify the user what
@@ -111,6 +130,7 @@ class BaseModel:
             yield error, True
             return
         logger.info(f'predicting with {self} (streaming)')
+        reply = None
         try:
             for reply, complete in self.stream_invoke(messages):
                 if complete:
@@ -122,6 +142,12 @@ class BaseModel:
                 yield response, True
                 return
             raise
+        # A cancelled reply is not returned, but the usage so far is recorded
+        # by get_response(). The reply is None if nothing was received.
+        if self.cancelled():
+            if reply is not None:
+                self.get_response(reply)
+            return
         reply = self.get_response(reply)
         if self._strip_thinking_blocks:
             reply = self.strip_thinking_blocks(reply)        
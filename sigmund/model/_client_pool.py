@@ -0,0 +1,99 @@
+"""A process-wide pool of provider SDK clients. Creating an SDK client also
+creates an HTTP connection pool, and connections to the providers are
+expensive to set up (TLS handshakes). Therefore, clients are created once per
+process and shared by all models, keyed by provider, API key, and base URL.
+"""
+import hashlib
+import logging
+import threading
+from .. import config
+logger = logging.getLogger('sigmund')
+# Keys are (provider, api_key, base_url) tuples. Values are dicts with the SDK
+# client, the underlying HTTP client, and the number of checkouts.
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def limits() -> dict:
+    """Returns the connection limits as keyword arguments for an httpx Limits
+    object. This is a dict rather than a Limits object, because SDKs may
+    depend on different versions (or forks) of httpx.
+    """
+    return dict(max_connections=config.model_client_pool_size,
+                max_keepalive_connections=config.model_client_pool_size,
+                keepalive_expiry=config.model_client_keepalive)
+
+
+def get_client(provider: str, factory: callable, api_key: str,
+               base_url: str = None):
+    """Returns a shared SDK client for the provider. If no client exists yet,
+    one is created by calling factory(limits()), which should return an
+    (sdk_client, http_client) tuple, where http_client is the HTTP client that
+    has been passed to the SDK.
+
+    Parameters
+    ----------
+    provider : str
+        The name of the provider, such as 'openai' or 'anthropic'.
+    factory : callable
+        A function that takes connection limits and returns an
+        (sdk_client, http_client) tuple.
+    api_key : str
+        The API key. Clients with different keys are never shared.
+    base_url : str, optional
+        The base URL of the API, if this differs from the SDK default.
+    """
+    key = provider, api_key, base_url
+    with _pool_lock:
+        entry = _pool.get(key)
+        if entry is None:
+            logger.info(f'creating pooled client for {provider}')
+            client, http_client = factory(limits())
+            entry = {'client': client,
+                     'http_client': http_client,
+                     'checkouts': 0}
+            _pool[key] = entry
+        entry['checkouts'] += 1
+        return entry['client']
+
+
+def _connection_stats(http_client) -> dict:
+    """Inspects the connection pool of an httpx client. This relies on
+    httpcore internals, so we fail gracefully if these change.
+    """
+    try:
+        connections = http_client._transport._pool.connections
+    except AttributeError:
+        return {}
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {'connections': len(connections),
+            'idle': idle,
+            'active': len(connections) - idle}
+
+
+def stats() -> list:
+    """Returns a list of dicts with utilization statistics for each pooled
+    client. API keys are not included, only a short fingerprint.
+    """
+    with _pool_lock:
+        entries = list(_pool.items())
+    result = []
+    for (provider, api_key, base_url), entry in entries:
+        fingerprint = hashlib.sha256(
+            str(api_key).encode()).hexdigest()[:8]
+        info = {'provider': provider,
+                'key_fingerprint': fingerprint,
+                'base_url': base_url,
+                'checkouts': entry['checkouts'],
+                'max_connections': config.model_client_pool_size}
+        info.update(_connection_stats(entry['http_client']))
+        result.append(info)
+    return result
+
+
+def close_all():
+    """Closes all pooled clients, for example when a worker shuts down."""
+    with _pool_lock:
+        for entry in _pool.values():
+            entry['http_client'].close()
+        _pool.clear()
@@ -5,6 +5,7 @@ import os
 from types import SimpleNamespace
 from .. import config, utils
 from . import BaseModel
+from . import _client_pool as client_pool
 from ._openai_model import OpenAIModel
 logger = logging.getLogger('sigmund')
 
@@ -12,7 +13,6 @@ logger = logging.getLogger('sigmund')
 class MistralModel(OpenAIModel):
 
     def __init__(self, sigmund, model, **kwargs):
-        from mistralai.client import Mistral
         BaseModel.__init__(self, sigmund, model, **kwargs)
         self._actual_model = self._model
         # Mistral doesn't allow a tool to be specified by name. So if this
@@ -21,7 +21,20 @@ class MistralModel(OpenAIModel):
         # the same thing as forcing the tool by name.
         if self._tool_choice not in [None, 'none', 'auto', 'any']:
             self._tool_choice = 'any'
-        self._client = Mistral(api_key=config.mistral_api_key)
+        # The Mistral client handles both sync and async calls
+        self._client = client_pool.get_client(
+            'mistral', self._create_client, config.mistral_api_key)
+
+    @staticmethod
+    def _create_client(limits):
+        from mistralai.client import Mistral
+        # The Mistral SDK may use a fork of httpx, so we use the module that
+        # the SDK itself uses.
+        from mistralai.client.httpclient import httpx
+        http_client = httpx.Client(follow_redirects=True,
+                                   limits=httpx.Limits(**limits))
+        return Mistral(api_key=config.mistral_api_key,
+                       client=http_client), http_client
 
     def predict(self, messages, attachments=None, stream=False):
         if isinstance(messages, str):
@@ -165,6 +178,15 @@ class MistralModel(OpenAIModel):
         usage = None
         all_text = ''
         for event in stream:
+            # Closing the stream closes the connection, so that the model stops
+            # generating. The usage is only reported at the end of a stream,
+            # and is therefore estimated.
+            if self.cancelled():
+                stream.close()
+                logger.info('stream cancelled')
+                if usage is None:
+                    usage = self._estimated_usage(messages, all_text)
+                break
             chunk = event.data
             if chunk.usage is not None:
                 usage = chunk.usage
@@ -177,14 +199,12 @@ class MistralModel(OpenAIModel):
                 if isinstance(delta.content, str):
                     content_items.append(('text', delta.content))
                     all_text += delta.content
-                    yield all_text, False
                 elif isinstance(delta.content, list):
                     has_list_content = True
                     for item in delta.content:
                         if item.type == 'text' and item.text:
                             content_items.append(('text', item.text))
                             all_text += item.text
-                            yield all_text, False
                         elif item.type == 'thinking':
                             content_items.append(
                                 ('thinking', item.thinking or []))
@@ -208,6 +228,12 @@ class MistralModel(OpenAIModel):
                             acc.function.name = tc.function.name
                         if tc.function.arguments:
                             acc.function.arguments += tc.function.arguments
+            # The text so far is yielded for every chunk, also for thinking
+            # and tool-call fragments, so that text that is held back by
+            # StreamCoalescer is sent in time while the model is thinking or
+            # calling a tool
+            if all_text:
+                yield all_text, False
         # Reconstruct the final response to match the structure returned by
         # invoke(), so that get_response() works on it.
         if not content_items:
@@ -3,6 +3,7 @@ import logging
 from types import SimpleNamespace
 from .. import config
 from . import BaseModel
+from . import _client_pool as client_pool
 
 
 logger = logging.getLogger('sigmund')
@@ -10,14 +11,34 @@ logger = logging.getLogger('sigmund')
 
 class OpenAIModel(BaseModel):
 
+    # The provider name and base URL are used to share clients between
+    # models. Subclasses for OpenAI-compatible APIs override these.
+    provider = 'openai'
+    base_url = None
+
     def __init__(self, sigmund, model, **kwargs):
-        from openai import Client, AsyncClient
         super().__init__(sigmund, model, **kwargs)
         if self._tool_choice not in (None, 'auto'):
             self._tool_choice = {"type": "function",
                                  "function": {"name": self._tool_choice}}
-        self._client = Client(api_key=config.openai_api_key)
-        self._async_client = AsyncClient(api_key=config.openai_api_key)
+        self._client = client_pool.get_client(
+            self.provider, self._create_client, self._api_key(),
+            self.base_url)
+
+    def _api_key(self):
+        return config.openai_api_key
+
+    def _create_client(self, limits):
+        from openai import Client, DefaultHttpxClient, \
+            DEFAULT_CONNECTION_LIMITS
+        http_client = DefaultHttpxClient(
+            limits=type(DEFAULT_CONNECTION_LIMITS)(**limits))
+        return Client(api_key=self._api_key(), base_url=self.base_url,
+                      http_client=http_client), http_client
+
+    def _create_async_client(self):
+        from openai import AsyncClient
+        return AsyncClient(api_key=self._api_key(), base_url=self.base_url)
 
     def predict(self, messages, attachments=None, stream=False):
         # Strings need to be converted a list of length one with a single
@@ -146,6 +167,24 @@ class OpenAIModel(BaseModel):
             return self.invalid_tool
         return response.choices[0].message.content
 
+    def _estimated_usage(self, messages, text):
+        """Estimates the usage of a stream that was cancelled before the usage
+        was reported.
+        """
+        chars_per_token = config.stream_cancel_chars_per_token
+        prompt_chars = 0
+        for message in messages:
+            content = message.get('content') or ''
+            # Content with attachments is a list of dict, of which only the
+            # text is counted
+            if isinstance(content, list):
+                content = ''.join(part.get('text', '') for part in content)
+            prompt_chars += len(content)
+        return SimpleNamespace(
+            prompt_tokens=max(1, prompt_chars // chars_per_token),
+            completion_tokens=len(text) // chars_per_token,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+
     def _tool_args(self):
         if not self._tools:
             return {}
@@ -183,16 +222,23 @@ class OpenAIModel(BaseModel):
         usage = None
         all_text = ''
         for chunk in stream:
+            # Closing the stream closes the connection, so that the model stops
+            # generating. The usage is only reported at the end of a stream,
+            # and is therefore estimated.
+            if self.cancelled():
+                stream.close()
+                logger.info('stream cancelled')
+                if usage is None:
+                    usage = self._estimated_usage(messages, all_text)
+                break
             if chunk.usage is not None:
                 usage = chunk.usage
             if not chunk.choices:
                 continue
             delta = chunk.choices[0].delta
-            # Yield text content fragments as they arrive
             if delta.content:
                 content_parts.append(delta.content)
                 all_text += delta.content
-                yield all_text, False
             # Accumulate streamed tool call fragments
             if delta.tool_calls:
                 for tc in delta.tool_calls:
@@ -213,6 +259,11 @@ class OpenAIModel(BaseModel):
                             acc.function.name = tc.function.name
                         if tc.function.arguments:
                             acc.function.arguments += tc.function.arguments
+            # The text so far is yielded for every chunk, also for tool-call
+            # fragments, so that text that is held back by StreamCoalescer is
+            # sent in time while the model is calling a tool
+            if all_text:
+                yield all_text, False
         # Reconstruct the final response to match the structure returned by
         # invoke(), so that get_response() works on it.
         final_content = ''.join(content_parts) if content_parts else None
@@ -1,5 +1,6 @@
 from zai import ZaiClient
 from ._openai_model import OpenAIModel
+from . import _client_pool as client_pool
 from .. import config
 import logging
 
@@ -9,20 +10,26 @@ BASE_URL = "https://api.z.ai/api/paas/v4/"
 
 class ZModel(OpenAIModel):
 
+    provider = 'z'
+    base_url = BASE_URL
 
     def __init__(self, sigmund, model, **kwargs):
-        from openai import Client, AsyncClient
         super().__init__(sigmund, model, **kwargs)
-        if self._tool_choice not in (None, 'auto'):
-            self._tool_choice = {"type": "function",
-                                 "function": {"name": self._tool_choice}}
-        self._client = Client(api_key=config.z_api_key, base_url=BASE_URL)
-        self._async_client = AsyncClient(api_key=config.z_api_key,
-                                         base_url=BASE_URL)
-        self._z_client = ZaiClient(api_key=config.z_api_key)
+        self._z_client = client_pool.get_client(
+            'zai', self._create_z_client, config.z_api_key)
         self._default_model = model
         self._vision_model = config.model_config['z']['vision_model']
-        
+
+    def _api_key(self):
+        return config.z_api_key
+
+    @staticmethod
+    def _create_z_client(limits):
+        import httpx
+        http_client = httpx.Client(limits=httpx.Limits(**limits))
+        return ZaiClient(api_key=config.z_api_key,
+                         http_client=http_client), http_client
+
     def _prepare_tool_messages(self, messages):        
         # Z expects at least one user message, which is different from OpenAI.
         # Therefore, we insert a user message as the first message if there is
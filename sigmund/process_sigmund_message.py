@@ -305,33 +305,356 @@ def escape_html_tags(message: str) -> str:
     return ''.join(result)
 
 
+# Patterns that are used by MessageNormalizer. They are matched against
+# single lines.
+_fence_pattern = re.compile(r'([ \t]*)(```|~~~)')
+_indent_pattern = re.compile(r'[ \t]*')
+_bullet_pattern = re.compile(r'(\s*)[•–♦○└─]\s+')
+_round_bracket_pattern = re.compile(r'(\s*\d+)\)')
+_ordinal_pattern = re.compile(r'\d+\.')
+_indented_item_pattern = re.compile(r'\s+(?:- |\d+\.)')
+_dash_item_pattern = re.compile(r'\s*-\s')
+_item_pattern = re.compile(r'\s*(?:-|\d+\.)(?:\s|$)')
+_next_item_pattern = re.compile(r'[ \t]*(?:-|\d+\.)(\s|$)')
+_line_break_pattern = re.compile('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_rule_pattern = re.compile(r'[─-]{10,}')
+_nested_item_pattern = re.compile(r'( +)(?:(-)\s+|(?=\d+\.))')
+_allowed_div_pattern = re.compile(
+    r'<div\b[^>]*class="[^"]*\b(?:thinking_block_signature|'
+    r'thinking_block_content|message-info|image-generation|'
+    r'tool-call-indicator)\b[^"]*"[^>]*>', re.IGNORECASE)
+_closing_div_pattern = re.compile(r'</div>', re.IGNORECASE)
+
+
+def _escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class MessageNormalizer:
+    """Normalizes AI messages in a single pass over their lines. This applies
+    the same fixes as the separate functions above did when they were applied
+    in a chain by process_ai_message(), and mostly gives the same result.
+    There are two deliberate differences:
+
+    - Lines inside fenced code blocks are left alone, except that they are
+      dedented and that trailing whitespace is removed.
+    - fix_indentation_after_colon() ignores lines that end with a colon if
+      they are identical to the last line of the message, also when they
+      occur earlier in the message, so that over-indented list items after
+      such lines are not dedented. Here, all lines that end with a colon are
+      treated in the same way, because the last line is not known yet while
+      a message is streamed.
+
+    Most lines are normalized as soon as they are complete. Some lines are
+    held back until the next lines are known, for example lines of a code
+    block, which can only be dedented once the block is closed. Because of
+    this, streamed messages can be normalized incrementally with update(),
+    so that lines are normalized only once.
+
+    Examples
+    --------
+    >>> normalizer = MessageNormalizer()
+    >>> for text in stream:
+    >>>     stable, pending = normalizer.update(text)
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._text = ''
+        # The number of characters of the text that have been fed as complete
+        # lines
+        self._consumed = 0
+        # The normalized lines. These don't change anymore.
+        self._output = []
+        # The lines of a code block that hasn't been closed yet, and the
+        # indentation and backticks or tildes of its opening fence
+        self._fence = None
+        self._fence_indent = None
+        self._fence_lines = []
+        # The state of fix_indentation_after_colon()
+        self._inside_intro_block = False
+        self._intro_indent = 0
+        self._after_colon = False
+        # The state of add_blank_line_after_colon_headers(), which inserts a
+        # blank line before a list item, unless the previous line is blank or
+        # a list item itself. A list item that consists only of a bullet or a
+        # number counts as a list item only if it is followed by another line,
+        # and is therefore held back.
+        self._previous_item = True
+        self._held_item = None
+        # The lines that are held back by fix_markdown_headings(), because
+        # they may turn out to be a heading
+        self._heading_lines = []
+        # The lines of a protected <div> that hasn't been closed yet
+        self._div_lines = None
+
+    def update(self, text: str) -> tuple[list, list]:
+        """Takes the full text that has been streamed so far, normalizes the
+        lines that have been completed since the last update, and returns a
+        (stable, pending) tuple. stable is a list of normalized lines that
+        won't change anymore, and which only grows between updates. pending
+        is a list of lines that are normalized as if the message ends here.
+        Together, they are the normalized message.
+        """
+        # Streamed text only grows. If it doesn't, we start from scratch.
+        if not text.startswith(self._text[:self._consumed]):
+            self.reset()
+        if not self._text and text:
+            self._start(text)
+        self._text = text
+        end = text.rfind('\n') + 1
+        if end > self._consumed:
+            for line in text[self._consumed:end - 1].split('\n'):
+                self._feed(line)
+            self._consumed = end
+        # The pending lines are normalized by a copy, so that the state of
+        # this normalizer doesn't change
+        normalizer = self._copy()
+        normalizer._feed(text[self._consumed:])
+        normalizer._finish(text[self._consumed:])
+        return self._output, normalizer._output
+
+    def normalize(self, text: str) -> str:
+        """Normalizes a complete message."""
+        self.reset()
+        if text:
+            self._start(text)
+        lines = text.split('\n')
+        for line in lines:
+            self._feed(line)
+        self._finish(lines[-1])
+        return '\n'.join(self._output)
+
+    def _copy(self):
+        normalizer = MessageNormalizer.__new__(MessageNormalizer)
+        normalizer.__dict__.update(self.__dict__)
+        normalizer._output = []
+        normalizer._fence_lines = self._fence_lines[:]
+        normalizer._heading_lines = self._heading_lines[:]
+        if self._div_lines is not None:
+            normalizer._div_lines = self._div_lines[:]
+        return normalizer
+
+    def _start(self, text):
+        # If the message doesn't start with a letter, then it may start with
+        # some markdown character that we should properly interpret, and thus
+        # needs to be on a newline preceded by an empty line.
+        if not text[0].isalpha():
+            self._fix_headings('', False)
+            self._fix_headings('', False)
+
+    def _feed(self, line):
+        """Collects code blocks, which are dedented once they are closed (see
+        dedent_code_blocks()). Other lines are passed on right away.
+        """
+        if self._fence is not None:
+            self._fence_lines.append(line)
+            if line.startswith(self._fence):
+                self._dedent_code_block()
+            return
+        m = _fence_pattern.match(line)
+        if m:
+            self._fence = m.group()
+            self._fence_indent = m.group(1)
+            self._fence_lines = [line]
+            return
+        self._normalize_line(line, False)
+
+    def _dedent_code_block(self):
+        indent = self._fence_indent
+        lines = self._fence_lines
+        if indent and all(_indent_pattern.match(line).group() >= indent
+                          for line in lines if line.strip()):
+            lines = [line[len(indent):] if line.strip() else line
+                     for line in lines]
+        for line in lines:
+            self._normalize_line(line, True)
+        self._fence = None
+        self._fence_lines = []
+
+    def _normalize_line(self, line, code):
+        """Applies normalize_bullet_points(), replace_round_bracket_with_dot(),
+        and fix_indentation_after_colon(), which only apply outside of code
+        blocks.
+        """
+        if code:
+            self._inside_intro_block = False
+            self._after_colon = False
+            self._add_blank_lines(line, True)
+            return
+        m = _bullet_pattern.match(line)
+        if m:
+            line = m.group(1) + '- ' + line[m.end():]
+        m = _round_bracket_pattern.match(line)
+        if m:
+            line = m.group(1) + '.' + line[m.end():]
+        if self._after_colon:
+            self._intro_indent = len(line) - len(line.lstrip())
+            self._after_colon = False
+        stripped = line.lstrip()
+        if stripped.endswith(':') and not stripped.startswith('-') and \
+                not _ordinal_pattern.match(stripped):
+            self._inside_intro_block = True
+            self._after_colon = True
+        elif self._inside_intro_block and _indented_item_pattern.match(line):
+            line = line[self._intro_indent:]
+        elif not _dash_item_pattern.match(line):
+            self._inside_intro_block = False
+        self._add_blank_lines(line, False)
+
+    def _add_blank_lines(self, line, code):
+        """Inserts blank lines before list items, as
+        add_blank_line_after_colon_headers() does.
+        """
+        if self._held_item is not None:
+            self._fix_headings('', False)
+            self._fix_headings(self._held_item, False)
+            self._held_item = None
+            self._previous_item = True
+        if code:
+            self._previous_item = False
+            self._fix_headings(line, True)
+            return
+        if not self._previous_item:
+            m = _next_item_pattern.match(line)
+            if m:
+                if not m.group(1):
+                    self._held_item = line
+                    return
+                self._fix_headings('', False)
+        self._previous_item = not line.strip() or \
+            _item_pattern.match(line) is not None
+        self._fix_headings(line, False)
+
+    def _fix_headings(self, line, code):
+        """Removes trailing whitespace, and turns text between two rule lines
+        into a heading, as fix_markdown_headings() does.
+        """
+        # Like str.splitlines(), fix_markdown_headings() also splits lines at
+        # other characters than newlines
+        if _line_break_pattern.search(line):
+            lines = (line + '\n').splitlines()
+        else:
+            lines = [line]
+        for line in lines:
+            line = line.rstrip()
+            if code:
+                self._flush_headings(final=True)
+                self._fix_list_formatting(line, True)
+                continue
+            self._heading_lines.append(line)
+            self._flush_headings(final=False)
+
+    def _flush_headings(self, final):
+        lines = self._heading_lines
+        while lines:
+            if not _rule_pattern.fullmatch(lines[0]):
+                self._fix_list_formatting(lines.pop(0), False)
+                continue
+            if len(lines) < 3:
+                if not final:
+                    return
+                self._fix_list_formatting(lines.pop(0), False)
+                continue
+            if lines[1].strip() and _rule_pattern.fullmatch(lines[2]):
+                self._fix_list_formatting(f'## {lines[1].strip()}', False)
+                self._fix_list_formatting('', False)
+                del lines[:3]
+            else:
+                self._fix_list_formatting(lines.pop(0), False)
+
+    def _fix_list_formatting(self, line, code):
+        """Indents nested list items by four spaces per level, as
+        fix_list_formatting_1() to fix_list_formatting_12() do.
+        """
+        if not code:
+            m = _nested_item_pattern.match(line)
+            if m:
+                spaces = len(m.group(1))
+                if spaces in (1, 2, 3):
+                    indent = '    '
+                elif spaces in (5, 6, 7):
+                    indent = '        '
+                else:
+                    indent = None
+                if indent is not None:
+                    line = indent + ('- ' if m.group(2) else '') + \
+                        line[m.end():]
+        self._escape_html_tags(line, code)
+
+    def _escape_html_tags(self, line, code):
+        """Escapes HTML outside of code blocks and protected <div>s, as
+        escape_html_tags() does. Protected <div>s are held back until they
+        are closed, because otherwise they are not protected.
+        """
+        if self._div_lines is not None:
+            self._div_lines.append((line, code))
+            m = _closing_div_pattern.search(line)
+            if m is None:
+                return
+            (prefix, div), *lines = self._div_lines[:-1]
+            self._div_lines = None
+            self._output.append(prefix + div)
+            self._output.extend(line for line, _ in lines)
+            if code:
+                self._output.append(line)
+            else:
+                self._escape_line(line[m.end():], line[:m.end()])
+            return
+        if code:
+            self._output.append(line)
+        else:
+            self._escape_line(line)
+
+    def _escape_line(self, line, prefix=''):
+        parts = [prefix]
+        pos = 0
+        while True:
+            m = _allowed_div_pattern.search(line, pos)
+            if m is None:
+                parts.append(_escape(line[pos:]))
+                break
+            parts.append(_escape(line[pos:m.start()]))
+            closing = _closing_div_pattern.search(line, m.end())
+            if closing is None:
+                self._div_lines = [(''.join(parts), line[m.start():])]
+                return
+            parts.append(line[m.start():closing.end()])
+            pos = closing.end()
+        self._output.append(''.join(parts))
+
+    def _finish(self, last_line):
+        if self._fence is not None:
+            # A code block that isn't closed is not a code block
+            lines = self._fence_lines
+            self._fence = None
+            self._fence_lines = []
+            for line in lines:
+                self._normalize_line(line, False)
+        if self._held_item is not None:
+            self._fix_headings(self._held_item, False)
+            self._held_item = None
+        self._flush_headings(final=True)
+        if self._div_lines is not None:
+            # A <div> that isn't closed is not protected
+            (prefix, div), *lines = self._div_lines
+            self._div_lines = None
+            self._output.append(prefix + _escape(div))
+            self._output.extend(line if code else _escape(line)
+                                for line, code in lines)
+        # fix_markdown_headings() removes the last line if it is empty, which
+        # is the case if the text ends with a newline. Lines that end with
+        # other line breaks are also split differently at the end.
+        if not last_line or (last_line[-1] != '\r' and
+                             _line_break_pattern.match(last_line[-1])):
+            self._output.pop()
+
+
 def process_ai_message(msg):
     try:
-        # msg = BaseModel.strip_thinking_blocks(msg)
-        msg = normalize_bullet_points(msg)
-        msg = replace_round_bracket_with_dot(msg)
-        msg = fix_indentation_after_colon(msg)
-        msg = add_blank_line_after_colon_headers(msg)
-        # If the message doesn't start with a letter, then it may start with some 
-        # markdown character that we should properly interpret, and thus needs to 
-        # be on a newline preceded by an empty line.
-        if msg and not msg[0].isalpha():
-            msg = '\n\n' + msg
-        msg = dedent_code_blocks(msg)
-        msg = fix_markdown_headings(msg)
-        msg = fix_list_formatting_1(msg)
-        msg = fix_list_formatting_2(msg)
-        msg = fix_list_formatting_3(msg)
-        msg = fix_list_formatting_4(msg)
-        msg = fix_list_formatting_5(msg)
-        msg = fix_list_formatting_6(msg)
-        msg = fix_list_formatting_7(msg)
-        msg = fix_list_formatting_8(msg)
-        msg = fix_list_formatting_9(msg)
-        msg = fix_list_formatting_10(msg)
-        msg = fix_list_formatting_11(msg)
-        msg = fix_list_formatting_12(msg)
-        msg = escape_html_tags(msg)        
+        msg = MessageNormalizer().normalize(msg)
     except Exception as e:
         logger.error(f"Error processing AI message: {e}")
     # We don't want to have empty assistant messages appear in the user 
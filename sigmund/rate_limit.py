@@ -0,0 +1,61 @@
+"""Token-bucket rate limiting in Redis, so that limits are shared across
+processes. Each bucket holds up to capacity tokens, and is refilled at a fixed
+rate. Every request takes a token, and is refused when the bucket is empty.
+The bucket is updated in an optimistic (WATCH/MULTI) transaction, so that
+concurrent requests cannot take the same token.
+"""
+import logging
+import math
+import time
+from redis.exceptions import RedisError
+from .redis_client import redis_client
+logger = logging.getLogger('sigmund')
+
+
+def consume(key: str, capacity: float, refill_rate: float,
+            tokens: float = 1) -> tuple[bool, float]:
+    """Takes tokens from a bucket.
+
+    Parameters
+    ----------
+    key : str
+        Identifies the bucket, for example an IP address.
+    capacity : float
+        The maximum number of tokens, which is also the maximum burst size.
+    refill_rate : float
+        The number of tokens that are added per second.
+    tokens : float, optional
+        The number of tokens to take.
+
+    Returns
+    -------
+    tuple
+        An (allowed, retry_after) tuple, where retry_after is the number of
+        seconds after which the tokens will be available. If Redis is not
+        available, requests are allowed.
+    """
+    bucket_key = f'rate_limit_{key}'
+
+    def take(pipe):
+        now = time.time()
+        level, timestamp = pipe.hmget(bucket_key, 'tokens', 'timestamp')
+        if level is None or timestamp is None:
+            level = capacity
+        else:
+            level = min(capacity, float(level) +
+                        max(0, now - float(timestamp)) * refill_rate)
+        allowed = level >= tokens
+        if allowed:
+            level -= tokens
+        pipe.multi()
+        pipe.hset(bucket_key, mapping={'tokens': level, 'timestamp': now})
+        # The bucket expires once it would have been refilled anyway
+        pipe.expire(bucket_key, math.ceil(capacity / refill_rate) + 1)
+        return allowed, 0 if allowed else (tokens - level) / refill_rate
+
+    try:
+        return redis_client.transaction(take, bucket_key,
+                                        value_from_callable=True)
+    except RedisError as e:
+        logger.warning(f'failed to check rate limit: {e}')
+        return True, 0
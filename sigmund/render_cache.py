@@ -0,0 +1,122 @@
+"""A cache for the rendered HTML of messages, so that messages don't need to
+be processed and rendered as Markdown every time that a conversation is
+opened. Rendered messages are kept in an in-memory LRU cache per process, and
+are stored, encrypted, with the messages in the database.
+
+Entries are keyed by user id, message id, renderer version, and theme, and
+also store a digest of the message, so that changed messages are rendered
+again. Change RENDERER_REVISION when rendering changes without a version bump.
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List
+from . import config, __version__
+logger = logging.getLogger('sigmund')
+RENDERER_REVISION = 2
+# Process-wide LRU cache with (user id, message id, renderer version, theme)
+# tuples as keys and (digest, html) tuples as values
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_counts = {'hits': 0, 'persistent_hits': 0, 'misses': 0}
+
+
+def renderer_version() -> str:
+    return f'{__version__}.{RENDERER_REVISION}'
+
+
+def digest(role: str, message: str, metadata: dict) -> str:
+    """Returns a digest of everything that affects the rendered HTML."""
+    return hashlib.sha256(json.dumps(
+        [role, message, metadata.get('sources')]).encode()).hexdigest()
+
+
+def _get(key: tuple, message_digest: str) -> dict | None:
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] != message_digest:
+            return None
+        _cache.move_to_end(key)
+        return entry[1]
+
+
+def _put(key: tuple, message_digest: str, html: dict):
+    with _cache_lock:
+        _cache[key] = message_digest, html
+        _cache.move_to_end(key)
+        while len(_cache) > config.render_cache_size:
+            _cache.popitem(last=False)
+
+
+def render_messages(sigmund, messages: List[tuple], row_ids: List[int],
+                    theme: str, render: Callable) -> List[dict]:
+    """Returns the rendered HTML for a list of (role, message, metadata)
+    tuples, from the cache where possible.
+
+    Parameters
+    ----------
+    sigmund : Sigmund
+        Used to look up and store rendered messages in the database.
+    messages : list
+        A list of (role, message, metadata) tuples.
+    row_ids : list
+        The database row id of each message, or None for messages that
+        haven't been saved.
+    theme : str
+        The theme for which the messages are rendered.
+    render : callable
+        A function that takes role, message, and metadata, and returns the
+        rendered HTML as a JSON-serializable dict.
+
+    Returns
+    -------
+    list
+        A list with the rendered HTML of each message.
+    """
+    version = renderer_version()
+    keys = [(sigmund.user_id, metadata.get('message_id'), version, theme)
+            for _, _, metadata in messages]
+    digests = [digest(*message) for message in messages]
+    results = [_get(key, message_digest)
+               for key, message_digest in zip(keys, digests)]
+    missing = [i for i, html in enumerate(results) if html is None]
+    _counts['hits'] += len(messages) - len(missing)
+    if not missing:
+        return results
+    stored = {}
+    if config.render_cache_persistent:
+        stored = sigmund.database.get_rendered_messages(
+            [row_ids[i] for i in missing])
+    to_store = {}
+    for i in missing:
+        row_id = row_ids[i]
+        entry = stored.get(row_id)
+        if entry is not None and entry.get('version') == version and \
+                entry.get('theme') == theme and \
+                entry.get('digest') == digests[i]:
+            _counts['persistent_hits'] += 1
+            html = entry['html']
+        else:
+            _counts['misses'] += 1
+            html = render(*messages[i])
+            if row_id is not None:
+                to_store[row_id] = {'version': version, 'theme': theme,
+                                    'digest': digests[i], 'html': html}
+        results[i] = html
+        if keys[i][1] is not None:
+            _put(keys[i], digests[i], html)
+    if config.render_cache_persistent:
+        sigmund.database.set_rendered_messages(to_store)
+    return results
+
+
+def stats() -> dict:
+    with _cache_lock:
+        return dict(_counts, size=len(_cache))
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
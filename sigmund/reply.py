@@ -1,5 +1,7 @@
+import re
 import json
-from . import utils, process_sigmund_message
+import time
+from . import config, utils, process_sigmund_message
 
 
 class BaseReply:
@@ -51,15 +53,160 @@ class ActionReply(BaseReply):
         return json.dumps({'action': self.action, 'message': self.msg})
 
 
+class StreamRenderer:
+    """Incrementally renders a streamed AI message as a sequence of Markdown
+    blocks. The message is normalized incrementally, so that lines are
+    normalized only once. Blocks are separated by blank lines outside of
+    fenced code blocks. Once a block is followed by the start of a new block,
+    it is considered final and is rendered only once. Only the last
+    (unfinished) block is re-rendered for every chunk.
+
+    The result of each update is a delta that consists of a start index and a
+    list of rendered blocks. The client should discard all blocks from the
+    start index onwards, and then append the new blocks. The final Reply
+    contains a full render of the message, which replaces the streamed blocks.
+    """
+
+    _fence_pattern = re.compile(r'^[ \t]*(```|~~~)')
+
+    def __init__(self):
+        self._normalizer = process_sigmund_message.MessageNormalizer()
+        self.reset()
+
+    def reset(self):
+        self._text = ''
+        self._normalizer.reset()
+        # The number of normalized lines that belong to finalized blocks
+        self._final_line = 0
+        # The number of finalized blocks that have been sent to the client
+        self._final_count = 0
+
+    def _render_block(self, lines):
+        block = '\n'.join(lines)
+        if not block.strip():
+            return None
+        return utils.md(block)
+
+    def _split_final(self, lines, stable):
+        """Splits off finalized blocks from the start of the pending lines and
+        returns them as a list of lists of lines, together with the number of
+        lines that they span. A block is only finalized if its lines, and the
+        blank line that follows it, are among the first stable lines, which
+        won't be changed by normalization anymore. The pending lines always
+        start outside of a code fence, because blocks are only finalized
+        outside of fences.
+        """
+        blocks = []
+        fence = None
+        block_start = 0
+        has_content = False
+        boundary = None
+        for i, line in enumerate(lines):
+            m = self._fence_pattern.match(line)
+            if m:
+                if fence is None:
+                    fence = m.group(1)
+                elif m.group(1) == fence:
+                    fence = None
+            if fence is None and not line.strip():
+                if i < stable and boundary is None and has_content:
+                    boundary = i
+            elif boundary is not None:
+                # Indented lines may continue the previous block, for example
+                # as a paragraph inside a list item.
+                if line[:1] in (' ', '\t'):
+                    boundary = None
+                else:
+                    blocks.append(lines[block_start:boundary])
+                    block_start = i
+                    boundary = None
+                    has_content = True
+            else:
+                has_content = True
+        return blocks, block_start
+
+    def update(self, text):
+        """Takes the full text that has been streamed so far and returns a
+        (start, blocks) tuple that describes the changes.
+        """
+        # Streamed text only grows. If it doesn't, we start from scratch.
+        if not text.startswith(self._text):
+            self.reset()
+        self._text = text
+        stable, pending = self._normalizer.update(text)
+        lines = stable[self._final_line:] + pending
+        final_blocks, consumed = self._split_final(
+            lines, len(stable) - self._final_line)
+        start = self._final_count
+        rendered = [html for html in map(self._render_block, final_blocks)
+                    if html is not None]
+        self._final_line += consumed
+        self._final_count += len(rendered)
+        tail = self._render_block(lines[consumed:])
+        if tail is not None:
+            rendered.append(tail)
+        return start, rendered
+
+
 class StreamReply(BaseReply):
     """Corresponds to a streaming text chunk sent during AI response
     generation. The front-end uses these to progressively display the
     response before the final Reply arrives.
+
+    If a StreamRenderer is provided, only the changed blocks are sent as a
+    delta. Otherwise, the full accumulated text is rendered and sent.
     """
-    def __init__(self, msg):
+    def __init__(self, msg, renderer: StreamRenderer = None):
         self.msg = msg
+        # The delta is computed right away, because the renderer is stateful
+        # and to_json() may be called more than once.
+        self.delta = None if renderer is None else renderer.update(msg)
 
     def to_json(self):
+        if self.delta is not None:
+            start, blocks = self.delta
+            return json.dumps(
+                {'stream_delta': {'start': start, 'blocks': blocks}})
         return json.dumps(
             {'stream': utils.md(
                 process_sigmund_message.process_ai_message(self.msg))})
+
+
+class StreamCoalescer:
+    """Coalesces streamed text into fewer StreamReply objects. Providers
+    stream text in small chunks, and every StreamReply is rendered and sent
+    to the client. A StreamReply is therefore only created for the first
+    chunk, and then when the interval (in seconds) has passed since the
+    previous one, or when enough new characters have been streamed. Text that
+    hasn't been sent yet is sent by flush().
+    """
+    def __init__(self, renderer: StreamRenderer = None, interval: float = None,
+                 chars: int = None):
+        self._renderer = renderer
+        self._interval = config.stream_coalesce_interval \
+            if interval is None else interval
+        self._chars = config.stream_coalesce_chars if chars is None else chars
+        self._text = None
+        self._sent_text = None
+        self._sent_time = None
+
+    def update(self, text: str) -> StreamReply | None:
+        """Takes the full text that has been streamed so far, and returns a
+        StreamReply, or None if the text should not be sent yet.
+        """
+        self._text = text
+        if self._sent_time is not None and \
+                time.monotonic() - self._sent_time < self._interval and \
+                len(text) - len(self._sent_text) < self._chars:
+            return None
+        return self.flush()
+
+    def flush(self) -> StreamReply | None:
+        """Returns a StreamReply for text that hasn't been sent yet, or None
+        if all text has been sent.
+        """
+        if self._text is None or self._text == self._sent_text:
+            return None
+        self._sent_text = self._text
+        self._sent_time = time.monotonic()
+        return StreamReply(self._text, renderer=self._renderer)
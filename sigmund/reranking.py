@@ -0,0 +1,131 @@
+"""Post-retrieval processing of library search results, so that the
+documentation that is included in the prompt is relevant, but not redundant,
+and stays within a length budget:
+
+- mmr() reranks results by maximal marginal relevance, so that
+  near-duplicate results are not all included
+- stitch_chunks() merges adjacent chunks of the same document
+- apply_budget() drops results that exceed the length budget
+"""
+import logging
+from typing import Any, Dict, List
+import numpy as np
+from . import config
+logger = logging.getLogger('sigmund')
+
+
+def mmr(results: List[Dict[str, Any]], k: int,
+        diversity: float = None) -> List[Dict[str, Any]]:
+    """Selects k results by maximal marginal relevance. Results should be
+    ordered by relevance, as returned by Library.search(), and have an
+    'embedding' field. Relevance is derived from the rank, so that the order
+    of hybrid (fused) searches is respected, and it is traded off against the
+    maximum cosine similarity with already selected results. The embedding
+    field is removed from the results.
+
+    Args:
+        results: The results, from most to least relevant
+        k: The number of results to select
+        diversity: Between 0 (relevance only) and 1 (diversity only).
+            Defaults to config.search_mmr_diversity.
+    """
+    if diversity is None:
+        diversity = config.search_mmr_diversity
+    # The embeddings are removed, so that they don't end up in the
+    # documentation
+    embeddings = [result.pop('embedding', None) for result in results]
+    if any(embedding is None for embedding in embeddings):
+        raise ValueError('results have no embeddings')
+    if len(results) <= k:
+        return results
+    embeddings = np.array(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.where(norms > 0, norms, 1)
+    similarities = embeddings @ embeddings.T
+    relevance = 1 - np.arange(len(results)) / len(results)
+    selection = [0]
+    # The maximum similarity of each result with the selected results
+    redundancy = similarities[0].copy()
+    candidates = np.ones(len(results), dtype=bool)
+    candidates[0] = False
+    while len(selection) < k:
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[~candidates] = -np.inf
+        best = int(np.argmax(scores))
+        selection.append(best)
+        candidates[best] = False
+        np.maximum(redundancy, similarities[best], out=redundancy)
+    return [results[i] for i in selection]
+
+
+def _strip_heading(content: str, heading: str) -> str:
+    """Removes a heading that is repeated at the start of each chunk."""
+    if heading.startswith('#') and content.startswith(heading):
+        return content[len(heading):].lstrip('\n')
+    return content
+
+
+def stitch_chunks(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merges results that are adjacent chunks of the same document (that
+    is, with the same path) into a single result, at the position of the
+    highest ranked chunk.
+    """
+    positions = {}
+    for i, result in enumerate(results):
+        if result.get('path') and result.get('chunk') is not None:
+            positions.setdefault(result['path'], []).append(i)
+    merged_into = {}
+    merged = {}
+    for path, indices in positions.items():
+        indices.sort(key=lambda i: results[i]['chunk'])
+        run = [indices[0]]
+        for i in indices[1:] + [None]:
+            if i is not None and \
+                    results[i]['chunk'] == results[run[-1]]['chunk'] + 1:
+                run.append(i)
+                continue
+            if len(run) > 1:
+                first = results[run[0]]
+                heading = first['content'].split('\n', 1)[0]
+                result = dict(first)
+                result['content'] = '\n\n'.join(
+                    [first['content'].rstrip('\n')] +
+                    [_strip_heading(results[j]['content'], heading)
+                     .rstrip('\n') for j in run[1:]])
+                position = min(run)
+                merged[position] = result
+                for j in run:
+                    merged_into[j] = position
+                logger.info(f'stitched chunks {results[run[0]]["chunk"]}-'
+                            f'{results[run[-1]]["chunk"]} of {path}')
+            run = [i]
+    stitched = []
+    for i, result in enumerate(results):
+        if i not in merged_into:
+            stitched.append(result)
+        elif merged_into[i] == i:
+            stitched.append(merged[i])
+    return stitched
+
+
+def apply_budget(results: List[Dict[str, Any]],
+                 max_length: int = None) -> List[Dict[str, Any]]:
+    """Keeps results, in order, as long as their total content length stays
+    within max_length characters. Results that don't fit are skipped, but
+    later, shorter results may still be included. The first result is always
+    kept.
+    """
+    if max_length is None:
+        max_length = config.search_max_documentation_length
+    if max_length is None:
+        return results
+    kept = []
+    length = 0
+    for result in results:
+        if kept and length + len(result['content']) > max_length:
+            logger.info(f'skipping document ({len(result["content"])} '
+                        f'characters) to stay within budget')
+            continue
+        kept.append(result)
+        length += len(result['content'])
+    return kept
@@ -1,11 +1,12 @@
 import logging
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Blueprint, abort, request
+from flask import Blueprint, abort, request, jsonify
 from flask_login import current_user
 from sqlalchemy import func
 
-from .. import config, utils
+from .. import config, utils, title_worker, embedding_cache, render_cache
+from ..model import _client_pool as client_pool
 from ..database.models import db, User, Activity, BufferActivity, Conversation, \
     Message, Subscription
 
@@ -193,4 +194,16 @@ def dashboard():
         # Subscriptions
         active_subscription_count=active_subscription_count,
         subscriber_rows=subscriber_rows,
-    )
\ No newline at end of file
+    )
+
+
+@admin_blueprint.route('/stats')
+@admin_required
+def stats():
+    """Returns process-level runtime statistics as JSON. These are specific to
+    the worker process that handles the request.
+    """
+    return jsonify(model_clients=client_pool.stats(),
+                   title_worker=title_worker.stats(),
+                   embedding_cache=embedding_cache.stats(),
+                   render_cache=render_cache.stats())
@@ -1,3 +1,4 @@
+import re
 import json
 import base64
 import mimetypes
@@ -6,9 +7,9 @@ from flask import request, jsonify, Response, redirect, session, \
     stream_with_context, make_response, Blueprint
 from werkzeug.exceptions import RequestEntityTooLarge
 from flask_login import login_required
-from .. import config
+from .. import config, stream_cancel, generation_worker
 from ..redis_client import redis_client
-from .app import get_sigmund
+from .app import get_sigmund, get_theme, render_message_history
 logger = logging.getLogger('sigmund')
 api_blueprint = Blueprint('api', __name__)
 
@@ -49,7 +50,7 @@ def api_chat_start():
     session['foundation_document_topics'] = foundation_document_topics
 
     sigmund = get_sigmund(transient_settings=transient_settings)
-    redis_client.delete(f'stream_cancel_{sigmund.user_id}')
+    stream_cancel.reset(sigmund.user_id)
 
     # Grab attached files from the request
     attachments = request.files.getlist('attachments')
@@ -81,12 +82,30 @@ def api_chat_start():
     # Save to Redis
     # Convert list of attachments to JSON first
     redis_client.set(f'attachments_{sigmund.user_id}', json.dumps(attachment_list))
+    # In generation-worker mode, the reply is generated by a worker process,
+    # and the stream route tails the events of the job
+    if config.generation_workers:
+        session['generation_job'] = generation_worker.submit(dict(
+            user_id=sigmund.user_id,
+            encryption_key=session['encryption_key'],
+            sigmund_kwargs=dict(
+                transient_settings=transient_settings,
+                transient_system_prompt=transient_system_prompt,
+                foundation_document_topics=foundation_document_topics),
+            message_kwargs=dict(
+                message=message,
+                workspace_content=workspace_content,
+                workspace_language=workspace_language,
+                message_id=message_id)))
+        return jsonify({'resumable': True})
     return '{}'
 
 
 @api_blueprint.route('/chat/stream', methods=['GET'])
 @login_required
 def api_chat_stream():
+    if config.generation_workers:
+        return _tail_generation_job()
 
     # Retrieve message details from session
     message = session.get('user_message', '')
@@ -108,15 +127,21 @@ def api_chat_stream():
 
     logger.info(f'starting stream for {sigmund.user_id}')
     def generate():
-        for reply in sigmund.send_user_message(
-                message, workspace_content, workspace_language,
-                attachments=attachments, message_id=message_id):
-            json_reply = reply.to_json()
-            logger.debug(f'ai message: {json_reply}')
-            yield f'data: {json_reply}\n\n'
-            if redis_client.get(f'stream_cancel_{sigmund.user_id}'):
-                logger.info(f'stream cancelled for {sigmund.user_id}')
-                break
+        # Cancellation sets a local flag, which is also checked by the model
+        # while streaming, so that the provider stream is closed right away
+        stream_cancel.watch(sigmund.user_id, sigmund.cancelled)
+        try:
+            for reply in sigmund.send_user_message(
+                    message, workspace_content, workspace_language,
+                    attachments=attachments, message_id=message_id):
+                json_reply = reply.to_json()
+                logger.debug(f'ai message: {json_reply}')
+                yield f'data: {json_reply}\n\n'
+                if sigmund.cancelled.is_set():
+                    logger.info(f'stream cancelled for {sigmund.user_id}')
+                    break
+        finally:
+            stream_cancel.unwatch(sigmund.user_id, sigmund.cancelled)
         yield 'data: {"action": "close"}\n\n'
 
     # Return a server-sent event response
@@ -124,12 +149,38 @@ def api_chat_stream():
                     mimetype='text/event-stream')
 
 
+def _tail_generation_job():
+    """Streams the replies of the generation job of the current session.
+    Browsers that reconnect send the id of the last event that they received,
+    and the stream resumes from there.
+    """
+    job_id = session.get('generation_job')
+    last_event_id = request.headers.get(
+        'Last-Event-ID', request.args.get('last_event_id', '0'))
+    if not re.fullmatch(r'\d+(-\d+)?', last_event_id):
+        return jsonify({'error': 'Invalid event id'}), 400
+
+    def generate():
+        if job_id is None:
+            yield 'data: {"action": "close"}\n\n'
+            return
+        for event_id, data in generation_worker.tail(job_id, last_event_id):
+            if data is None:
+                yield ': keep-alive\n\n'
+            elif event_id is None:
+                yield f'data: {data}\n\n'
+            else:
+                yield f'id: {event_id}\ndata: {data}\n\n'
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 @api_blueprint.route('/chat/cancel', methods=['POST'])
 @login_required
 def api_chat_cancel_stream():
     sigmund = get_sigmund()
     logger.info(f'cancelling stream for {sigmund.user_id}')
-    redis_client.set(f'stream_cancel_{sigmund.user_id}', '1')
+    stream_cancel.cancel(sigmund.user_id)
     return jsonify({'status': 'cancelled'}), 200
     
     
@@ -164,11 +215,60 @@ def activate_conversation(conversation_id):
 @api_blueprint.route('/conversation/list', methods=['GET'])
 @login_required
 def list_conversations():
+    """Lists conversations as a list of {id, title, last_updated,
+    message_count} objects. The offset and limit parameters can be used for
+    pagination. With a query, matching conversations are listed in ranked
+    order, and the objects also have snippet and score keys. Without a query,
+    the sort ('last_updated' or 'message_count') and order ('desc' or 'asc')
+    parameters can be used, and the total number of conversations is returned
+    in the X-Total-Count header.
+    """
     sigmund = get_sigmund()
     query = request.args.get('query', None)
-    return jsonify(sigmund.database.list_conversations(query))
+    if query:
+        return jsonify(sigmund.database.list_conversations(
+            query, offset=request.args.get('offset', 0, type=int),
+            limit=request.args.get('limit', None, type=int)))
+    try:
+        conversations = sigmund.database.list_conversations(
+            offset=request.args.get('offset', 0, type=int),
+            limit=request.args.get('limit', None, type=int),
+            sort=request.args.get('sort', 'last_updated'),
+            descending=request.args.get('order', 'desc') != 'asc')
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    response = jsonify(conversations)
+    response.headers['X-Total-Count'] = \
+        str(sigmund.database.count_conversations())
+    return response
     
 
+@api_blueprint.route('/conversation/messages', methods=['GET'])
+@login_required
+def conversation_messages():
+    """Returns a window of rendered messages from the active conversation, so
+    that earlier messages can be loaded as the user scrolls up. The before
+    parameter is the id of the oldest message that is already shown, and limit
+    is the number of messages. The response contains the HTML, the id to pass
+    as before for the next window, and whether there are earlier messages.
+    """
+    sigmund = get_sigmund()
+    before = request.args.get('before', None, type=int)
+    limit = min(request.args.get('limit', config.chat_history_window,
+                                 type=int),
+                config.chat_history_max_window)
+    if limit < 1:
+        return jsonify(success=False, message='Invalid limit'), 400
+    window = sigmund.database.get_message_window(before=before, limit=limit)
+    if window is None:
+        return jsonify(html='', before=None, has_more=False)
+    html_content, _, _ = render_message_history(
+        sigmund, [tuple(msg) for _, msg in window['messages']],
+        [row_id for row_id, _ in window['messages']], get_theme())
+    return jsonify(html=html_content, before=window['before'],
+                   has_more=window['has_more'])
+
+
 @api_blueprint.route('/conversation/delete/<int:conversation_id>',
                      methods=['DELETE'])
 @login_required
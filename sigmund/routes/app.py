@@ -1,6 +1,7 @@
 import json
 import base64
 from pathlib import Path
+from cryptography.fernet import InvalidToken
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
@@ -9,6 +10,7 @@ from flask_login import login_user, current_user, logout_user, UserMixin
 from .. import config
 from .. import utils
 from .. import process_sigmund_message
+from .. import render_cache
 from ..forms import LoginForm
 from ..sigmund import Sigmund
 import logging
@@ -29,6 +31,10 @@ def get_theme():
 def get_sigmund(db_cache='default', transient_settings=None,
                 transient_system_prompt=None,
                 foundation_document_topics=None):
+    """Returns a Sigmund instance for the current user. Subsystems are built
+    lazily, so routes that only use, for example, the database get a minimal
+    Sigmund that doesn't load the conversation, the library, or the models.
+    """
     config.db_cache = db_cache
     return Sigmund(user_id=current_user.get_id(), persistent=True,
                    encryption_key=session['encryption_key'],
@@ -37,29 +43,45 @@ def get_sigmund(db_cache='default', transient_settings=None,
                    foundation_document_topics=foundation_document_topics)
 
 
-def chat_page():
-    sigmund = get_sigmund()
-    if config.subscription_required and \
-            not sigmund.database.check_subscription():
-        return redirect(url_for('store.subscription_page'), code=303)
-    if sigmund.limits.suspended():
-        return redirect(url_for('app.suspended'), code=303)        
+def _render_message(role, message, metadata):
+    """Renders the body and the sources of a message. This is relatively
+    slow, and the result is therefore cached (see sigmund.render_cache).
+    """
+    if role == 'assistant':
+        body = utils.md(process_sigmund_message.process_ai_message(message))
+    else:
+        body = '<p>' + utils.clean(message, 
+                                   escape_html=True,
+                                   render=False) + '</p>'
+    if 'sources' in metadata:
+        sources_div = '<div class="message-sources">'
+        sources = json.loads(metadata['sources'])
+        urls = {source['url'] for source in sources if source['url']}
+        for url in urls:
+            sources_div += f'<a href="{url}">{url}</a><br />'
+        sources_div += '</div>'
+    else:
+        sources_div = ''
+    return {'body': body, 'sources': sources_div}
+
+
+def render_message_history(sigmund, messages, row_ids, theme):
+    """Renders a list of (role, message, metadata) tuples as HTML, and also
+    returns the workspace content and language of the last message.
+    """
     html_content = ''
     previous_timestamp = None
     previous_answer_model = None
     workspace_content = ''
     workspace_language = 'markdown'
-    for role, message, metadata in sigmund.messages.visible_messages():
+    rendered_messages = render_cache.render_messages(
+        sigmund, messages, row_ids, theme, _render_message)
+    for (role, message, metadata), rendered in zip(messages,
+                                                   rendered_messages):
         message_id = metadata.get('message_id', 0)
         delete_button = f'<button class="message-delete" onclick="deleteMessage(\'{message_id}\')"><i class="fas fa-trash"></i></button>'
-        if role == 'assistant':
-            html_body = utils.md(process_sigmund_message.process_ai_message(message))
-            html_class = 'message-ai'
-        else:
-            html_body = '<p>' + utils.clean(message, 
-                                            escape_html=True,
-                                            render=False) + '</p>'
-            html_class = 'message-user'
+        html_body = rendered['body']
+        html_class = 'message-ai' if role == 'assistant' else 'message-user'
         workspace_content = metadata.get('workspace_content', None)
         workspace_language = metadata.get('workspace_language', None)
         if workspace_content:
@@ -70,15 +92,7 @@ def chat_page():
                 </div>'''
         else:
             workspace_div = ''
-        if 'sources' in metadata:
-            sources_div = '<div class="message-sources">'
-            sources = json.loads(metadata['sources'])
-            urls = {source['url'] for source in sources if source['url']}
-            for url in urls:
-                sources_div += f'<a href="{url}">{url}</a><br />'
-            sources_div += '</div>'
-        else:
-            sources_div = ''
+        sources_div = rendered['sources']
         if previous_timestamp != metadata['timestamp']:
             previous_timestamp = metadata['timestamp']
             timestamp_div = f'<div class="message-timestamp">{metadata["timestamp"]}</div>'
@@ -91,6 +105,42 @@ def chat_page():
             answer_model_div = ''
 
         html_content += f'<div class="message {html_class}" data-message-id="{message_id}">{delete_button}{html_body}{workspace_div}{timestamp_div}{answer_model_div}{sources_div}</div>'
+    return html_content, workspace_content, workspace_language
+
+
+def chat_page():
+    sigmund = get_sigmund()
+    if config.subscription_required and \
+            not sigmund.database.check_subscription():
+        return redirect(url_for('store.subscription_page'), code=303)
+    if sigmund.limits.suspended():
+        return redirect(url_for('app.suspended'), code=303)        
+    theme = get_theme()
+    # Only the last messages are decrypted and rendered. Earlier messages are
+    # loaded through /api/conversation/messages.
+    try:
+        window = sigmund.database.get_message_window(
+            limit=config.chat_history_window)
+    except InvalidToken as e:
+        logger.error(f'failed to get message window: {e}')
+        window = None
+    if window and window['messages'] and all(
+            'message_id' in msg[2] for _, msg in window['messages']):
+        row_ids = [row_id for row_id, _ in window['messages']]
+        messages = [tuple(msg) for _, msg in window['messages']]
+        history_before = window['before']
+        history_has_more = window['has_more']
+    else:
+        # There is no active conversation yet, or it cannot be windowed. In
+        # that case, the full conversation is loaded, which also creates the
+        # welcome message and assigns ids to messages that don't have one.
+        rows = list(sigmund.messages.visible_rows())
+        row_ids = [row_id for row_id, _ in rows]
+        messages = [message for _, message in rows]
+        history_before = None
+        history_has_more = False
+    html_content, workspace_content, workspace_language = \
+        render_message_history(sigmund, messages, row_ids, theme)
     # The user's settings are the defaults updated with the user-specific 
     # settings from the database
     settings = config.settings_default.copy()
@@ -100,6 +150,8 @@ def chat_page():
         workspace_language = 'markdown'
     username = sigmund.username()
     return utils.render('chat.html', message_history=html_content,
+                        history_before=history_before,
+                        history_has_more=history_has_more,
                         subscription_required=config.subscription_required,
                         username=username,
                         need_login=False,
@@ -109,7 +161,7 @@ def chat_page():
                         usage=sigmund.limits.usage(),
                         weekly_credits_left=sigmund.limits.weekly_credits_left(),
                         extra_credits_left=sigmund.limits.extra_credits_left(),
-                        theme=get_theme())
+                        theme=theme)
 
 
 def login_handler(form, failed=False):
@@ -1,34 +1,57 @@
+import hashlib
+import json
 import logging
+import math
 from flask import jsonify, Blueprint, request, Response
 from flask_cors import cross_origin
-from .. import config, utils, prompt
-from ..sigmund import Sigmund
+from redis.exceptions import RedisError
+from .. import config, utils, prompt, rate_limit
+from ..documentation import Documentation
+from ..embedding_cache import normalize
+from ..model import model
+from ..redis_client import redis_client
 logger = logging.getLogger('sigmund')
 public_blueprint = Blueprint('public', __name__)
 
 
-@public_blueprint.route('/search', methods=['POST'])
-@cross_origin()
-def search():
-    data = request.json
-    query = data.get('query', None)
-    offset = data.get('offset', 0) * config.public_search_docs_max
-    source = data.get('source', 'default')
-    logger.info(f'public search source: {source}')
-    sigmund = Sigmund(user_id='dummy', persistent=False, encryption_key=None,
-                      model_config='mistral')
-    sigmund.documentation.clear()
-    sigmund.documentation._collections.add('opensesame')
-    if 'public-with-forum' in source:
-        sigmund.documentation._collections.add('forum')
-        logger.info('adding forum source for search')
-    sigmund.documentation.search(query, howtos=True, foundation=False,
-                                 k=config.public_search_docs_max + offset,
-                                 max_distance=float('inf'))
+def _client_address():
+    """The address of the client. When the app runs behind a proxy, this is
+    taken from the X-Forwarded-For header by ProxyFix, for the number of
+    proxies in config.flask_proxy_hops, so that clients cannot spoof it.
+    """
+    return request.remote_addr
+
+
+def _cache_key(query, collections, offset):
+    """Queries that differ only in case and whitespace share a cache entry."""
+    key = json.dumps([normalize(query).lower(), sorted(collections), offset])
+    return f'public_search_{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def _cache_get(key):
+    try:
+        cached = redis_client.get(key)
+    except RedisError as e:
+        logger.warning(f'failed to read public search cache: {e}')
+        return None
+    return json.loads(cached) if cached is not None else None
+
+
+def _cache_set(key, entry):
+    try:
+        redis_client.set(key, json.dumps(entry),
+                         ex=config.public_search_cache_ttl)
+    except RedisError as e:
+        logger.warning(f'failed to write public search cache: {e}')
+
+
+def _retrieve(documentation, query, offset):
+    documentation.search(query, howtos=True, foundation=False,
+                         k=config.public_search_docs_max + offset,
+                         max_distance=float('inf'), rerank=False)
     docs = []
     urls = []
-    logging.info(f'public search: {query} (offset={offset})')
-    for i, doc in enumerate(sigmund.documentation._documents[offset:]):
+    for i, doc in enumerate(documentation._documents[offset:]):
         url = doc.get('url')
         if not url:
             url = f'howto-{i}'
@@ -40,12 +63,60 @@ def search():
         docs.append(doc)
         if len(docs) >= config.public_search_docs_max:
             break
-    sigmund.documentation._documents = docs
+    return docs
+
+
+@public_blueprint.route('/search', methods=['POST'])
+@cross_origin()
+def search():
+    """Searches the documentation and summarizes the results. This is used
+    by the search widget, which is embedded in public websites. Therefore,
+    requests are rate-limited per client, and results are cached. No user is
+    involved, so the user database is not accessed.
+    """
+    client = _client_address()
+    allowed, retry_after = rate_limit.consume(
+        f'public_search_{client}', config.public_search_rate_limit_burst,
+        config.public_search_rate_limit_rate)
+    if not allowed:
+        logger.warning(f'public search rate limit exceeded for {client} '
+                       f'(origin: {request.headers.get("Origin")})')
+        response = jsonify(success=False, message='Too many requests')
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+    data = request.json
+    query = data.get('query', None)
+    if not isinstance(query, str) or not query.strip():
+        return jsonify(success=False, message='No query'), 400
+    offset = data.get('offset', 0) * config.public_search_docs_max
+    source = data.get('source', 'default')
+    logger.info(f'public search source: {source}')
+    collections = {'opensesame'}
+    if 'public-with-forum' in source:
+        collections.add('forum')
+        logger.info('adding forum source for search')
+    logging.info(f'public search: {query} (offset={offset})')
+    key = _cache_key(query, collections, offset)
+    cached = _cache_get(key) or {}
+    if 'results' in cached:
+        logger.info('public search results from cache')
+        return jsonify(results=cached['results'])
+    documentation = Documentation(None, collections=collections)
+    # Retrieved documents are cached separately, so that they are reused when
+    # the summary could not be generated
+    if 'documents' in cached:
+        docs = cached['documents']
+    else:
+        docs = _retrieve(documentation, query, offset)
+        _cache_set(key, {'documents': docs})
+    documentation._documents = docs
     logging.info(f'public search results: {len(docs)}')
     query = prompt.render(prompt.PUBLIC_SEARCH_PROMPT,
-                          documentation=sigmund.documentation)
-    results = utils.md(
-        sigmund.public_model.predict(query).replace('\n\n-', '\n-'))
+                          documentation=documentation)
+    public_model = model(None, config.model_config[
+        config.public_search_model_config]['public_model'])
+    results = utils.md(public_model.predict(query).replace('\n\n-', '\n-'))
+    _cache_set(key, {'documents': docs, 'results': results})
     return jsonify(results=results)
 
 
@@ -5,6 +5,7 @@ from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_session import Session
 from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.middleware.proxy_fix import ProxyFix
 from . import config
 from .redis_client import redis_client
 from .routes import api_blueprint, app_blueprint, User, store_blueprint, \
@@ -30,6 +31,9 @@ class SigmundConfig(Config):
 def create_app(config_class=SigmundConfig):
     app = Flask(__name__, static_url_path='/static')
     app.config.from_object(config_class)
+    if config.flask_proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.flask_proxy_hops,
+                                x_proto=config.flask_proxy_hops)
     # Initialize Flask-Session to activate Redis for session management
     Session(app)
     app.register_blueprint(app_blueprint)
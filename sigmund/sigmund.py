@@ -1,8 +1,10 @@
 import logging
 import json
+import threading
+from functools import cached_property
 from types import GeneratorType
 from . import config
-from .reply import Reply, ActionReply, StreamReply
+from .reply import Reply, ActionReply, StreamRenderer, StreamCoalescer
 from .documentation import Documentation
 from .messages import Messages
 from .model import model
@@ -39,44 +41,89 @@ class Sigmund:
                  transient_settings: dict = None,
                  transient_system_prompt: str = None,
                  foundation_document_topics: list = None):
+        # Subsystems are built lazily on first access (see the cached
+        # properties below), because many routes only need a few of them. For
+        # example, changing a setting should not load and decrypt the active
+        # conversation.
         self.user_id = user_id
-        self.database = DatabaseManager(self, user_id, encryption_key)
-        if transient_settings:
-            logger.info(f'using transient settings: {transient_settings}')
-            self.database.transient_settings = transient_settings
+        self._persistent = persistent
+        self._encryption_key = encryption_key
+        self._model_config_name = model_config
+        self._tool_names = tools
+        self._transient_settings = transient_settings
+        self._foundation_document_topics = foundation_document_topics
         self.transient_system_prompt = transient_system_prompt
+        # Set when the user cancels the reply that is being streamed (see
+        # stream_cancel.py)
+        self.cancelled = threading.Event()
+
+    @cached_property
+    def database(self):
+        database = DatabaseManager(self, self.user_id, self._encryption_key)
+        if self._transient_settings:
+            logger.info(f'using transient settings: {self._transient_settings}')
+            database.transient_settings = self._transient_settings
+        return database
+
+    @cached_property
+    def model_config(self):
         # Available model configs may change with updates, but the user settings
         # are not updated along with this. Therefore, if a model config doesn't
         # exist, we reset to the default.
+        model_config = self._model_config_name
         if model_config is None:
             model_config = self.database.get_setting('model_config')
         if model_config not in config.model_config:
             logger.warning(
                 f'model_config {model_config} not found, resetting to default')
             model_config = config.settings_default['model_config']
-            self.database.set_setting('model_config', model_config)        
-        self.model_config = config.model_config[model_config]
-        self.documentation = Documentation(
-            self, foundation_document_topics=foundation_document_topics)
-        self.messages = Messages(self, persistent)
+            self.database.set_setting('model_config', model_config)
+        return config.model_config[model_config]
+
+    @cached_property
+    def documentation(self):
+        return Documentation(
+            self, foundation_document_topics=self._foundation_document_topics)
+
+    @cached_property
+    def messages(self):
+        return Messages(self, self._persistent)
+
+    @cached_property
+    def tools(self):
+        tools = self._tool_names
         if tools is None:
             tools = [t for t in dir(tools_module)
                      if self.database.get_setting(f'tool_{t}') == 'true']
         # Tools are class names from the tools module, which need to be
         # instantiated with sigmund (self) as first argument
-        self.tools = [getattr(mod_tools, t)(self) for t in tools]
+        return [getattr(mod_tools, t)(self) for t in tools]
+
+    @cached_property
+    def answer_model(self):
         # If there are answer tools, the mode can choose freely
-        if tools:
+        if self.tools:
             tool_choice = 'auto'
         else:
             tool_choice = None
-        self.answer_model = model(self, self.model_config['answer_model'],
-                                  tools=self.tools,
-                                  tool_choice=tool_choice)
-        self.condense_model = model(self, self.model_config['condense_model'])
-        self.public_model = model(self, self.model_config['public_model'])
-        self.theme = self.database.get_setting('theme')
-        self.limits = LimitsChecker(self)
+        return model(self, self.model_config['answer_model'],
+                     tools=self.tools, tool_choice=tool_choice)
+
+    @cached_property
+    def condense_model(self):
+        return model(self, self.model_config['condense_model'])
+
+    @cached_property
+    def public_model(self):
+        return model(self, self.model_config['public_model'])
+
+    @cached_property
+    def theme(self):
+        return self.database.get_setting('theme')
+
+    @cached_property
+    def limits(self):
+        return LimitsChecker(self)
 
     def send_user_message(self, message: str, workspace_content: str = None,
                           workspace_language: str = 'text',
@@ -145,19 +192,30 @@ class Sigmund:
             logger.info(f'query length: {query_len}')
             query = '\n\n'.join(query_messages)
             query = query[:config.search_max_query_length]
-            for reply in self._search(query):
-                yield reply
+            # If the query hasn't changed materially since the previous search,
+            # for example in tool-feedback loops and short follow-ups, the
+            # previously retrieved documentation is reused.
+            query_embedding = self.documentation.embed(query)
+            if self.documentation.restore(self.messages.retrieval,
+                                          query_embedding):
+                logger.info('[search state] reusing previous documentation')
+            else:
+                for reply in self._search(query, query_embedding):
+                    yield reply
+                self.messages.retrieval = self.documentation.state(
+                    query_embedding)
         for reply in self._answer(attachments):
             yield reply
 
-    def _search(self, message: str) -> GeneratorType:
+    def _search(self, message: str,
+                query_embedding: list = None) -> GeneratorType:
         """Implements the documentation search phase."""
         yield ActionReply(f'{config.ai_name} is searching ')
         logger.info('[search state] entering')
         self.documentation.clear()
         # First seach based on the user question
         logger.info('[search state] searching based on user message')
-        self.documentation.search(message)
+        self.documentation.search(message, query_embedding=query_embedding)
         logger.info(
             f'[search state] {len(self.documentation._documents)} documents, {len(self.documentation)} characters')
 
@@ -172,10 +230,26 @@ class Sigmund:
                                            attachments=attachments,
                                            stream=True)
         # The stream may return incomplete chunks, which we yield as 
-        # StreamReply objects.
+        # StreamReply objects. Small chunks are coalesced, so that not every
+        # chunk is rendered and sent. In delta mode, a renderer keeps track of
+        # the blocks that have already been rendered and sent to the client.
+        renderer = StreamRenderer() if config.stream_delta else None
+        coalescer = StreamCoalescer(renderer)
         for reply, complete in stream:
             if not complete:
-                yield StreamReply(reply)
+                stream_reply = coalescer.update(reply)
+                if stream_reply is not None:
+                    yield stream_reply
+        # A cancelled reply is not stored. The model has already closed the
+        # stream and recorded the usage so far.
+        if self.cancelled.is_set():
+            logger.info(f'[{state} state] cancelled')
+            return
+        # Text that hasn't been sent yet is sent before a tool is run, or
+        # before the final reply
+        stream_reply = coalescer.flush()
+        if stream_reply is not None:
+            yield stream_reply
         if isinstance(reply, str) and self.documentation.poor_match:
             reply = '''<div class="message-info" markdown="1">Expert knowledge is enabled, but Sigmund was unable to find useful documentation to answer your question. To get a more useful answer:
 
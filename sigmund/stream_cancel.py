@@ -0,0 +1,101 @@
+"""Cancellation of streamed replies across processes. A stream is cancelled by
+publishing the user id on a Redis channel. Each process subscribes to this
+channel once, and a background thread sets a local flag (a threading.Event)
+for every stream of the cancelled user. Streams therefore check for
+cancellation without any I/O.
+
+Cancellations are also stored in Redis for a short while, because a stream
+that starts listening after a cancellation has been published would otherwise
+miss it.
+"""
+import logging
+import threading
+import time
+from redis.exceptions import RedisError
+from . import config
+from .redis_client import redis_client
+logger = logging.getLogger('sigmund')
+CHANNEL = 'stream_cancel'
+# A dict with user ids as keys and sets of threading.Event objects as values
+_events = {}
+_lock = threading.Lock()
+_listener = None
+
+
+def _key(user_id: str) -> str:
+    return f'stream_cancel_{user_id}'
+
+
+def _set(user_id: str):
+    with _lock:
+        events = list(_events.get(user_id, ()))
+    for event in events:
+        event.set()
+
+
+def _handle_message(message):
+    _set(message['data'].decode())
+
+
+def _handle_exception(e, pubsub, thread):
+    # The subscription is restored when the connection is back, so we only
+    # need to avoid retrying in a tight loop
+    logger.warning(f'stream-cancellation listener failed: {e}')
+    time.sleep(1)
+
+
+def _ensure_listener():
+    global _listener
+    with _lock:
+        if _listener is not None and _listener.is_alive():
+            return
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CHANNEL: _handle_message})
+        _listener = pubsub.run_in_thread(
+            sleep_time=config.stream_cancel_poll_interval, daemon=True,
+            exception_handler=_handle_exception)
+
+
+def watch(user_id: str, event: threading.Event):
+    """Sets the event when a stream of the user is cancelled, until unwatch()
+    is called. The event is set right away if the stream was cancelled
+    before.
+    """
+    with _lock:
+        _events.setdefault(user_id, set()).add(event)
+    try:
+        _ensure_listener()
+        if redis_client.get(_key(user_id)):
+            event.set()
+    except RedisError as e:
+        logger.warning(f'failed to listen for stream cancellation: {e}')
+
+
+def unwatch(user_id: str, event: threading.Event):
+    with _lock:
+        events = _events.get(user_id)
+        if events is None:
+            return
+        events.discard(event)
+        if not events:
+            del _events[user_id]
+
+
+def cancel(user_id: str):
+    """Cancels all streams of the user, in all processes. If Redis is not
+    available, only streams in this process are cancelled.
+    """
+    _set(user_id)
+    try:
+        redis_client.set(_key(user_id), '1', ex=config.stream_cancel_expiry)
+        redis_client.publish(CHANNEL, user_id)
+    except RedisError as e:
+        logger.warning(f'failed to publish stream cancellation: {e}')
+
+
+def reset(user_id: str):
+    """Forgets an earlier cancellation, so that a new stream can start."""
+    try:
+        redis_client.delete(_key(user_id))
+    except RedisError as e:
+        logger.warning(f'failed to reset stream cancellation: {e}')
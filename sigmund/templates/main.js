@@ -2,6 +2,8 @@
 let currentEventSource = null;
 let currentLoadingInterval = null;
 let currentLoadingMessageBox = null;
+// Whether earlier messages are being loaded
+let loadingEarlierMessages = false;
 
 function initMain(event) {
 
@@ -48,6 +50,12 @@ function initMain(event) {
     }
     // Scroll to bottom on page load so the most recent messages are visible
     scrollChatToBottom();
+    // Load earlier messages when scrolling to the top of the conversation
+    chatAreaDiv.addEventListener('scroll', function() {
+        if (chatAreaDiv.scrollTop < 100) {
+            loadEarlierMessages();
+        }
+    });
 
     // Initialize on load
     updateUsageBar();
@@ -300,6 +308,25 @@ function createAIMessageElement(data, metadata, forwardReplyToSocket) {
     return aiMessage;
 }
 
+function applyStreamDelta(delta) {
+    let streamingMsg = document.getElementById('streaming-message');
+    if (!streamingMsg) {
+        streamingMsg = document.createElement('div');
+        streamingMsg.id = 'streaming-message';
+        streamingMsg.className = 'message-ai message message-streaming';
+        responseDiv.appendChild(streamingMsg);
+    }
+    while (streamingMsg.children.length > delta.start) {
+        streamingMsg.lastElementChild.remove();
+    }
+    delta.blocks.forEach(html => {
+        const block = document.createElement('div');
+        block.className = 'stream-block';
+        block.innerHTML = html;
+        streamingMsg.appendChild(block);
+    });
+}
+
 function removeStreamingMessage() {
     const streamingMsg = document.getElementById('streaming-message');
     if (streamingMsg) {
@@ -445,13 +472,19 @@ async function sendMessage(
         return;
     }
 
+    // If replies are generated by a worker, the stream can be resumed after
+    // the connection is lost
+    const startData = await startResponse.json().catch(() => ({}));
+    const resumable = startData.resumable === true;
+
     // Start streaming
     currentEventSource = new EventSource('{{ server_url }}/api/chat/stream');
 
     currentEventSource.onmessage = function(event) {
         // console.log(event);
         const data = JSON.parse(event.data);
-        if (typeof data.stream === 'undefined') {
+        if (typeof data.stream === 'undefined' &&
+                typeof data.stream_delta === 'undefined') {
             console.log(data);
         }
 
@@ -459,6 +492,8 @@ async function sendMessage(
         if (typeof data.action !== 'undefined') {
             if (data.action == 'close') {
                 endStream();
+            } else if (data.action == 'error') {
+                handleStreamingError(loadingInfo, data.message);
             } else if (data.action == 'set_loading_indicator') {
                 loadingInfo.setBaseMessage(data.message);
                 scrollChatToBottom();
@@ -480,6 +515,14 @@ async function sendMessage(
             return;
         }
 
+        // Handle streaming deltas. All blocks from the start index onwards
+        // are replaced by the blocks in the delta.
+        if (typeof data.stream_delta !== 'undefined') {
+            applyStreamDelta(data.stream_delta);
+            scrollChatToBottom();
+            return;
+        }
+
         // Handle final AI message
         removeLoadingIndicator(loadingInfo);
         const metadata = data.metadata;
@@ -507,6 +550,13 @@ async function sendMessage(
     };
 
     currentEventSource.onerror = function(event) {
+        // The browser reconnects resumable streams by itself, and sends the
+        // id of the last event that it received
+        if (resumable &&
+                currentEventSource.readyState === EventSource.CONNECTING) {
+            console.log('Stream interrupted, reconnecting');
+            return;
+        }
         handleStreamingError(loadingInfo, event);
     };
 
@@ -531,6 +581,35 @@ function deleteMessage(messageId) {
     }).catch(error => console.error('Error deleting message:', error));
 }
 
+function loadEarlierMessages() {
+    // Earlier messages are loaded in windows. The id of the oldest message
+    // that is shown is stored in the data-before attribute of the response
+    // div, and the load-earlier link is removed when there are no more
+    // messages.
+    const loadEarlierDiv = document.getElementById('load-earlier');
+    if (!loadEarlierDiv || loadingEarlierMessages) {
+        return;
+    }
+    loadingEarlierMessages = true;
+    fetch(`/api/conversation/messages?before=${responseDiv.dataset.before}`)
+    .then(response => response.json())
+    .then(data => {
+        // Keep the scroll position, so that the messages that were shown
+        // don't move
+        const scrollHeight = chatAreaDiv.scrollHeight;
+        responseDiv.insertAdjacentHTML('afterbegin', data.html);
+        chatAreaDiv.scrollTop += chatAreaDiv.scrollHeight - scrollHeight;
+        responseDiv.dataset.before = data.before;
+        if (!data.has_more) {
+            loadEarlierDiv.remove();
+        }
+    })
+    .catch(error => console.error('Error loading earlier messages:', error))
+    .finally(() => {
+        loadingEarlierMessages = false;
+    });
+}
+
 function requestBody(message, workspace_content, workspace_language, user_message_id) {
     return JSON.stringify({
         message: message,
@@ -0,0 +1,139 @@
+"""A bounded background worker for generating conversation titles. Titles are
+generated by a model, which can take several seconds, and we don't want to
+block the conversation while this happens. Jobs are run by a small, fixed
+number of threads that take jobs from a bounded queue. Jobs are deduplicated per
+conversation, so that a conversation never has more than one pending title job.
+"""
+import logging
+import queue
+import threading
+from flask import current_app, has_app_context
+from . import config
+logger = logging.getLogger('sigmund')
+
+
+class TitleWorker:
+    """Runs title jobs in a fixed number of daemon threads.
+
+    Parameters
+    ----------
+    workers : int
+        The number of worker threads.
+    max_queue_size : int
+        The maximum number of jobs that wait to be run. Jobs that are submitted
+        while the queue is full are dropped.
+    """
+    def __init__(self, workers: int, max_queue_size: int):
+        self._workers = workers
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        # The keys of conversations that have a queued or running job
+        self._pending = set()
+        self._running = 0
+        self._counts = {'submitted': 0, 'deduplicated': 0, 'dropped': 0,
+                        'completed': 0, 'failed': 0}
+        self._threads = []
+
+    def submit(self, key, job: callable) -> bool:
+        """Submits a job, unless a job with the same key is already queued or
+        running, or the queue is full. If the job is submitted from within a
+        Flask app context, it is also run within that app's context.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the conversation.
+        job : callable
+            A function without arguments.
+
+        Returns
+        -------
+        bool
+            True if the job was queued, False otherwise.
+        """
+        app = current_app._get_current_object() if has_app_context() else None
+        with self._lock:
+            if key in self._pending:
+                self._counts['deduplicated'] += 1
+                return False
+            try:
+                self._queue.put_nowait((key, app, job))
+            except queue.Full:
+                self._counts['dropped'] += 1
+                logger.warning('title queue is full, dropping job')
+                return False
+            self._pending.add(key)
+            self._counts['submitted'] += 1
+            self._start_threads()
+        return True
+
+    def join(self):
+        """Blocks until all queued jobs have been run."""
+        self._queue.join()
+
+    def stats(self) -> dict:
+        """Returns queue-depth and throughput statistics."""
+        with self._lock:
+            return dict(queued=self._queue.qsize(),
+                        running=self._running,
+                        workers=self._workers,
+                        max_queue_size=self._queue.maxsize,
+                        **self._counts)
+
+    def _start_threads(self):
+        # Threads are started when the first job is submitted, so that
+        # importing this module (for example in a forked worker process) has
+        # no side effects. This is called while holding the lock.
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name=f'title-worker-{len(self._threads)}')
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            key, app, job = self._queue.get()
+            with self._lock:
+                self._running += 1
+            succeeded = False
+            try:
+                if app is None:
+                    job()
+                else:
+                    with app.app_context():
+                        job()
+                succeeded = True
+            except Exception as e:
+                logger.error(f'title job failed: {e}')
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending.discard(key)
+                    self._counts['completed' if succeeded else 'failed'] += 1
+                self._queue.task_done()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker() -> TitleWorker:
+    """Returns the title worker of this process, creating it if necessary."""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = TitleWorker(config.title_workers,
+                                  config.title_queue_size)
+        return _worker
+
+
+def submit(key, job: callable) -> bool:
+    """Submits a job to the title worker of this process. See
+    TitleWorker.submit().
+    """
+    return get_worker().submit(key, job)
+
+
+def stats() -> dict:
+    """Returns statistics for the title worker of this process."""
+    return get_worker().stats()
@@ -0,0 +1,176 @@
+"""Usage accounting with sliding-window counters in Redis. Checking usage
+limits used to mean summing the activity table over the past hour and the past
+week, several times per chat turn. Instead, token usage is also counted in
+Redis, in per-minute buckets (for the hourly window) and per-hour buckets (for
+the weekly window), which expire by themselves once they fall outside of the
+window. A window sum then takes a single MGET of a fixed number of buckets.
+
+The activity table remains the durable ledger. The counters are periodically
+rebuilt from it, and also when they are missing, for example after Redis has
+been restarted. If Redis is unavailable, the ledger is queried directly.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+from redis.exceptions import RedisError
+from . import config
+from .redis_client import redis_client
+logger = logging.getLogger('sigmund')
+MINUTE = 60
+HOUR = 3600
+
+
+class UsageCounter:
+    """Counts the token usage of a single user.
+
+    Parameters
+    ----------
+    database : DatabaseManager
+        The database of the user, which provides access to the ledger.
+    """
+    def __init__(self, database):
+        self._db = database
+        self._prefix = f'usage_{database.user_id}'
+
+    def add(self, tokens: int):
+        """Counts tokens that have just been added to the ledger."""
+        if not config.usage_counters:
+            return
+        try:
+            # If the counters have just been rebuilt from the ledger, then
+            # they already include these tokens
+            if self._reconcile_if_needed():
+                return
+            now = time.time()
+            minute_key = self._minute_key(int(now // MINUTE))
+            hour_key = self._hour_key(int(now // HOUR))
+            pipe = redis_client.pipeline()
+            pipe.incrby(minute_key, tokens)
+            pipe.expire(minute_key, self._minute_ttl())
+            pipe.incrby(hour_key, tokens)
+            pipe.expire(hour_key, self._hour_ttl())
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f'failed to count usage: {e}')
+
+    def hourly(self) -> int:
+        """Returns the number of tokens consumed in the past hour."""
+        if config.usage_counters:
+            try:
+                self._reconcile_if_needed()
+                return self._sum(self._minute_key,
+                                 int(time.time() // MINUTE), HOUR // MINUTE)
+            except RedisError as e:
+                logger.warning(f'failed to read hourly usage: {e}')
+        return self._db.get_activity(time_delta={'hours': 1})
+
+    def weekly(self) -> int:
+        """Returns the number of tokens consumed in the weekly range."""
+        if config.usage_counters:
+            try:
+                self._reconcile_if_needed()
+                return self._sum(self._hour_key, int(time.time() // HOUR),
+                                 self._weekly_hours())
+            except RedisError as e:
+                logger.warning(f'failed to read weekly usage: {e}')
+        return self._db.get_activity(
+            time_delta={'days': config.weekly_token_range})
+
+    def buffer(self) -> int:
+        """Returns the activity buffer balance. The balance is cached until it
+        changes, or until the reconciliation interval has passed.
+        """
+        if config.usage_counters:
+            try:
+                balance = redis_client.get(self._buffer_key())
+                if balance is not None:
+                    return int(balance)
+                balance = self._db.get_activity_buffer()
+                redis_client.set(self._buffer_key(), balance,
+                                 ex=config.usage_reconcile_interval)
+                return balance
+            except RedisError as e:
+                logger.warning(f'failed to read activity buffer: {e}')
+        return self._db.get_activity_buffer()
+
+    def invalidate_buffer(self):
+        """Should be called when the activity buffer changes."""
+        try:
+            redis_client.delete(self._buffer_key())
+        except RedisError as e:
+            logger.warning(f'failed to invalidate activity buffer: {e}')
+
+    def reconcile(self):
+        """Rebuilds the counters from the ledger. Increments that happen while
+        the counters are being rebuilt may be lost, but they are restored by
+        the next reconciliation.
+        """
+        logger.info(f'reconciling usage counters for user {self._db.user_id}')
+        now = time.time()
+        current_minute = int(now // MINUTE)
+        current_hour = int(now // HOUR)
+        weekly_hours = self._weekly_hours()
+        minutes = dict.fromkeys(
+            range(current_minute - HOUR // MINUTE + 1, current_minute + 1), 0)
+        hours = dict.fromkeys(
+            range(current_hour - weekly_hours + 1, current_hour + 1), 0)
+        # The ledger stores naive UTC datetimes
+        since = datetime.utcnow() - timedelta(hours=weekly_hours)
+        for activity_time, tokens in self._db.get_activity_log(since):
+            timestamp = (activity_time - datetime(1970, 1, 1)).total_seconds()
+            if int(timestamp // HOUR) in hours:
+                hours[int(timestamp // HOUR)] += tokens
+            if int(timestamp // MINUTE) in minutes:
+                minutes[int(timestamp // MINUTE)] += tokens
+        pipe = redis_client.pipeline()
+        for minute, tokens in minutes.items():
+            pipe.set(self._minute_key(minute), tokens,
+                     ex=self._minute_ttl())
+        for hour, tokens in hours.items():
+            pipe.set(self._hour_key(hour), tokens, ex=self._hour_ttl())
+        pipe.delete(self._buffer_key())
+        pipe.execute()
+
+    def _reconcile_if_needed(self) -> bool:
+        """Rebuilds the counters if they haven't been rebuilt during the
+        reconciliation interval. The marker key is set atomically, so that
+        only one process rebuilds the counters. Returns True if the counters
+        have been rebuilt.
+        """
+        if not redis_client.set(self._reconciled_key(), 1, nx=True,
+                                ex=config.usage_reconcile_interval):
+            return False
+        try:
+            self.reconcile()
+        except Exception:
+            # Make sure that the next call tries again
+            redis_client.delete(self._reconciled_key())
+            raise
+        return True
+
+    def _sum(self, key_func, current: int, n: int) -> int:
+        values = redis_client.mget(
+            [key_func(bucket) for bucket in range(current - n + 1,
+                                                  current + 1)])
+        return sum(int(value) for value in values if value is not None)
+
+    def _weekly_hours(self) -> int:
+        return int(config.weekly_token_range * 24)
+
+    def _minute_ttl(self) -> int:
+        return HOUR + MINUTE
+
+    def _hour_ttl(self) -> int:
+        return (self._weekly_hours() + 1) * HOUR
+
+    def _minute_key(self, minute: int) -> str:
+        return f'{self._prefix}_m_{minute}'
+
+    def _hour_key(self, hour: int) -> str:
+        return f'{self._prefix}_h_{hour}'
+
+    def _buffer_key(self) -> str:
+        return f'{self._prefix}_buffer'
+
+    def _reconciled_key(self) -> str:
+        return f'{self._prefix}_reconciled'
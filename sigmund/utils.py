@@ -3,28 +3,90 @@ import logging
 import time
 import re
 import base64
+import functools
+import threading
 from io import BytesIO
 from flask import render_template, render_template_string
 import markdown
+from markdown.extensions import codehilite
 from markdown.extensions.fenced_code import FencedCodeExtension
 from markdown.extensions.codehilite import CodeHiliteExtension
 from markdown.extensions.toc import TocExtension
 from markdown.extensions.attr_list import AttrListExtension
 from markdown.extensions.md_in_html import MarkdownInHtmlExtension
 from markdown.extensions.tables import TableExtension
+from pygments.formatters import get_formatter_by_name
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
 from . import config
 from . import __version__
 logger = logging.getLogger('sigmund')
+# Each thread has its own Markdown instance, because instances are not
+# thread-safe. Instances are reset after each use.
+_markdown = threading.local()
+
+
+def _hashable_options(options: dict) -> tuple:
+    return tuple(sorted((key, tuple(value) if isinstance(value, list)
+                         else value) for key, value in options.items()))
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_lexer(alias: str, options: tuple):
+    try:
+        return get_lexer_by_name(alias, **dict(options))
+    except ClassNotFound as e:
+        # Unknown languages are also cached, because they are looked up in
+        # all lexers
+        return e
+
+
+def _get_lexer_by_name(alias, **options):
+    """A cached version of pygments.lexers.get_lexer_by_name(). Lexers don't
+    change when they are used, and can therefore be shared.
+    """
+    lexer = _cached_lexer(alias, _hashable_options(options))
+    if isinstance(lexer, ClassNotFound):
+        raise ClassNotFound(str(lexer))
+    return lexer
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_formatter(options: tuple):
+    return get_formatter_by_name('html', **dict(options))
+
+
+def _get_formatter(lang_str=None, **options):
+    """Returns a cached HTML formatter. This is passed to CodeHilite as the
+    pygments_formatter, which is called with the language as lang_str.
+    Creating a formatter is relatively slow, because it builds a stylesheet.
+    """
+    return _cached_formatter(_hashable_options(options))
+
+
+# CodeHilite, which is also used by FencedCode, looks up a lexer for each code
+# block
+codehilite.get_lexer_by_name = _get_lexer_by_name
+
+
+def _create_markdown():
+    return markdown.Markdown(
+        extensions=[FencedCodeExtension(),
+                    CodeHiliteExtension(pygments_formatter=_get_formatter),
+                    TocExtension(),
+                    AttrListExtension(),
+                    MarkdownInHtmlExtension(),
+                    TableExtension()])
 
 
 def md(text):
-    return markdown.markdown(text,
-                             extensions=[FencedCodeExtension(),
-                                         CodeHiliteExtension(),
-                                         TocExtension(),
-                                         AttrListExtension(),
-                                         MarkdownInHtmlExtension(),
-                                         TableExtension()])
+    renderer = getattr(_markdown, 'renderer', None)
+    if renderer is None:
+        renderer = _markdown.renderer = _create_markdown()
+    try:
+        return renderer.convert(text)
+    finally:
+        renderer.reset()
 
 
 def clean(text, escape_html=True, render=True):
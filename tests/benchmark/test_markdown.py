@@ -0,0 +1,75 @@
+"""Measures how many assistant messages per second can be rendered as HTML.
+Run with: pytest -s tests/benchmark/test_markdown.py
+"""
+import time
+import markdown
+from sigmund import utils
+from sigmund.process_sigmund_message import process_ai_message
+
+MESSAGES = [
+    '''To collect keyboard responses in OpenSesame, use a `keyboard_response`
+item. You can set the allowed responses in the item controls:
+
+1. Add a keyboard_response item to your sequence
+2. Set *Allowed responses* to `z;m`
+3. Set a *Timeout*, for example 2000 ms
+
+The response is then stored in the `response` variable.''',
+    '''Here is how you can compute the mean response time per condition with
+DataMatrix:
+
+```python
+from datamatrix import operations as ops, functional as fnc
+dm = io.readtxt('data.csv')
+for cond, cdm in ops.split(dm.condition):
+    print(f'{cond}: {cdm.response_time.mean:.2f} ms')
+```
+
+| condition | mean RT |
+|-----------|---------|
+| congruent | 512 |
+| incongruent | 568 |
+
+Let me know if you want to add error bars!''',
+    '''# Summary
+
+- **Stroop effect**: responses are slower on incongruent trials
+- **Data**: 40 participants, 120 trials each
+
+## Analysis
+
+```r
+library(lme4)
+m <- lmer(rt ~ condition + (1 | subject), data = df)
+summary(m)
+```
+
+See the [documentation](https://osdoc.cogsci.nl) for more.''',
+]
+
+
+def _throughput(render, messages, duration=1):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for message in messages:
+            render(message)
+        n += len(messages)
+    return n / (time.perf_counter() - start)
+
+
+def _render_without_pool(text):
+    return markdown.markdown(
+        text, extensions=['fenced_code', 'codehilite', 'toc', 'attr_list',
+                          'md_in_html', 'tables'])
+
+
+def test_markdown_throughput():
+    messages = [process_ai_message(message) for message in MESSAGES]
+    for message in messages:
+        assert utils.md(message) == _render_without_pool(message)
+    pooled = _throughput(utils.md, messages)
+    unpooled = _throughput(_render_without_pool, messages)
+    print(f'\npooled renderer: {pooled:.0f} renders/s')
+    print(f'new renderer per message: {unpooled:.0f} renders/s')
+    assert pooled > unpooled
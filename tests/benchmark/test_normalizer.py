@@ -0,0 +1,108 @@
+"""Measures how many assistant messages per second can be normalized by the
+single-pass MessageNormalizer, compared to the chain of regular expressions
+that process_ai_message() used before, both for complete messages and for
+messages that are streamed in chunks.
+Run with: pytest -s tests/benchmark/test_normalizer.py
+"""
+import time
+from sigmund import process_sigmund_message as psm
+from sigmund.process_sigmund_message import MessageNormalizer
+
+MESSAGES = [
+    '''To collect keyboard responses in OpenSesame, you have two options:
+1) Use a keyboard_response item
+2) Use a Python inline_script
+
+For the first option:
+  - Add a keyboard_response item to your sequence
+  - Set *Allowed responses* to `z;m`
+  - Set a *Timeout*, for example 2000 ms
+
+The response is then stored in the `response` variable.''',
+    '''Here is how you can compute the mean response time per condition:
+
+    ```python
+    from datamatrix import operations as ops
+    dm = io.readtxt('data.csv')
+    for cond, cdm in ops.split(dm.condition):
+        print(f'{cond}: {cdm.response_time.mean:.2f} ms')
+    ```
+
+• The <b>congruent</b> condition is faster
+• The <b>incongruent</b> condition is slower''',
+    '''------------------------------
+Summary
+------------------------------
+
+Key points:
+ 1. **Stroop effect**: responses are slower on incongruent trials
+ 2. **Data**: 40 participants, 120 trials each
+     - 20 in the first session
+     - 20 in the second session
+
+<div class="thinking_block_content">Let me think about this.</div>
+See the [documentation](https://osdoc.cogsci.nl) for more.''',
+]
+# A long message, as in a long answer
+LONG_MESSAGE = '\n\n'.join(MESSAGES * 10)
+CHUNK_SIZE = 20
+
+
+def _regex_chain(msg):
+    """The pipeline that process_ai_message() used before the single-pass
+    normalizer.
+    """
+    msg = psm.normalize_bullet_points(msg)
+    msg = psm.replace_round_bracket_with_dot(msg)
+    msg = psm.fix_indentation_after_colon(msg)
+    msg = psm.add_blank_line_after_colon_headers(msg)
+    if msg and not msg[0].isalpha():
+        msg = '\n\n' + msg
+    msg = psm.dedent_code_blocks(msg)
+    msg = psm.fix_markdown_headings(msg)
+    for i in range(1, 13):
+        msg = getattr(psm, f'fix_list_formatting_{i}')(msg)
+    return psm.escape_html_tags(msg)
+
+
+def _normalize(msg):
+    return MessageNormalizer().normalize(msg)
+
+
+def _stream_regex_chain(msg):
+    for end in range(CHUNK_SIZE, len(msg) + CHUNK_SIZE, CHUNK_SIZE):
+        _regex_chain(msg[:end])
+
+
+def _stream_normalizer(msg):
+    normalizer = MessageNormalizer()
+    for end in range(CHUNK_SIZE, len(msg) + CHUNK_SIZE, CHUNK_SIZE):
+        normalizer.update(msg[:end])
+
+
+def _throughput(normalize, messages, duration=1):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for message in messages:
+            normalize(message)
+        n += len(messages)
+    return n / (time.perf_counter() - start)
+
+
+def test_normalizer_throughput():
+    for message in MESSAGES:
+        assert _normalize(message) == _regex_chain(message) or \
+            '```' in message
+    single_pass = _throughput(_normalize, MESSAGES)
+    regex_chain = _throughput(_regex_chain, MESSAGES)
+    print(f'\nsingle-pass normalizer: {single_pass:.0f} messages/s')
+    print(f'regex chain: {regex_chain:.0f} messages/s')
+
+
+def test_streamed_normalizer_throughput():
+    single_pass = _throughput(_stream_normalizer, [LONG_MESSAGE])
+    regex_chain = _throughput(_stream_regex_chain, [LONG_MESSAGE])
+    print(f'\nincremental normalizer: {single_pass:.2f} streamed messages/s')
+    print(f'regex chain on every chunk: {regex_chain:.2f} streamed messages/s')
+    assert single_pass > regex_chain
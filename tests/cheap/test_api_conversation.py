@@ -43,7 +43,8 @@ class TestApiConversation(BaseRoutesTestCase):
             pass        
         self.client.get('/api/conversation/new', follow_redirects=True)
         list_resp = self.client.get('/api/conversation/list')
-        conversation_id = list(list_resp.json)[0]
+        # The first conversation is the active one
+        conversation_id = list_resp.json[-1]['id']
         original_count = len(list_resp.json)
         # Delete the conversation
         delete_resp = self.client.delete(
@@ -56,12 +57,77 @@ class TestApiConversation(BaseRoutesTestCase):
 
     def test_activate_conversation(self):
         list_resp = self.client.get('/api/conversation/list')
-        conversation_id = list(list_resp.json)[0]
+        conversation_id = list_resp.json[0]['id']
         activate_resp = self.client.get(
             f'/api/conversation/activate/{conversation_id}',
             follow_redirects=True)
         self.assertEqual(activate_resp.status_code, 200)
-        
+
+    def test_list_conversations_paginated(self):
+        for i in range(3):
+            self.client.post('/api/chat/start', data={'message': 'dummy'})
+            for response in self.client.get('/api/chat/stream').iter_encoded():
+                pass
+            self.client.get('/api/conversation/new', follow_redirects=True)
+        list_resp = self.client.get('/api/conversation/list')
+        total = int(list_resp.headers['X-Total-Count'])
+        self.assertEqual(total, len(list_resp.json))
+        page_resp = self.client.get('/api/conversation/list?offset=1&limit=2')
+        self.assertEqual(len(page_resp.json), 2)
+        self.assertEqual(int(page_resp.headers['X-Total-Count']), total)
+        self.assertEqual([c['id'] for c in page_resp.json],
+                         [c['id'] for c in list_resp.json][1:3])
+        # The order is preserved, also when it isn't the order of the ids
+        asc_resp = self.client.get('/api/conversation/list?order=asc')
+        self.assertEqual([c['last_updated'] for c in asc_resp.json],
+                         sorted(c['last_updated'] for c in list_resp.json))
+        bad_resp = self.client.get('/api/conversation/list?sort=title')
+        self.assertEqual(bad_resp.status_code, 400)
+
+    def test_search_conversations(self):
+        self.client.get('/api/conversation/new', follow_redirects=True)
+        self.client.post('/api/chat/start',
+                         data={'message': 'Plotting a histogram'})
+        for response in self.client.get('/api/chat/stream').iter_encoded():
+            pass
+        list_resp = self.client.get('/api/conversation/list?query=histogram')
+        self.assertEqual(len(list_resp.json), 1)
+        result = list_resp.json[0]
+        self.assertIn('<mark>histogram</mark>', result['snippet'])
+        self.assertGreater(result['score'], 0)
+        self.assertEqual(result['message_count'], 3)
+        list_resp = self.client.get('/api/conversation/list?query=xyzzy')
+        self.assertEqual(len(list_resp.json), 0)
+
+    def test_conversation_messages(self):
+        self.client.get('/api/conversation/new', follow_redirects=True)
+        for i in range(3):
+            self.client.post('/api/chat/start',
+                             data={'message': f'message {i}'})
+            for response in self.client.get('/api/chat/stream').iter_encoded():
+                pass
+        # The last messages are shown when the chat page is opened
+        page = self.client.get('/chat').text
+        self.assertIn('message 2', page)
+        # Earlier messages are loaded in windows, from newest to oldest
+        windows = []
+        before = ''
+        while True:
+            window = self.client.get(
+                f'/api/conversation/messages?before={before}&limit=2').json
+            windows.append(window['html'])
+            if not window['has_more']:
+                break
+            self.assertEqual(window['html'].count('class="message '), 2)
+            before = window['before']
+        html = ''.join(reversed(windows))
+        # The welcome message, and three user messages with their replies
+        self.assertEqual(html.count('class="message '), 7)
+        self.assertLess(html.index('message 0'), html.index('message 2'))
+        self.assertIn(config.welcome_message, windows[-1])
+        bad_resp = self.client.get('/api/conversation/messages?limit=0')
+        self.assertEqual(bad_resp.status_code, 400)
+
     def test_update_conversation_title(self):
         self.client.get('/api/conversation/new', follow_redirects=True)
         for i in range(2):
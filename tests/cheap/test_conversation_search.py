@@ -0,0 +1,43 @@
+from .test_app import BaseRoutesTestCase
+from sigmund.database.manager import DatabaseManager
+
+
+class TestConversationSearch(BaseRoutesTestCase):
+
+    def _add_conversation(self, database, title, message):
+        database.new_conversation()
+        conversation_data = database.get_active_conversation()
+        conversation_data['title'] = title
+        conversation_data['message_history'] = [
+            ['user', message, None], ['ai', 'A reply', None]]
+        database.update_active_conversation(conversation_data)
+        return database._get_user().active_conversation_id
+
+    def test_search_conversation_titles(self):
+        database = DatabaseManager(None, 'conversation-search-test')
+        first_id = self._add_conversation(database, 'Bayesian statistics',
+                                          'How do priors work?')
+        self._add_conversation(database, 'Statistics homework',
+                               'Help me with my homework')
+        self._add_conversation(database, 'Plotting', 'Statistics with plots')
+        # Title words are indexed, and title matches are ranked first
+        results = database.list_conversations('bayesian')
+        self.assertEqual([result['id'] for result in results], [first_id])
+        self.assertEqual(results[0]['title'], 'Bayesian statistics')
+        results = database.list_conversations('statistics')
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[-1]['title'], 'Plotting')
+        # Titles are decrypted only for the returned conversations
+        decrypted = []
+        decrypt_title = database._decrypt_title
+        database._decrypt_title = \
+            lambda header: decrypted.append(header) or decrypt_title(header)
+        self.assertEqual(
+            len(database.list_conversations('statistics', limit=1)), 1)
+        self.assertEqual(len(decrypted), 1)
+        del database._decrypt_title
+        # The title is re-indexed when it changes
+        database.set_conversation_title(first_id, 'Frequentist statistics')
+        self.assertEqual(database.list_conversations('bayesian'), [])
+        results = database.list_conversations('frequentist')
+        self.assertEqual([result['id'] for result in results], [first_id])
@@ -0,0 +1,34 @@
+from sigmund import config, embedding_cache
+
+
+class CountingEmbeddingFunction:
+    """Returns a fixed-size embedding based on the text length, and counts the
+    number of calls.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, texts):
+        self.calls += 1
+        return [[float(len(text)), 1.0, -1.0] for text in texts]
+
+
+def test_embedding_cache(monkeypatch):
+    monkeypatch.setattr(config, 'search_embedding_cache_ttl', None)
+    monkeypatch.setattr(config, 'search_embedding_cache_size', 2)
+    embedding_cache.clear()
+    embedding_function = CountingEmbeddingFunction()
+    embedding = embedding_cache.embed('a query', 'model', embedding_function)
+    assert embedding == [7.0, 1.0, -1.0]
+    # Whitespace differences don't matter, but the model does
+    assert embedding_cache.embed('  a\nquery ', 'model',
+                                 embedding_function) == embedding
+    assert embedding_function.calls == 1
+    embedding_cache.embed('a query', 'other-model', embedding_function)
+    assert embedding_function.calls == 2
+    # The cache holds two embeddings, so the least recently used one is
+    # evicted
+    embedding_cache.embed('another query', 'model', embedding_function)
+    embedding_cache.embed('a query', 'model', embedding_function)
+    assert embedding_function.calls == 4
+    embedding_cache.clear()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from sigmund import embedding_cache
+from sigmund.embedding_providers import get_embedding_function, \
+    HashingEmbeddingFunction, LocalEmbeddingFunction
+from sigmund.library import Library
+
+
+class FakeLocalEmbeddingFunction(LocalEmbeddingFunction):
+    """A local embedding function without a model, which records the
+    batches.
+    """
+    def _load_encoder(self):
+        self.batches = []
+
+        def encoder(batch):
+            self.batches.append(batch)
+            return np.array([[float(len(text)), 1.0] for text in batch])
+        return encoder
+
+
+def test_hashing_embedding_function():
+    embedding_function = HashingEmbeddingFunction(dimensions=64)
+    a, b, c, empty = embedding_function([
+        'How do I define a loop?', 'How do I define a loop?',
+        'Drawing a fixation dot on the sketchpad', ''])
+    assert len(a) == 64
+    assert np.allclose(a, b)
+    assert np.isclose(np.linalg.norm(a), 1)
+    assert not np.any(empty)
+    # Texts with shared words are more similar than unrelated texts
+    d, = embedding_function(['How can I define a loop in OpenSesame?'])
+    assert np.dot(a, d) > np.dot(a, c)
+
+
+def test_local_embedding_function():
+    embedding_function = FakeLocalEmbeddingFunction('fake', batch_size=3,
+                                                    workers=2)
+    texts = [str(i) * i for i in range(1, 9)]
+    embeddings = embedding_function(texts)
+    # Embeddings are returned in order, even though batches are embedded
+    # concurrently
+    assert [embedding[0] for embedding in embeddings] == list(range(1, 9))
+    assert sorted(len(batch) for batch in embedding_function.batches) == \
+        [2, 3, 3]
+
+
+def test_library_with_hashing_provider(tmp_path):
+    with pytest.raises(ValueError):
+        get_embedding_function('unknown', 'model')
+    library = Library(str(tmp_path), 'hashing', 'hashing')
+    library.add([{'content': 'A loop repeats a sequence of items',
+                  'topic': 'loop'},
+                 {'content': 'A sketchpad shows a static display',
+                  'topic': 'sketchpad'}])
+    embedding_cache.clear()
+    results = library.search('How does a loop repeat items?', k=1)
+    assert results[0]['topic'] == 'loop'
+    embedding_cache.clear()
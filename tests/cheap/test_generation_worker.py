@@ -0,0 +1,105 @@
+import json
+from unittest import mock
+from .test_app import BaseRoutesTestCase
+from sigmund import config, generation_worker
+from sigmund.redis_client import redis_client
+
+
+def _events(response):
+    """Parses a server-sent event response into (id, data) tuples."""
+    events = []
+    for frame in response.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in frame.splitlines()
+                      if not line.startswith(':'))
+        if 'data' in fields:
+            events.append((fields.get('id'), json.loads(fields['data'])))
+    return events
+
+
+class TestGenerationWorker(BaseRoutesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        config.settings_default['model_config'] = 'dummy'
+        config.generation_workers = True
+        self._keepalive_interval = config.generation_keepalive_interval
+        config.generation_keepalive_interval = .1
+        self.login()
+        self.client.post('/api/setting/set',
+            json={
+                  'collection_opensesame': 'false',
+                  'collection_datamatrix': 'false'
+            })
+
+    def tearDown(self):
+        config.generation_workers = False
+        config.generation_keepalive_interval = self._keepalive_interval
+        super().tearDown()
+
+    def _start(self):
+        self.client.post('/api/chat/start', data={'message': 'dummy'})
+        with self.client.session_transaction() as session:
+            return session['generation_job']
+
+    def _actions(self):
+        return [data.get('action')
+                for _, data in _events(self.client.get('/api/chat/stream'))]
+
+    def test_generation_worker(self):
+        response = self.client.post('/api/chat/start',
+                                    data={'message': 'dummy'})
+        self.assertTrue(response.json['resumable'])
+        # The reply is generated by the worker, and not by the stream route
+        self.assertTrue(generation_worker.run_next_job(self.app, timeout=1))
+        events = _events(self.client.get('/api/chat/stream'))
+        self.assertEqual(events[-1][1], {'action': 'close'})
+        self.assertTrue(any('response' in data for _, data in events))
+        self.assertTrue(all(event_id is not None for event_id, _ in events))
+        # A client that reconnects only receives the events that it missed
+        resumed = _events(self.client.get(
+            '/api/chat/stream', headers={'Last-Event-ID': events[1][0]}))
+        self.assertEqual(resumed, events[2:])
+        response = self.client.get('/api/chat/stream?last_event_id=x')
+        self.assertEqual(response.status_code, 400)
+
+    def test_generation_worker_failure(self):
+        response = self.client.post('/api/chat/start',
+                                    data={'message': 'dummy'})
+        self.assertTrue(response.json['resumable'])
+        # A job that fails, even before Sigmund has been created, ends with an
+        # error and a close event
+        with mock.patch.object(generation_worker, 'Sigmund',
+                               side_effect=RuntimeError('failure')):
+            self.assertTrue(generation_worker.run_next_job(self.app,
+                                                           timeout=1))
+        events = _events(self.client.get('/api/chat/stream'))
+        self.assertEqual([data.get('action') for _, data in events],
+                         ['error', 'close'])
+
+    def test_generation_worker_lost_jobs(self):
+        # The job contains the encryption key, and expires if no worker takes
+        # it in time. The client then receives an error right away.
+        job_id = self._start()
+        self.assertGreater(
+            redis_client.ttl(generation_worker._job_key(job_id)), 0)
+        redis_client.delete(generation_worker._job_key(job_id))
+        self.assertEqual(self._actions(), ['error', 'close'])
+        # The worker that takes the expired job ends its stream with an error
+        self.assertTrue(generation_worker.run_next_job(self.app, timeout=1))
+        self.assertEqual(self._actions(), ['error', 'close'])
+        self.assertEqual(redis_client.llen(generation_worker.PROCESSING_KEY),
+                         0)
+        # A worker takes a job and dies, so that the job is neither stored nor
+        # running anymore. Only the job id is queued.
+        job_id = self._start()
+        self.assertEqual(
+            redis_client.lrange(generation_worker.JOBS_KEY, 0, -1),
+            [job_id.encode()])
+        redis_client.lmove(generation_worker.JOBS_KEY,
+                           generation_worker.PROCESSING_KEY, 'RIGHT', 'LEFT')
+        redis_client.delete(generation_worker._job_key(job_id))
+        self.assertEqual(self._actions(), ['error', 'close'])
+        self.assertEqual(generation_worker.recover_lost_jobs(), 1)
+        self.assertEqual(redis_client.llen(generation_worker.PROCESSING_KEY),
+                         0)
+        self.assertEqual(self._actions(), ['error', 'close'])
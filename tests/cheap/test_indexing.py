@@ -0,0 +1,58 @@
+import json
+from sigmund import config
+from sigmund.library import Library
+from sigmund.indexing import Indexer, iter_json_array
+
+
+class CountingEmbeddingFunction:
+    """Returns deterministic embeddings, and counts the embedded texts."""
+    def __init__(self):
+        self.embedded = 0
+
+    def __call__(self, texts):
+        self.embedded += len(texts)
+        return [[float(len(text)), 1.0, 0.0] for text in texts]
+
+
+def test_iter_json_array(tmp_path):
+    items = [{'content': 'a, b] c', 'n': i} for i in range(20)] + [[1, 2], 'x']
+    path = tmp_path / 'source.json'
+    path.write_text(json.dumps(items, indent=2))
+    # A small chunk size makes sure that items span multiple chunks
+    assert list(iter_json_array(path, chunk_size=7)) == items
+    path.write_text('[]')
+    assert list(iter_json_array(path)) == []
+
+
+def test_indexer(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'openai_api_key', 'dummy')
+    library = Library(str(tmp_path / 'library'), 'openai',
+                      'text-embedding-3-large')
+    embedding_function = CountingEmbeddingFunction()
+    library.embedding_function = embedding_function
+    docs = [{'content': f'document {i}', 'topic': 'test'} for i in range(10)]
+    path = tmp_path / 'test.json'
+    path.write_text(json.dumps(docs))
+    indexer = Indexer(library, workers=2, batch_size=3)
+    stats = indexer.sync([path])
+    assert stats['added'] == 10 and library.count() == 10
+    assert embedding_function.embedded == 10
+    assert len(library.keyword_index) == 10
+    # Unchanged documents are not embedded again, also not by a new indexer
+    stats = Indexer(library, workers=2, batch_size=3).sync([path])
+    assert stats['unchanged'] == 10
+    assert embedding_function.embedded == 10
+    # Change the content of one document, the metadata of another, and
+    # remove a third one
+    docs[0]['content'] = 'changed document'
+    docs[1]['topic'] = 'changed'
+    del docs[2]
+    path.write_text(json.dumps(docs))
+    stats = indexer.sync([path])
+    assert stats == dict(added=1, updated=1, deleted=2, unchanged=7)
+    assert embedding_function.embedded == 11
+    assert library.count() == 9
+    assert len(library.collection.get(where={'topic': 'changed'})['ids']) == 1
+    # Removing the source removes all of its documents
+    assert indexer.sync([])['deleted'] == 9
+    assert library.count() == 0
@@ -0,0 +1,53 @@
+from sigmund import config
+from sigmund.keyword_index import tokenize, reciprocal_rank_fusion
+from sigmund.library import Library
+
+
+def test_tokenize():
+    assert tokenize('Use dm.series, or var.correct!') == \
+        ['use', 'dm.series', 'dm', 'series', 'or', 'var.correct', 'var',
+         'correct']
+    assert tokenize('A keyboard_response item.') == \
+        ['a', 'keyboard_response', 'keyboard', 'response', 'item']
+
+
+def test_reciprocal_rank_fusion():
+    # b is ranked highly by both, and therefore wins
+    assert reciprocal_rank_fusion([['a', 'b', 'c'], ['b', 'd']], k=60) == \
+        ['b', 'a', 'd', 'c']
+
+
+def test_hybrid_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'search_hybrid', True)
+    library = Library(str(tmp_path), 'hashing', 'hashing')
+    # Documents are added with precomputed embeddings, so that the vector
+    # results are known
+    library.collection.add(
+        ids=['1', '2', '3'],
+        documents=['Collect responses with a keyboard_response item',
+                   'Series are columns with multiple values per cell',
+                   'Use a sketchpad to show a fixation dot'],
+        embeddings=[[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]],
+        metadatas=[{'howto': False}, {'howto': True, 'title': 'dm.series'},
+                   {'howto': False}])
+    assert not library.hybrid
+    library.build_keyword_index()
+    assert library.hybrid and len(library.keyword_index) == 3
+    assert library.keyword_index.search('keyboard_response', 5)[0][0] == '1'
+    # The second document is too far from the query embedding, but is found
+    # by its title through keyword search
+    results = library.search('What is dm.series?', k=2, max_distance=.5,
+                             query_embedding=[1.0, 0.0])
+    assert [result['content'][:7] for result in results] == \
+        ['Collect', 'Series ']
+    assert results[0]['distance'] == 0 and results[1]['distance'] is None
+    # Keyword results also respect the metadata filters
+    results = library.search('What is dm.series?', k=2, max_distance=.5,
+                             query_embedding=[1.0, 0.0], howto=False)
+    assert len(results) == 1
+    # The keyword index is loaded when the library is opened, and is
+    # discarded when the library changes
+    library = Library(str(tmp_path), 'hashing', 'hashing')
+    assert library.hybrid
+    library.delete_all()
+    assert not library.hybrid
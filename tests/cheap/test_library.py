@@ -0,0 +1,27 @@
+from sigmund import config
+from sigmund.library import Library
+
+
+def test_foundation_documents(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'openai_api_key', 'dummy')
+    library = Library(str(tmp_path), 'openai', 'text-embedding-3-large')
+    # Documents are added with precomputed embeddings, so that the embedding
+    # provider isn't called
+    library.collection.add(
+        ids=['1', '2', '3'],
+        documents=['loop foundation', 'loop howto', 'sketchpad foundation'],
+        embeddings=[[1.0] * 4, [2.0] * 4, [3.0] * 4],
+        metadatas=[{'foundation': True, 'topic': 'loop'},
+                   {'foundation': False, 'topic': 'loop'},
+                   {'foundation': True, 'topic': 'sketchpad'}])
+    # Foundation documents are loaded when the library is opened
+    library = Library(str(tmp_path), 'openai', 'text-embedding-3-large',
+                      read_only=True)
+    docs = library.retrieve_foundation_documents(
+        [{'topics': ['sketchpad']}], topics=['loop', 'unknown'])
+    assert sorted(doc['content'] for doc in docs) == \
+        ['loop foundation', 'sketchpad foundation']
+    # Returned documents are copies of the in-memory documents
+    docs[0]['content'] = 'modified'
+    docs = library.retrieve_foundation_documents([], topics=['loop'])
+    assert docs[0]['content'] == 'loop foundation'
@@ -4,7 +4,7 @@ from sigmund.process_sigmund_message import process_ai_message, dedent_code_bloc
     fix_list_formatting_3, fix_list_formatting_4, fix_list_formatting_5, fix_list_formatting_6, \
     fix_list_formatting_7, fix_list_formatting_8, fix_list_formatting_9, \
     fix_list_formatting_10, fix_list_formatting_11, fix_list_formatting_12, \
-    escape_html_tags
+    escape_html_tags, MessageNormalizer
 
 def test_fix_markdown_headings():
     """
@@ -776,3 +776,43 @@ def test_class_attribute_order_does_not_matter():
     message = '<div data-foo="1" class="foo thinking_block_content">Z & Q</div>'
     expected = message
     assert escape_html_tags(message) == expected    
+
+def test_message_normalizer_code_fences():
+    message = 'Code:\n```\n1) a\n• b\n```\n1) a\n• b'
+    expected = 'Code:\n```\n1) a\n• b\n```\n\n1. a\n- b'
+    assert process_ai_message(message) == expected
+
+def test_message_normalizer_colon_at_end():
+    # Unlike fix_indentation_after_colon(), the normalizer also dedents list
+    # items after a line that is identical to the last line
+    message = 'Intro:\n  - sub\nIntro:'
+    assert process_ai_message(message) == 'Intro:\n\n- sub\nIntro:'
+    assert fix_indentation_after_colon(message) == message
+    assert process_ai_message('Intro:') == 'Intro:'
+
+def test_message_normalizer_incremental():
+    message = """Steps:
+1) Open the file
+   - Use `open()`
+2) Read it
+
+    ```python
+    with open('data.txt') as fd:
+        text = fd.read()
+    ```
+──────────
+Result
+──────────
+<div class="thinking_block_content">A & <b>B</b></div>
+"""
+    expected = MessageNormalizer().normalize(message)
+    normalizer = MessageNormalizer()
+    previous_stable = []
+    for end in range(len(message) + 1):
+        stable, pending = normalizer.update(message[:end])
+        # Stable lines only grow
+        assert stable[:len(previous_stable)] == previous_stable
+        previous_stable = stable[:]
+        assert '\n'.join(stable + pending) == \
+            MessageNormalizer().normalize(message[:end])
+    assert '\n'.join(stable + pending) == expected
@@ -0,0 +1,67 @@
+import tempfile
+import uuid
+from unittest import mock
+from sigmund import config
+from sigmund.library import Library
+from .test_app import BaseRoutesTestCase
+
+
+class TestPublicSearch(BaseRoutesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._config = {key: getattr(config, key) for key in (
+            'search_persist_directory', 'search_embedding_provider',
+            'public_search_model_config', 'public_search_rate_limit_burst',
+            'public_search_rate_limit_rate')}
+        config.search_persist_directory = self._tmp_dir.name
+        config.search_embedding_provider = 'hashing'
+        config.public_search_model_config = 'dummy'
+        Library(self._tmp_dir.name, 'hashing',
+                config.search_embedding_model).add([
+            {'content': 'Install the Tobii plugin with PyGaze',
+             'url': 'https://example.com/tobii', 'collection': 'opensesame',
+             'howto': False, 'foundation': False}])
+        # Each test has its own client address, and thus its own rate limit
+        self._environ = {'REMOTE_ADDR': str(uuid.uuid4())}
+
+    def tearDown(self):
+        for key, value in self._config.items():
+            setattr(config, key, value)
+        self._tmp_dir.cleanup()
+        super().tearDown()
+
+    def _search(self, query, headers=None):
+        return self.client.post('/public/search', json={'query': query},
+                                environ_base=self._environ, headers=headers)
+
+    def test_cache(self):
+        # Imported here, because the database models depend on whether the
+        # app has been created
+        from sigmund.routes import public
+        query = f'How do I install Tobii? {uuid.uuid4()}'
+        with mock.patch.object(public, '_retrieve',
+                               wraps=public._retrieve) as retrieve:
+            response = self._search(query)
+            assert response.status_code == 200
+            assert response.json['results']
+            # Differences in case and whitespace don't matter
+            response = self._search(f'  {query.upper()}')
+            assert response.status_code == 200
+            assert retrieve.call_count == 1
+        assert self._search('').status_code == 400
+
+    def test_rate_limit(self):
+        config.public_search_rate_limit_burst = 2
+        config.public_search_rate_limit_rate = 0.01
+        assert self._search('tobii').status_code == 200
+        assert self._search('tobii').status_code == 200
+        response = self._search('tobii')
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+        # A client cannot escape the limit with a spoofed X-Forwarded-For
+        # header, because there is no trusted proxy
+        response = self._search('tobii',
+                                headers={'X-Forwarded-For': str(uuid.uuid4())})
+        assert response.status_code == 429
@@ -0,0 +1,36 @@
+from sigmund import config, render_cache
+from .test_app import BaseRoutesTestCase
+
+
+class TestRenderCache(BaseRoutesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        config.settings_default['model_config'] = 'dummy'
+        self.login()
+        self.client.post('/api/setting/set',
+                         json={'collection_opensesame': 'false',
+                               'collection_datamatrix': 'false'})
+        self.client.post('/api/chat/start', data={'message': 'hello *you*'})
+        for _ in self.client.get('/api/chat/stream').iter_encoded():
+            pass
+
+    def test_render_cache(self):
+        render_cache.clear()
+        misses = render_cache.stats()['misses']
+        response = self.client.get('/chat')
+        assert response.status_code == 200
+        assert 'dummy reply' in response.text
+        # The welcome message, the user message, and the reply
+        assert render_cache.stats()['misses'] == misses + 3
+        # Rendered messages are served from memory
+        hits = render_cache.stats()['hits']
+        self.client.get('/chat')
+        assert render_cache.stats()['hits'] == hits + 3
+        assert render_cache.stats()['misses'] == misses + 3
+        # And, after they have been saved, from the database
+        render_cache.clear()
+        persistent_hits = render_cache.stats()['persistent_hits']
+        response = self.client.get('/chat')
+        assert 'hello *you*' in response.text
+        assert render_cache.stats()['persistent_hits'] == persistent_hits + 3
@@ -0,0 +1,45 @@
+from sigmund.library import Library
+from sigmund.reranking import mmr, stitch_chunks, apply_budget
+
+
+def test_mmr():
+    results = [{'content': 'a', 'embedding': [1.0, 0.0]},
+               {'content': 'a duplicate', 'embedding': [1.0, 0.01]},
+               {'content': 'b', 'embedding': [0.0, 1.0]}]
+    # The near-duplicate is skipped in favor of a less relevant, but
+    # different result
+    assert [result['content'] for result in mmr(results, 2, .5)] == \
+        ['a', 'b']
+    assert not any('embedding' in result for result in results)
+
+
+def test_stitch_chunks():
+    results = [
+        {'content': '# Series\n\nPart 2\n', 'path': 'series.md', 'chunk': 2},
+        {'content': 'Loops', 'path': 'loop.md', 'chunk': 1},
+        {'content': '# Series\n\nPart 1\n', 'path': 'series.md', 'chunk': 1},
+        {'content': '# Series\n\nPart 4', 'path': 'series.md', 'chunk': 4}]
+    stitched = stitch_chunks(results)
+    assert [result['content'] for result in stitched] == \
+        ['# Series\n\nPart 1\n\nPart 2', 'Loops', '# Series\n\nPart 4']
+    assert stitched[0]['chunk'] == 1
+
+
+def test_apply_budget():
+    results = [{'content': 'x' * 10}, {'content': 'x' * 10},
+               {'content': 'x' * 5}]
+    assert [len(result['content']) for result in
+            apply_budget(results, 15)] == [10, 5]
+    # The first result is always kept
+    assert len(apply_budget(results, 5)) == 1
+
+
+def test_search_with_embeddings(tmp_path):
+    library = Library(str(tmp_path), 'hashing', 'hashing')
+    library.collection.add(ids=['1', '2'], documents=['a', 'b'],
+                           embeddings=[[1.0, 0.0], [0.0, 1.0]],
+                           metadatas=[{'howto': False}, {'howto': False}])
+    results = library.search('a', k=2, query_embedding=[1.0, 0.0],
+                             include_embeddings=True, howto=False)
+    assert [list(result['embedding']) for result in results] == \
+        [[1.0, 0.0], [0.0, 1.0]]
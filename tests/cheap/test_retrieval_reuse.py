@@ -0,0 +1,32 @@
+import json
+from sigmund import config
+from sigmund.documentation import Documentation
+
+
+class FakeDatabase:
+    def get_setting(self, key):
+        return 'true'
+
+
+class FakeSigmund:
+    database = FakeDatabase()
+
+
+def test_retrieval_reuse(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'search_persist_directory', str(tmp_path))
+    monkeypatch.setattr(config, 'search_embedding_provider', 'hashing')
+    monkeypatch.setattr(config, 'search_reuse_similarity', .95)
+    documentation = Documentation(FakeSigmund())
+    documentation.append({'content': 'Use a loop item'})
+    # The state is stored with the conversation, so it needs to survive a
+    # JSON round trip
+    state = json.loads(json.dumps(documentation.state([1.0, 0.0, 0.0])))
+    documentation = Documentation(FakeSigmund())
+    assert not documentation.restore(None, [1.0, 0.0, 0.0])
+    assert not documentation.restore(state, [0.0, 1.0, 0.0])
+    assert not list(documentation)
+    assert documentation.restore(state, [1.0, 0.1, 0.0])
+    assert list(documentation) == [{'content': 'Use a loop item'}]
+    # Documents are not reused when other collections are searched
+    documentation._collections.remove('forum')
+    assert not documentation.restore(state, [1.0, 0.0, 0.0])
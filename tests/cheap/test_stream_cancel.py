@@ -0,0 +1,67 @@
+import threading
+from types import SimpleNamespace
+from sigmund import stream_cancel
+from sigmund.redis_client import redis_client
+
+
+def test_stream_cancel():
+    user_id = 'stream-cancel-test'
+    stream_cancel.reset(user_id)
+    event = threading.Event()
+    stream_cancel.watch(user_id, event)
+    assert not event.is_set()
+    # A cancellation that is published by another process sets the local flag
+    redis_client.publish(stream_cancel.CHANNEL, user_id)
+    assert event.wait(timeout=5)
+    stream_cancel.unwatch(user_id, event)
+    # A stream that starts after a cancellation is cancelled right away,
+    # until the cancellation is reset
+    stream_cancel.cancel(user_id)
+    event = threading.Event()
+    stream_cancel.watch(user_id, event)
+    assert event.is_set()
+    stream_cancel.unwatch(user_id, event)
+    stream_cancel.reset(user_id)
+    event = threading.Event()
+    stream_cancel.watch(user_id, event)
+    assert not event.is_set()
+    stream_cancel.unwatch(user_id, event)
+
+
+class _Stream:
+    """Mimics an OpenAI stream that never ends by itself."""
+
+    def __init__(self, sigmund):
+        self.sigmund = sigmund
+        self.closed = False
+
+    def __iter__(self):
+        n = 0
+        while not self.closed:
+            n += 1
+            if n == 3:
+                self.sigmund.cancelled.set()
+            delta = SimpleNamespace(content='word ', tool_calls=None)
+            yield SimpleNamespace(usage=None,
+                                  choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        self.closed = True
+
+
+def test_cancel_model_stream():
+    from sigmund.model import model
+    activity = []
+    sigmund = SimpleNamespace(
+        cancelled=threading.Event(),
+        database=SimpleNamespace(add_activity=activity.append))
+    openai_model = model(sigmund, 'gpt-5.4-mini')
+    stream = _Stream(sigmund)
+    openai_model._client = SimpleNamespace(chat=SimpleNamespace(
+        completions=SimpleNamespace(create=lambda **kwargs: stream)))
+    replies = list(openai_model.predict('hello ' * 100, stream=True))
+    # The stream is closed, nothing is returned after the streamed text, and
+    # the (estimated) usage is recorded
+    assert stream.closed
+    assert replies == [('word ', False), ('word word ', False)]
+    assert len(activity) == 1 and activity[0] > 0
@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+from sigmund.reply import StreamRenderer, StreamReply, StreamCoalescer
+
+
+def _stream(text, step=3):
+    """Feeds the text to a renderer in growing chunks, and reconstructs the
+    client-side list of blocks from the deltas.
+    """
+    renderer = StreamRenderer()
+    blocks = []
+    for end in range(step, len(text) + step, step):
+        start, new_blocks = renderer.update(text[:end])
+        assert start <= len(blocks)
+        blocks = blocks[:start] + new_blocks
+    return blocks
+
+
+def test_stream_renderer_blocks():
+    text = '''First paragraph.
+
+Second paragraph with `code`.
+
+- item 1
+- item 2
+
+Last paragraph.'''
+    blocks = _stream(text)
+    assert len(blocks) == 4
+    assert '<p>First paragraph.</p>' in blocks[0]
+    assert '<ul>' in blocks[2]
+    assert 'Last paragraph.' in blocks[3]
+
+
+def test_stream_renderer_code_fence():
+    text = '''Some code:
+
+```python
+a = 1
+
+b = 2
+```
+
+Done.'''
+    blocks = _stream(text)
+    # The blank line inside the code block should not split the block
+    assert len(blocks) == 3
+    assert 'b' in blocks[1] and 'a' in blocks[1]
+    assert 'Done.' in blocks[2]
+
+
+def test_stream_renderer_finalized_once():
+    renderer = StreamRenderer()
+    start, blocks = renderer.update('Para one.\n\nPara')
+    assert start == 0 and len(blocks) == 2
+    start, blocks = renderer.update('Para one.\n\nPara two.')
+    # The first block is final, so only the second block is resent
+    assert start == 1 and len(blocks) == 1
+    assert 'Para two.' in blocks[0]
+
+
+def test_stream_reply_json():
+    renderer = StreamRenderer()
+    reply = StreamReply('Hello **world**', renderer=renderer)
+    data = json.loads(reply.to_json())
+    assert data['stream_delta']['start'] == 0
+    assert '<strong>world</strong>' in data['stream_delta']['blocks'][0]
+    # Calling to_json() again should give the same result
+    assert json.loads(reply.to_json()) == data
+    data = json.loads(StreamReply('Hello **world**').to_json())
+    assert '<strong>world</strong>' in data['stream']
+
+
+def test_stream_coalescer():
+    text = 'word ' * 100
+    chunks = [text[:end] for end in range(1, len(text) + 1)]
+    # With a long interval, only the first chunk and every 100 characters are
+    # sent. The remaining text is sent by flush().
+    coalescer = StreamCoalescer(interval=60, chars=100)
+    replies = [coalescer.update(chunk) for chunk in chunks]
+    sent = [reply.msg for reply in replies if reply is not None]
+    assert sent == [text[:1], text[:101], text[:201], text[:301], text[:401]]
+    assert coalescer.flush().msg == text
+    assert coalescer.flush() is None
+    # Without an interval, every chunk is sent
+    coalescer = StreamCoalescer(interval=0, chars=100)
+    assert all(coalescer.update(chunk) is not None for chunk in chunks)
+    assert coalescer.flush() is None
+
+
+def _tool_call_chunk():
+    function = SimpleNamespace(name=None, arguments='{}')
+    tool_call = SimpleNamespace(index=0, id=None, type=None,
+                                function=function)
+    delta = SimpleNamespace(content=None, tool_calls=[tool_call])
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+
+def test_stream_coalescer_gap():
+    """Text that is held back is sent once the interval has passed, also when
+    the model streams no new text because it is calling a tool.
+    """
+    from sigmund.model import model
+
+    def stream():
+        for word in ('Let me ', 'check '):
+            delta = SimpleNamespace(content=word, tool_calls=None)
+            yield SimpleNamespace(usage=None,
+                                  choices=[SimpleNamespace(delta=delta)])
+        # A gap in which only tool-call fragments arrive
+        for i in range(3):
+            time.sleep(.1)
+            yield _tool_call_chunk()
+
+    sigmund = SimpleNamespace(cancelled=threading.Event())
+    openai_model = model(sigmund, 'gpt-5.4-mini')
+    openai_model._client = SimpleNamespace(chat=SimpleNamespace(
+        completions=SimpleNamespace(create=lambda **kwargs: stream())))
+    coalescer = StreamCoalescer(interval=.15, chars=100)
+    sent = []
+    for text, complete in openai_model.stream_invoke([]):
+        if not complete:
+            reply = coalescer.update(text)
+            if reply is not None:
+                sent.append(reply.msg)
+    # The second word is sent during the gap, rather than by flush() after
+    # the stream has ended
+    assert sent == ['Let me ', 'Let me check ']
+    assert coalescer.flush() is None
@@ -0,0 +1,62 @@
+import threading
+from sigmund.title_worker import TitleWorker
+
+
+def test_title_worker_dedupe():
+    worker = TitleWorker(workers=1, max_queue_size=10)
+    release = threading.Event()
+    calls = []
+
+    def job(key):
+        release.wait(5)
+        calls.append(key)
+
+    assert worker.submit(1, lambda: job(1))
+    # A second job for the same conversation is ignored while the first one
+    # is pending, but jobs for other conversations are accepted.
+    assert not worker.submit(1, lambda: job(1))
+    assert worker.submit(2, lambda: job(2))
+    release.set()
+    worker.join()
+    assert sorted(calls) == [1, 2]
+    stats = worker.stats()
+    assert stats['submitted'] == 2
+    assert stats['deduplicated'] == 1
+    assert stats['completed'] == 2
+    assert stats['queued'] == 0 and stats['running'] == 0
+    # Once the job has finished, the conversation can be submitted again
+    assert worker.submit(1, lambda: job(1))
+    worker.join()
+
+
+def test_title_worker_bounded():
+    worker = TitleWorker(workers=1, max_queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking_job():
+        started.set()
+        release.wait(5)
+
+    assert worker.submit(1, blocking_job)
+    started.wait(5)
+    assert worker.submit(2, lambda: None)
+    # The queue is full, so this job is dropped
+    assert not worker.submit(3, lambda: None)
+    assert worker.stats()['queued'] == 1
+    assert worker.stats()['dropped'] == 1
+    release.set()
+    worker.join()
+
+
+def test_title_worker_failure():
+    worker = TitleWorker(workers=1, max_queue_size=10)
+
+    def failing_job():
+        raise ValueError()
+
+    assert worker.submit(1, failing_job)
+    worker.join()
+    assert worker.stats()['failed'] == 1
+    assert worker.submit(1, lambda: None)
+    worker.join()
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from .test_app import BaseRoutesTestCase
+from sigmund import config
+from sigmund.database.manager import DatabaseManager
+from sigmund.database.models import db, Activity
+
+
+class TestUsage(BaseRoutesTestCase):
+
+    def test_usage_counters(self):
+        database = DatabaseManager(None, 'usage-test')
+        # Rebuild the counters, because Redis may contain counters from
+        # previous test runs with the same user id
+        database.usage.reconcile()
+        now = datetime.utcnow()
+        for hours, tokens in [(.5, 100), (2, 200), (24 * 8, 400)]:
+            db.session.add(Activity(user_id=database.user_id,
+                                    time=now - timedelta(hours=hours),
+                                    tokens_consumed=tokens))
+        db.session.commit()
+        # Ledger entries that are added directly are picked up by
+        # reconciliation, whereas new activity is counted directly
+        database.usage.reconcile()
+        database.add_activity(50)
+        self.assertEqual(database.usage.hourly(), 150)
+        self.assertEqual(database.usage.weekly(), 350)
+        database.add_activity(10)
+        self.assertEqual(database.usage.hourly(), 160)
+        self.assertEqual(
+            database.usage.weekly(),
+            database.get_activity(
+                time_delta={'days': config.weekly_token_range}))
+        # The buffer balance is cached, but invalidated when it changes
+        self.assertEqual(database.usage.buffer(), 0)
+        database.add_activity_buffer(1000)
+        self.assertEqual(database.usage.buffer(), 1000)
@@ -1,4 +1,6 @@
-from sigmund.utils import prepare_messages, remove_masked_elements
+from concurrent.futures import ThreadPoolExecutor
+import markdown
+from sigmund.utils import prepare_messages, remove_masked_elements, md
 
 
 def test_prepare_messages():
@@ -89,3 +91,38 @@ def test_remove_masked_elements():
     
     result = remove_masked_elements(html_content)
     assert result.strip() == expected_output.strip()
+
+
+def test_md():
+    text = """# Heading
+
+Some *text* with a [link](https://osdoc.cogsci.nl).
+
+# Heading
+
+```python
+print('hello')
+```
+
+```unknownlanguage
+some code
+```
+
+| a | b |
+|---|---|
+| 1 | 2 |
+"""
+    expected = markdown.markdown(
+        text, extensions=['fenced_code', 'codehilite', 'toc', 'attr_list',
+                          'md_in_html', 'tables'])
+    assert '<h1 id="heading_1">' in expected
+    assert 'class="codehilite"' in expected
+    # The Markdown instance, lexers, and formatters are reused, which should
+    # not affect the output
+    assert md(text) == expected
+    assert md('Other text') == '<p>Other text</p>'
+    assert md(text) == expected
+    # Each thread has its own Markdown instance
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(md, [text] * 8)) == [expected] * 8
+